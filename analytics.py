@@ -0,0 +1,246 @@
+import json
+import time
+
+import dedup
+import store
+
+# Market figures over the listings history, precomputed into two small
+# tables and refreshed incrementally after each scrape (see refresh):
+#   analytics_listings  one row per accepted listing: model, year, state,
+#                       current and first observed price, days on sale
+#   analytics_models    per model and year: price quartiles of the ads on
+#                       sale, median time to sell, price drops
+# Reads are indexed queries on these tables and do not touch the history.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS analytics_listings (
+    lien TEXT PRIMARY KEY,
+    site TEXT,
+    model_key TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    active INTEGER NOT NULL,
+    sold INTEGER NOT NULL,
+    price INTEGER,
+    first_price INTEGER,
+    min_price INTEGER,
+    max_price INTEGER,
+    observations INTEGER NOT NULL,
+    drop_pct REAL,
+    days_listed REAL
+);
+CREATE INDEX IF NOT EXISTS idx_analytics_listings_model ON analytics_listings (model_key, year);
+CREATE INDEX IF NOT EXISTS idx_analytics_listings_drop ON analytics_listings (active, drop_pct);
+CREATE TABLE IF NOT EXISTS analytics_models (
+    model_key TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    listings INTEGER NOT NULL,
+    active INTEGER NOT NULL,
+    sold INTEGER NOT NULL,
+    median_price REAL,
+    p25_price REAL,
+    p75_price REAL,
+    median_days_to_sell REAL,
+    price_drops INTEGER NOT NULL,
+    median_drop_pct REAL,
+    PRIMARY KEY (model_key, year)
+);
+CREATE INDEX IF NOT EXISTS idx_analytics_models_listings ON analytics_models (listings);
+"""
+
+# Model years in ad titles; listings without one are grouped under year 0
+YEAR_RE = r"\b(19[89]\d|20[0-4]\d)\b"
+DAY = 24 * 3600
+
+# Refreshes racing another worker's start over this many times at most
+REFRESH_ATTEMPTS = 3
+
+_initialized = set()
+
+def _ensure_schema(path=None):
+    # Keyed by the file actually opened, so a store moved to a new DB_PATH gets its tables too
+    path = path or store.DB_PATH
+    if path not in _initialized:
+        with store.transaction(path) as conn:
+            conn.executescript(SCHEMA)
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('analytics_version', -1)")
+        _initialized.add(path)
+
+def get_version(path=None):
+    """Data version the rollups were last refreshed at (-1 before the first refresh)."""
+    _ensure_schema(path)
+    with store.transaction(path) as conn:
+        return conn.execute("SELECT value FROM meta WHERE key = 'analytics_version'").fetchone()[0]
+
+def listing_frame(listings, history):
+    """Per-listing figures from a frame of listings and one of their price
+    observations (lien, observed_at, prix_num), computed column-wise."""
+    import numpy as np
+
+    observed = history.sort_values(["lien", "observed_at"]).groupby("lien")["prix_num"]
+    prices = observed.agg(first_price="first", min_price="min", max_price="max", observations="count")
+
+    df = listings.set_index("lien").join(prices, how="left")
+    df["observations"] = df["observations"].fillna(0).astype("int64")
+    df["model_key"] = df["model"].fillna("").map(lambda title: dedup.model_key(dedup.title_tokens(title)))
+    df["year"] = df["model"].fillna("").str.extract(YEAR_RE, expand=False).fillna(0).astype("int64")
+    visible = df["duplicate"] == 0
+    df["active"] = ((df["gone"] == 0) & visible).astype("int64")
+    df["sold"] = ((df["gone"] == 1) & visible).astype("int64")
+    df["price"] = df["prix_num"].where(df["prix_num"] > 0)
+    df["drop_pct"] = np.where(
+        (df["first_price"] > 0) & (df["price"] > 0),
+        (df["first_price"] - df["price"]) / df["first_price"] * 100,
+        np.nan,
+    ).round(2)
+    df["days_listed"] = ((df["last_seen"] - df["first_seen"]) / DAY).round(2)
+    columns = ["site", "model_key", "year", "active", "sold", "price", "first_price", "min_price", "max_price",
+               "observations", "drop_pct", "days_listed"]
+    return df[columns].reset_index()
+
+def model_frame(per_listing):
+    """Per model and year rollups of listing_frame rows."""
+    import pandas as pd
+
+    keys = ["model_key", "year"]
+    groups = per_listing.groupby(keys)
+    on_sale = per_listing[(per_listing["active"] == 1) & per_listing["price"].notna()].groupby(keys)["price"]
+    sold = per_listing[per_listing["sold"] == 1].groupby(keys)["days_listed"]
+    drops = per_listing[(per_listing["active"] == 1) & (per_listing["drop_pct"] > 0)].groupby(keys)["drop_pct"]
+
+    rollup = pd.DataFrame({
+        "listings": groups.size(),
+        "active": groups["active"].sum(),
+        "sold": groups["sold"].sum(),
+        "median_price": on_sale.median(),
+        "p25_price": on_sale.quantile(0.25),
+        "p75_price": on_sale.quantile(0.75),
+        "median_days_to_sell": sold.median(),
+        "price_drops": drops.size(),
+        "median_drop_pct": drops.median(),
+    })
+    rollup["price_drops"] = rollup["price_drops"].fillna(0).astype("int64")
+    return rollup.reset_index()
+
+def _records(df):
+    # NaN becomes NULL, numpy scalars become Python ones
+    return [
+        tuple(None if value != value else (value.item() if hasattr(value, "item") else value) for value in row)
+        for row in df.itertuples(index=False, name=None)
+    ]
+
+def refresh(full=False, path=None):
+    """Bring the rollups up to date with the listings store.
+
+    Only listings that changed since the last refresh (per the store's
+    change log) are re-read, and only the model groups they leave or join
+    are recomputed. ``full`` rebuilds everything, as does a refresh whose
+    change log no longer reaches back. The figures are computed from a read
+    snapshot, so scrapes keep writing meanwhile; the write lock is only
+    taken to swap the rows in. Returns the number of listings re-read.
+    """
+    for _ in range(REFRESH_ATTEMPTS):
+        since = get_version(path)
+        liens, version = store.changed_liens(since, path) if since >= 0 and not full else (None, None)
+        if liens is not None and not liens:
+            return 0
+        started = time.perf_counter()
+        version, per_listing, groups, rollup = _compute(liens, version, path)
+
+        with store.transaction(path, immediate=True) as conn:
+            if conn.execute("SELECT value FROM meta WHERE key = 'analytics_version'").fetchone()[0] != since:
+                # Another worker refreshed meanwhile, so the groups read may be stale: start over
+                continue
+            if liens is None:
+                conn.execute("DELETE FROM analytics_listings")
+                conn.execute("DELETE FROM analytics_models")
+            else:
+                conn.execute("DELETE FROM analytics_listings WHERE lien IN (SELECT value FROM json_each(?))", (json.dumps(liens),))
+                conn.executemany("DELETE FROM analytics_models WHERE model_key = ? AND year = ?", sorted(groups))
+            for table, df in (("analytics_listings", per_listing), ("analytics_models", rollup)):
+                if not df.empty:
+                    conn.executemany(
+                        f"INSERT INTO {table} ({', '.join(df.columns)}) VALUES ({', '.join('?' * len(df.columns))})",
+                        _records(df),
+                    )
+            conn.execute("UPDATE meta SET value = ? WHERE key = 'analytics_version'", (version,))
+
+        print(f"Analytics: {len(per_listing)} listings re-read, {len(rollup)} model groups updated in {time.perf_counter() - started:.2f}s.")
+        return len(per_listing)
+    print("Analytics: skipped, other refreshes kept getting there first.")
+    return 0
+
+def _compute(liens, version, path=None):
+    """Read the changed listings (all when ``liens`` is None) in one
+    snapshot and build their rows and those of the model groups they touch:
+    (version, per_listing, groups, rollup). groups is None for a full build."""
+    import pandas as pd
+
+    with store.transaction(path) as conn:
+        # A deferred transaction: every read below sees the same snapshot
+        conn.execute("BEGIN")
+        if liens is None:
+            version = store.read_version(conn)
+        where = "" if liens is None else "AND lien IN (SELECT value FROM json_each(?))"
+        params = () if liens is None else (json.dumps(liens),)
+        listings = pd.read_sql_query(
+            f"SELECT lien, site, model, prix_num, gone, duplicate, first_seen, last_seen FROM listings WHERE data IS NOT NULL {where}",
+            conn, params=params,
+        )
+        history = pd.read_sql_query(f"SELECT lien, observed_at, prix_num FROM price_history WHERE 1 {where}", conn, params=params)
+        per_listing = listing_frame(listings, history)
+
+        if liens is None:
+            members, groups = per_listing, None
+        else:
+            # Groups the changed listings were in, and the ones they are in now
+            old = conn.execute(
+                "SELECT DISTINCT model_key, year FROM analytics_listings WHERE lien IN (SELECT value FROM json_each(?))", params
+            ).fetchall()
+            groups = {(row["model_key"], row["year"]) for row in old}
+            groups |= set(zip(per_listing["model_key"], per_listing["year"].tolist()))
+            others = pd.read_sql_query(
+                "SELECT * FROM analytics_listings WHERE model_key IN (SELECT value FROM json_each(?)) "
+                "AND lien NOT IN (SELECT value FROM json_each(?))",
+                conn, params=(json.dumps(sorted({model for model, _ in groups})), params[0]),
+            )
+            members = pd.concat([others, per_listing], ignore_index=True) if not others.empty else per_listing
+            members = members[[key in groups for key in zip(members["model_key"], members["year"])]]
+    rollup = model_frame(members) if not members.empty else pd.DataFrame()
+    return version, per_listing, groups, rollup
+
+def models(model=None, year=None, min_listings=1, limit=50, path=None):
+    """Rollups per model and year, most listed first; ``model`` matches the
+    start of the model key (e.g. "toyota" or "toyota hiace")."""
+    _ensure_schema(path)
+    clauses, params = ["listings >= ?"], [min_listings]
+    if model:
+        clauses.append("model_key LIKE ?")
+        params.append(" ".join(dedup.title_tokens(model)) + "%")
+    if year is not None:
+        clauses.append("year = ?")
+        params.append(year)
+    with store.transaction(path) as conn:
+        rows = conn.execute(
+            f"SELECT * FROM analytics_models WHERE {' AND '.join(clauses)} ORDER BY listings DESC, model_key, year LIMIT ?",
+            (*params, limit),
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+def price_drops(model=None, limit=20, path=None):
+    """Ads on sale whose price fell the most since they were first seen."""
+    _ensure_schema(path)
+    clauses, params = ["a.active = 1", "a.drop_pct > 0"], []
+    if model:
+        clauses.append("a.model_key LIKE ?")
+        params.append(" ".join(dedup.title_tokens(model)) + "%")
+    with store.transaction(path) as conn:
+        rows = conn.execute(
+            f"""
+            SELECT a.lien, a.site, l.model, a.model_key, a.year, a.first_price, a.price, a.drop_pct, a.days_listed
+            FROM analytics_listings a JOIN listings l ON l.lien = a.lien
+            WHERE {' AND '.join(clauses)}
+            ORDER BY a.drop_pct DESC LIMIT ?
+            """,
+            (*params, limit),
+        ).fetchall()
+    return [dict(row) for row in rows]
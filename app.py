@@ -1,12 +1,27 @@
-from flask import Flask, render_template, request, jsonify, send_file, send_from_directory
+from flask import Flask, Response, g, redirect, render_template, request, jsonify, send_file, send_from_directory
 from flask_cors import CORS
+import analytics
+import fetcher
 import scraper
+import store
+import events
+import jobs
+import metrics
+import contextlib
+import io
 import os
 import threading
+import time
+from collections import defaultdict
 from apscheduler.schedulers.background import BackgroundScheduler
 from datetime import datetime
 import json
-from pywebpush import webpush, WebPushException
+import notifications
+import scheduling
+import searches
+import subscriptions
+import thumbs
+from urllib.parse import urlsplit
 
 app = Flask(__name__, static_folder='frontend/dist', template_folder='frontend/dist')
 CORS(app) # Enable CORS for cross-origin mobile access
@@ -17,10 +32,53 @@ VAPID_PRIVATE_KEY = os.environ.get("VAPID_PRIVATE_KEY")
 VAPID_PUBLIC_KEY = os.environ.get("VAPID_PUBLIC_KEY")
 VAPID_EMAIL = os.environ.get("VAPID_EMAIL", "mailto:admin@example.com")
 
-# Global variables to track state
-scraping_active = False
-last_results = []
-last_csv_path = "liste_annonces_v2.csv" # Fixed path for persistence
+# Scrapes run as jobs shared by every gunicorn worker through the store
+job_manager = jobs.JobManager()
+SCRAPE_JOB = "scrape"
+PHONE_JOB = "phones"
+IMAGE_JOB = "images"
+# Queries of the daily scrape, as a JSON list of {"keyword", "avito_url"}
+DAILY_QUERIES = json.loads(os.environ.get("SCRAPER_DAILY_QUERIES", "null")) or [scraper.DEFAULT_QUERY]
+# Most queries one scrape job may fan out to
+MAX_QUERIES = 20
+# "adaptive": probe each site as often as it changes (see scheduling.py);
+# "daily": scrape every site in full at 20:00
+SCRAPE_SCHEDULE = os.environ.get("SCRAPER_SCHEDULE", "adaptive")
+SCHEDULE_JOB = "schedule"
+SCHEDULE_TICK_MINUTES = 5
+legacy_csv_path = "liste_annonces_v2.csv" # Pre-SQLite results, imported once
+
+# SSE streams follow the scrape jobs' event log, which one poller per
+# worker reads every SSE_POLL_SECONDS for all of them (events.EventTail).
+# A stream sends a comment every SSE_HEARTBEAT_SECONDS to keep proxies from
+# closing it, and is closed after SSE_MAX_SECONDS; EventSource reconnects
+# on its own and resumes after its Last-Event-ID. Each open stream holds
+# one of the worker's WEB_THREADS threads (the Procfile starts gunicorn
+# with as many), so SSE_MAX_STREAMS leaves two of them for the rest of the API.
+WEB_THREADS = int(os.environ.get("WEB_THREADS", 8))
+SSE_POLL_SECONDS = 1
+SSE_HEARTBEAT_SECONDS = 15
+SSE_MAX_SECONDS = 300
+SSE_MAX_STREAMS = int(os.environ.get("SCRAPER_SSE_MAX_STREAMS", max(WEB_THREADS - 2, 1)))
+sse_slots = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+event_tail = events.EventTail(lambda after: job_manager.events(SCRAPE_JOB, after), interval=SSE_POLL_SECONDS)
+
+# Phone numbers not asked for yet are looked up in the background, this
+# many sellers every PHONE_BATCH_MINUTES, and never while a scrape runs
+PHONE_BATCH_SIZE = int(os.environ.get("SCRAPER_PHONE_BATCH_SIZE", 20))
+PHONE_BATCH_MINUTES = int(os.environ.get("SCRAPER_PHONE_BATCH_MINUTES", 30))
+
+# Set to a directory to save a cProfile dump of every scrape job there
+PROFILE_DIR = os.environ.get("SCRAPER_PROFILE_DIR")
+if PROFILE_DIR:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+
+# Seed an empty listings store from the legacy CSV
+try:
+    if store.count_listings() == 0 and os.path.exists(legacy_csv_path):
+        store.import_csv(legacy_csv_path)
+except Exception as e:
+    print(f"Legacy CSV import error: {e}")
 
 # Load VAPID keys from file if not in environment
 if not VAPID_PRIVATE_KEY and os.path.exists("vapid_keys.json"):
@@ -29,68 +87,197 @@ if not VAPID_PRIVATE_KEY and os.path.exists("vapid_keys.json"):
         VAPID_PRIVATE_KEY = keys.get("private_key")
         VAPID_PUBLIC_KEY = keys.get("public_key")
 
-# Subscriptions storage
+# Page size of /listings, and of the first page still embedded in /status
+LISTINGS_PAGE_SIZE = 50
+LISTINGS_MAX_PAGE_SIZE = 200
+
+# Listing images are served as cached thumbnails from /img/<id>; an id
+# always names the same source image, so browsers may keep them for a year
+thumbnail_cache = thumbs.ThumbnailCache()
+THUMB_MAX_AGE = 365 * 24 * 60 * 60
+# Images not cached yet are fetched while the browser waits, outside the
+# scraper's per-host limiter (see fetcher.direct_get), with a short
+# timeout and at most THUMB_MAX_FETCHES at once so they cannot tie up the
+# worker's threads; past that the browser is sent to the source image.
+THUMB_MAX_FETCHES = int(os.environ.get("SCRAPER_THUMB_MAX_FETCHES", 3))
+THUMB_FETCH_TIMEOUT = (3, 5)
+thumb_fetch_slots = threading.BoundedSemaphore(THUMB_MAX_FETCHES)
+
+# Subscriptions storage; the JSON file is only read once to seed the store
 SUBSCRIPTIONS_FILE = "subscriptions.json"
+subscription_store = subscriptions.SubscriptionStore(legacy_file=SUBSCRIPTIONS_FILE)
+search_store = searches.SearchStore()
 
-def get_subscriptions():
-    if os.path.exists(SUBSCRIPTIONS_FILE):
-        try:
-            with open(SUBSCRIPTIONS_FILE, "r") as f:
-                return json.load(f)
-        except:
-            return []
-    return []
-
-def save_subscription(sub):
-    subs = get_subscriptions()
-    if sub not in subs:
-        subs.append(sub)
-        with open(SUBSCRIPTIONS_FILE, "w") as f:
-            json.dump(subs, f)
+# Listings named in a targeted push before it says "and N more"
+PUSH_LISTED_ADS = 2
+
+push_dispatcher = None
+
+def get_push_dispatcher():
+    global push_dispatcher
+    if push_dispatcher is None and VAPID_PRIVATE_KEY:
+        push_dispatcher = notifications.PushDispatcher(VAPID_PRIVATE_KEY, VAPID_EMAIL)
+    return push_dispatcher
 
 def send_notification(title, body):
-    if not VAPID_PRIVATE_KEY:
+    """Queue a push to every subscriber; returns a Future of the delivery stats."""
+    dispatcher = get_push_dispatcher()
+    if dispatcher is None:
         print("VAPID_PRIVATE_KEY not set, skipping notification")
-        return
-        
-    subs = get_subscriptions()
-    for sub in subs:
-        try:
-            webpush(
-                subscription_info=sub,
-                data=json.dumps({"title": title, "body": body}),
-                vapid_private_key=VAPID_PRIVATE_KEY,
-                vapid_claims={"sub": VAPID_EMAIL}
-            )
-        except WebPushException as ex:
-            print(f"Notification error for {sub.get('endpoint')}: {ex}")
-        except Exception as e:
-            print(f"Unexpected notification error: {e}")
-
-def perform_scrape(keyword='minibus', avito_url='https://www.avito.ma/fr/maroc/fourgon_et_minibus'):
-    global scraping_active, last_results, last_csv_path
-    if scraping_active:
-        return
-        
-    scraping_active = True
+        return None
+
+    return dispatcher.send_async(subscription_store.all(), title, body, on_gone=prune_subscriptions)
+
+def prune_subscriptions(endpoints):
+    subscription_store.delete(endpoints)
+    search_store.delete_endpoints(endpoints)
+
+def _matches_message(ads):
+    names = [f"{ad['model']} ({ad['prix']})" for ad in ads[:PUSH_LISTED_ADS]]
+    more = len(ads) - len(names)
+    title = f"{len(ads)} nouvelle annonce pour vous" if len(ads) == 1 else f"{len(ads)} nouvelles annonces pour vous"
+    return title, ", ".join(names) + (f" et {more} autre(s)" if more else "")
+
+def notify_new_listings(since, total):
+    """Push each subscriber the new listings matching their saved searches.
+
+    Subscribers without saved searches keep getting the run summary;
+    those with searches hear only about matches. Returns a Future of the
+    delivery stats, or None.
+    """
+    dispatcher = get_push_dispatcher()
+    if dispatcher is None:
+        print("VAPID_PRIVATE_KEY not set, skipping notification")
+        return None
+
+    index = search_store.index()
+    matched = defaultdict(dict)
+    for search_id, ads in index.match(store.new_listings(since)).items():
+        endpoint = index.searches[search_id]["endpoint"]
+        for ad in ads:
+            matched[endpoint][ad["lien"]] = ad
+    with_searches = {s["endpoint"] for s in index.searches.values()}
+
+    messages = []
+    for sub in subscription_store.all():
+        endpoint = sub["endpoint"]
+        if matched.get(endpoint):
+            messages.append((sub, *_matches_message(list(matched[endpoint].values()))))
+        elif endpoint not in with_searches and total:
+            messages.append((sub, "Scraping Terminé", f"J'ai trouvé {total} minibus pour vous !"))
+    if not messages:
+        return None
+    return dispatcher.send_each_async(messages, on_gone=prune_subscriptions)
+
+def scrape_job(job, keyword='minibus', avito_url='https://www.avito.ma/fr/maroc/fourgon_et_minibus', queries=None,
+               site_names=None, summary=True):
+    def progress(event, **data):
+        # Parsed ads go to the event log in the shape /listings returns them
+        if data.get("listing"):
+            data["listing"] = _use_thumbnails([{k: data["listing"].get(k) or "" for k in store.FIELDNAMES}])[0]
+        job.report(event, **data)
+
+    started_at = time.time()
+    profile = metrics.profiled(os.path.join(PROFILE_DIR, f"scrape-{job.id}.prof")) if PROFILE_DIR else contextlib.nullcontext()
     try:
-        results, csv_path = scraper.run_full_scrape(keyword, avito_url)
-        last_results = results
-        # Ensure results are persistent
-        if results:
-            send_notification("Scraping Terminé", f"J'ai trouvé {len(results)} minibus pour vous !")
+        with profile:
+            queries = queries or [{"keyword": keyword, "avito_url": avito_url}]
+            found = scraper.run_multi_scrape(queries, incremental=True, progress=progress, should_stop=job.should_stop,
+                                             site_names=site_names)
+    except scraper.ScrapeCancelled:
+        raise jobs.JobCancelled()
     except Exception as e:
         print(f"Scraping error: {e}")
         send_notification("Erreur Scraping", f"Une erreur est survenue : {str(e)[:50]}")
-    finally:
-        scraping_active = False
+        raise
+
+    count = found["count"]
+    try:
+        # Scheduled crawls of a few sites only push saved-search matches
+        notify_new_listings(started_at, count if summary else 0)
+    except Exception as e:
+        print(f"Notification error: {e}")
+    # Pairs of listings only their photos can settle are compared off the scrape's path
+    job_manager.submit(IMAGE_JOB, image_job, dedupe_key=f"images:{job.id}", after=job.id)
+    return {"count": count, "new": len(found["new"]),
+            "queries": [{**query, "count": vehicles} for query, vehicles in zip(queries, found["queries"])]}
+
+def perform_scrape(keyword='minibus', avito_url='https://www.avito.ma/fr/maroc/fourgon_et_minibus', dedupe_key=None, queries=None,
+                   **options):
+    """Start a scrape job unless one is already running in any worker; returns (job, started).
+
+    ``queries`` ({"keyword", "avito_url"} dicts) are all scraped by the one
+    job, sharing the listing and detail pages they have in common.
+    ``options`` are passed on to scrape_job (site_names, summary).
+    """
+    if queries:
+        return job_manager.submit(SCRAPE_JOB, scrape_job, dedupe_key=dedupe_key, queries=queries, **options)
+    return job_manager.submit(SCRAPE_JOB, scrape_job, dedupe_key=dedupe_key, keyword=keyword, avito_url=avito_url, **options)
+
+def daily_scrape():
+    # Every worker's scheduler fires; the dedupe key lets only one of them run it
+    perform_scrape(dedupe_key=f"daily_scrape:{datetime.now():%Y-%m-%d}", queries=DAILY_QUERIES)
+
+def schedule_job(job):
+    def crawl(site_names):
+        print(f"Scheduled crawl of {', '.join(site_names)}")
+        perform_scrape(queries=DAILY_QUERIES, site_names=site_names, summary=False)
+
+    return {"crawled": scheduling.tick(DAILY_QUERIES, crawl)}
+
+def adaptive_scrape():
+    # Ticks with no site due are not recorded as jobs
+    if job_manager.active(SCRAPE_JOB) is not None or not scheduling.due_sites():
+        return
+    # Every worker's scheduler fires; one check per tick runs
+    slot = int(time.time() // (SCHEDULE_TICK_MINUTES * 60))
+    job_manager.submit(SCHEDULE_JOB, schedule_job, dedupe_key=f"adaptive_scrape:{slot}")
+
+def phone_job(job, limit=PHONE_BATCH_SIZE):
+    # Low priority: give way to any scrape that starts meanwhile
+    should_stop = lambda: job.should_stop() or job_manager.active(SCRAPE_JOB) is not None
+    return {"resolved": scraper.resolve_pending_phones(limit, should_stop=should_stop)}
+
+def image_job(job, after=None, limit=scraper.IMAGE_HASH_BATCH):
+    # Low priority: give way to any scrape other than the one that started it
+    def should_stop():
+        active = job_manager.active(SCRAPE_JOB)
+        return job.should_stop() or (active is not None and active["id"] != after)
+    return {"hashed": store.hash_images(scraper.fetch_image, limit, should_stop=should_stop)}
+
+def phone_batch():
+    if job_manager.active(SCRAPE_JOB) is not None or not store.pending_phones(1, scraper.PHONE_TTL):
+        return
+    # One batch per interval across workers, as for the daily scrape
+    slot = int(time.time() // (PHONE_BATCH_MINUTES * 60))
+    job_manager.submit(PHONE_JOB, phone_job, dedupe_key=f"phone_batch:{slot}")
 
 # Setup APScheduler
 scheduler = BackgroundScheduler()
-# Run daily at 20:00 (8 PM)
-scheduler.add_job(func=perform_scrape, id='daily_scrape', trigger="cron", hour=20, minute=0, replace_existing=True)
+if SCRAPE_SCHEDULE == "daily":
+    # Run daily at 20:00 (8 PM)
+    scheduler.add_job(func=daily_scrape, id='daily_scrape', trigger="cron", hour=20, minute=0, replace_existing=True)
+else:
+    scheduler.add_job(func=adaptive_scrape, id='adaptive_scrape', trigger="interval", minutes=SCHEDULE_TICK_MINUTES, replace_existing=True)
+scheduler.add_job(func=phone_batch, id='phone_batch', trigger="interval", minutes=PHONE_BATCH_MINUTES, replace_existing=True)
 scheduler.start()
 
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_latency(response):
+    # Label by route pattern, not path, so /jobs/<id> stays one series
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    if "started" in g:
+        metrics.ROUTE_SECONDS.observe(time.perf_counter() - g.started, route=route, method=request.method, status=str(response.status_code))
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
     if os.path.exists(os.path.join(app.static_folder, 'index.html')):
@@ -105,49 +292,304 @@ def serve_static(path):
 
 @app.route('/scrape', methods=['POST'])
 def run_scrape():
-    if scraping_active:
-        return jsonify({"status": "error", "message": "Scrape already in progress"}), 400
-    
     data = request.json or {}
     keyword = data.get('keyword', 'minibus')
     avito_url = data.get('avito_url', 'https://www.avito.ma/fr/maroc/fourgon_et_minibus')
-    
-    thread = threading.Thread(target=perform_scrape, args=(keyword, avito_url))
-    thread.start()
-    return jsonify({"status": "started"})
+    queries = data.get('queries')
+    if queries is not None:
+        if not isinstance(queries, list) or not queries or not all(isinstance(q, dict) for q in queries):
+            return jsonify({"status": "error", "message": "queries must be a list of {keyword, avito_url} objects"}), 400
+        if len(queries) > MAX_QUERIES:
+            return jsonify({"status": "error", "message": f"At most {MAX_QUERIES} queries"}), 400
+        queries = [
+            {"keyword": q.get('keyword') or keyword, "avito_url": q.get('avito_url') or avito_url}
+            for q in queries
+        ]
+
+    job, started = perform_scrape(keyword, avito_url, queries=queries)
+    if not started:
+        return jsonify({"status": "error", "message": "Scrape already in progress", "job_id": job["id"] if job else None}), 400
+    return jsonify({"status": "started", "job_id": job["id"]})
+
+@app.route('/schedule')
+def get_schedule():
+    return jsonify({"mode": SCRAPE_SCHEDULE, "budget": scheduling.ADAPTIVE_DAILY_REQUESTS,
+                    "requests_24h": store.requests_since(time.time() - scheduling.DAY), "sites": scheduling.plan()})
+
+@app.route('/jobs')
+def list_jobs():
+    # ?kind=scrape leaves out the background jobs (schedule, phones, images)
+    return jsonify({"jobs": job_manager.list(kind=request.args.get('kind'))})
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({"status": "error", "message": "Unknown job"}), 404
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    if not job_manager.cancel(job_id):
+        return jsonify({"status": "error", "message": "Job is not running"}), 400
+    return jsonify({"status": "cancelling", "job_id": job_id})
+
+def _not_modified(etag):
+    """A 304 response if the client already holds the version tagged ``etag``."""
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+def _use_thumbnails(results):
+    """Point listing images at the thumbnail proxy, keeping the source url."""
+    for ad in results:
+        if ad.get("image"):
+            ad["image_original"] = ad["image"]
+            ad["image"] = f"/img/{store.image_id(ad['image'])}"
+    return results
 
 @app.route('/status')
 def status():
-    # Try to reload last results from CSV if memory is empty (e.g. after server restart)
-    global last_results
-    if not last_results and os.path.exists(last_csv_path):
-        import pandas as pd
-        try:
-            df = pd.read_csv(last_csv_path)
-            last_results = df.to_dict('records')
-        except:
-            pass
-
-    return jsonify({
-        "active": scraping_active,
-        "count": len(last_results),
-        "results": last_results
+    # The ETag covers both the data version and the running job
+    version = store.get_version()
+    active_job = job_manager.active(SCRAPE_JOB)
+    etag = f"{version}-{active_job['id'] if active_job else 0}"
+    cached = _not_modified(etag)
+    if cached:
+        return cached
+
+    # Progress only; "results" is the first page of /listings so the
+    # installed PWA builds that still read it keep working.
+    results, next_cursor = store.query_listings(limit=LISTINGS_PAGE_SIZE)
+    _use_thumbnails(results)
+    response = jsonify({
+        "active": active_job is not None,
+        "job_id": active_job["id"] if active_job else None,
+        "version": version,
+        "count": store.count_listings(),
+        "results": results,
+        "next_cursor": next_cursor
+    })
+    response.set_etag(etag)
+    return response
+
+def _number_arg(name):
+    value = request.args.get(name)
+    return int(value) if value not in (None, "") else None
+
+@app.route('/listings')
+def listings():
+    version = store.get_version()
+    etag = str(version)
+    cached = _not_modified(etag)
+    if cached:
+        return cached
+
+    try:
+        since = _number_arg('since')
+        if since is not None:
+            # Delta mode: what changed after the version the client holds
+            delta = store.changes_since(since)
+            payload = delta if delta is not None else {"version": version, "reset": True}
+            _use_thumbnails(payload.get("changed", []))
+        else:
+            limit = min(int(request.args.get('limit', LISTINGS_PAGE_SIZE)), LISTINGS_MAX_PAGE_SIZE)
+            results, next_cursor = store.query_listings(
+                site=request.args.get('site'),
+                min_price=_number_arg('min_price'),
+                max_price=_number_arg('max_price'),
+                date_from=request.args.get('date_from'),
+                date_to=request.args.get('date_to'),
+                keyword=request.args.get('q'),
+                sort=request.args.get('sort', 'date'),
+                order=request.args.get('order', 'desc'),
+                limit=max(limit, 1),
+                cursor=request.args.get('cursor'),
+            )
+            _use_thumbnails(results)
+            payload = {"version": version, "results": results, "next_cursor": next_cursor}
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    response = jsonify(payload)
+    response.set_etag(etag)
+    return response
+
+@app.route('/events')
+def scrape_event_stream():
+    """Scrape progress as SSE: the scrape jobs' event log from the client's
+    Last-Event-ID on, or from the start of the running job."""
+    if not sse_slots.acquire(blocking=False):
+        response = jsonify({"status": "error", "message": "Too many event streams, poll /status instead"})
+        response.status_code = 503
+        response.headers["Retry-After"] = str(SSE_HEARTBEAT_SECONDS)
+        return response
+
+    try:
+        after = int(request.headers.get("Last-Event-ID") or request.args.get("last_event_id") or -1)
+    except ValueError:
+        after = -1
+    if after < 0:
+        after = job_manager.event_cursor(SCRAPE_JOB)
+
+    def stream(after):
+        active = job_manager.active(SCRAPE_JOB)
+        yield f"retry: 5000\n{events.format_sse(None, 'status', {'active': active is not None})}"
+        deadline = time.monotonic() + SSE_MAX_SECONDS
+        while time.monotonic() < deadline:
+            batch = event_tail.wait(after, min(SSE_HEARTBEAT_SECONDS, deadline - time.monotonic()))
+            if not batch:
+                yield ": keep-alive\n\n"
+            for event in batch:
+                yield events.format_sse(event["id"], event["event"], {"job_id": event["job_id"], **event["data"]})
+                after = event["id"]
+
+    # The stream reads only the store, so it needs no request context
+    response = Response(stream(after), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
     })
+    # Runs however the stream ends, even before its first message
+    response.call_on_close(sse_slots.release)
+    return response
+
+class ThumbnailBusy(Exception):
+    """Every thumbnail fetch slot is taken; carries the source url."""
+
+@app.route('/img/<image_id>')
+def listing_image(image_id):
+    def fetch():
+        url = store.get_image_url(image_id)
+        if not url:
+            raise LookupError(image_id)
+        if url.startswith("//"):
+            url = "https:" + url
+        if not thumb_fetch_slots.acquire(blocking=False):
+            raise ThumbnailBusy(url)
+        try:
+            # Hotlink-protected CDNs want a referer from their own site
+            parts = urlsplit(url)
+            response = fetcher.direct_get(url, headers={"Referer": f"{parts.scheme}://{parts.netloc}/", "Accept": "image/webp,image/*"},
+                                          timeout=THUMB_FETCH_TIMEOUT)
+        finally:
+            thumb_fetch_slots.release()
+        if response.status_code != 200:
+            raise LookupError(f"{url}: {response.status_code}")
+        return response.content, response.headers.get("Content-Type")
+
+    try:
+        path, mime, name = thumbnail_cache.get(image_id, fetch)
+    except LookupError:
+        return "Image introuvable", 404
+    except ThumbnailBusy as e:
+        # Not cached: the next page load asks the proxy again
+        response = redirect(e.args[0])
+        response.headers["Cache-Control"] = "no-store"
+        return response
+    except fetcher.FetchError as e:
+        print(f"Image fetch error for {image_id}: {e}")
+        return "Image indisponible", 502
+
+    response = _not_modified(name) or send_file(path, mimetype=mime, etag=name, conditional=False)
+    response.headers["Cache-Control"] = f"public, max-age={THUMB_MAX_AGE}, immutable"
+    return response
+
+@app.route('/analytics')
+def market_analytics():
+    """Precomputed market figures per model and year, and the biggest price drops."""
+    version = analytics.get_version()
+    etag = f"analytics-{version}-{request.query_string.decode()}"
+    cached = _not_modified(etag)
+    if cached:
+        return cached
+    try:
+        model = request.args.get('model')
+        limit = max(min(int(request.args.get('limit', 50)), 500), 1)
+        payload = {
+            "version": version,
+            "models": analytics.models(model=model, year=_number_arg('year'), limit=limit),
+            "price_drops": analytics.price_drops(model=model, limit=min(limit, 20)),
+        }
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    response = jsonify(payload)
+    response.set_etag(etag)
+    return response
+
+@app.route('/analytics/history')
+def price_history():
+    """Price observations of one listing, oldest first."""
+    lien = request.args.get('lien')
+    if not lien:
+        return jsonify({"status": "error", "message": "Missing lien"}), 400
+    return jsonify({"lien": lien, "history": store.get_price_history(lien)})
+
+@app.route('/phone')
+def listing_phone():
+    """Phone number of a listing, looked up on the listing's site if needed."""
+    lien = request.args.get('lien')
+    if not lien:
+        return jsonify({"status": "error", "message": "Missing lien"}), 400
+    try:
+        telephone = scraper.resolve_phone(lien)
+    except fetcher.FetchError as e:
+        print(f"Phone lookup error for {lien}: {e}")
+        return jsonify({"status": "error", "message": "Numéro indisponible"}), 502
+    if telephone is None:
+        return jsonify({"status": "error", "message": "Unknown listing"}), 404
+    return jsonify({"lien": lien, "telephone": telephone})
 
 @app.route('/vapid-public-key')
 def get_public_key():
     return jsonify({"publicKey": VAPID_PUBLIC_KEY})
 
+@app.route('/push-stats')
+def push_stats():
+    dispatcher = get_push_dispatcher()
+    return jsonify({"last": dispatcher.last_stats if dispatcher else None})
+
 @app.route('/subscribe', methods=['POST'])
 def subscribe():
-    save_subscription(request.json)
+    sub = request.json or {}
+    if not sub.get('endpoint'):
+        return jsonify({"status": "error", "message": "Missing endpoint"}), 400
+    subscription_store.upsert(sub)
+    return jsonify({"status": "success"})
+
+@app.route('/searches', methods=['GET'])
+def list_searches():
+    endpoint = request.args.get('endpoint')
+    if not endpoint:
+        return jsonify({"status": "error", "message": "Missing endpoint"}), 400
+    return jsonify({"searches": search_store.list(endpoint)})
+
+@app.route('/searches', methods=['POST'])
+def add_search():
+    data = request.json or {}
+    try:
+        search = search_store.add(data.get('endpoint'), **{k: data.get(k) for k in searches.FIELDS})
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"status": "success", "search": search}), 201
+
+@app.route('/searches/<int:search_id>', methods=['DELETE'])
+def delete_search(search_id):
+    endpoint = request.args.get('endpoint') or (request.get_json(silent=True) or {}).get('endpoint')
+    if not search_store.delete(search_id, endpoint):
+        return jsonify({"status": "error", "message": "Unknown search"}), 404
     return jsonify({"status": "success"})
 
 @app.route('/download')
 def download():
-    if os.path.exists(last_csv_path):
-        return send_file(last_csv_path, as_attachment=True)
-    return "Aucun fichier disponible", 404
+    if store.count_listings() == 0:
+        return "Aucun fichier disponible", 404
+    buffer = io.StringIO()
+    with metrics.stage("csv_write", site="all"):
+        store.export_csv(buffer)
+    data = io.BytesIO(buffer.getvalue().encode('utf-8'))
+    return send_file(data, mimetype='text/csv', as_attachment=True, download_name=legacy_csv_path)
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,42 @@
+import hashlib
+import json
+import os
+
+# A fixture set is a directory of response bodies plus index.json mapping
+# "METHOD url" to the status, content type and body file of each response.
+INDEX_FILE = "index.json"
+
+def key(method, url):
+    return f"{method.upper()} {url}"
+
+class FixtureSet:
+    def __init__(self, directory):
+        self.directory = directory
+        self.index = {}
+        path = os.path.join(directory, INDEX_FILE)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.index = json.load(f)
+
+    def add(self, method, url, status, content_type, body):
+        name = hashlib.sha1(key(method, url).encode()).hexdigest() + ".body"
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, name), "wb") as f:
+            f.write(body)
+        self.index[key(method, url)] = {"status": status, "content_type": content_type, "file": name}
+
+    def get(self, method, url):
+        """Return (status, content_type, body) or None."""
+        entry = self.index.get(key(method, url))
+        if entry is None:
+            return None
+        with open(os.path.join(self.directory, entry["file"]), "rb") as f:
+            return entry["status"], entry["content_type"], f.read()
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, INDEX_FILE), "w", encoding="utf-8") as f:
+            json.dump(self.index, f, indent=1, sort_keys=True)
+
+    def __len__(self):
+        return len(self.index)
@@ -0,0 +1,55 @@
+"""Record the live sites into a fixture set for the offline benchmark.
+
+    python -m bench.record --out bench/fixtures/live --pages 2
+
+Runs every site pipeline of scraper.py once against the real sites and
+saves each response (listing and detail pages) it gets. Phone numbers are
+looked up on demand, not during the scrape, so none are recorded.
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+def main():
+    parser = argparse.ArgumentParser(description="Record listing and detail responses of every site")
+    parser.add_argument("--out", default=os.path.join("bench", "fixtures", "live"), help="Fixture directory to write")
+    parser.add_argument("--pages", type=int, default=2, help="Listing pages per site")
+    parser.add_argument("--ads", type=int, default=40, help="Ads per site")
+    parser.add_argument("--keyword", default="minibus")
+    parser.add_argument("--avito-url", default="https://www.avito.ma/fr/maroc/fourgon_et_minibus")
+    args = parser.parse_args()
+
+    # Every response must reach the recorder, and the real store stays untouched
+    os.environ["SCRAPER_CACHE"] = "0"
+    os.environ["LISTINGS_DB"] = os.path.join(tempfile.mkdtemp(prefix="bench-record-"), "listings.db")
+    os.environ["SCRAPER_MAX_PAGES"] = str(args.pages)
+    os.environ["SCRAPER_MAX_ADS"] = str(args.ads)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import fetcher
+    import scraper
+    from bench.fixtures import FixtureSet
+
+    fixtures = FixtureSet(args.out)
+    send = fetcher.request
+
+    def recording_request(method, url, **kwargs):
+        try:
+            response = send(method, url, **kwargs)
+        except fetcher.FetchError as e:
+            if e.response is not None:
+                fixtures.add(method, url, e.response.status_code, e.response.headers.get("Content-Type", ""), e.response.content)
+            raise
+        fixtures.add(method, url, response.status_code, response.headers.get("Content-Type", ""), response.content)
+        return response
+
+    fetcher.request = recording_request
+    try:
+        summary = scraper.run_full_scrape(args.keyword, args.avito_url)
+    finally:
+        fixtures.save()
+    print(f"Recorded {len(fixtures)} responses ({summary['count']} ads) into {args.out}")
+
+if __name__ == "__main__":
+    main()
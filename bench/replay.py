@@ -0,0 +1,101 @@
+"""Local HTTP stand-in for the scraped sites, serving a fixture set.
+
+    python -m bench.replay --fixtures bench/fixtures/live --latency 120 --error-rate 0.02
+
+Requests arrive as /<scheme>/<host><path> (see fetcher.REPLAY_URL). Each
+response is delayed by the latency plus jitter, and a share of them fail
+with 503 to exercise retries and backoff. Unknown urls get 404.
+"""
+import argparse
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bench.fixtures import FixtureSet
+
+class ReplayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, fixtures, port=0, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        super().__init__(("127.0.0.1", port), ReplayHandler)
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"served": 0, "errors": 0, "missing": 0, "bytes": 0}
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _original_url(self):
+        _, scheme, rest = self.path.split("/", 2)
+        return f"{scheme}://{rest}"
+
+    def _respond(self, method):
+        server = self.server
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        with server.lock:
+            delay = max(0.0, server.latency + server.random.uniform(-server.jitter, server.jitter))
+            fail = server.random.random() < server.error_rate
+        time.sleep(delay)
+
+        if fail:
+            server.count("errors")
+            status, content_type, body = 503, "text/plain", b"Injected error"
+        else:
+            found = server.fixtures.get(method, self._original_url())
+            if found is None:
+                server.count("missing")
+                status, content_type, body = 404, "text/plain", b"Not recorded"
+            else:
+                status, content_type, body = found
+                server.count("served")
+                server.count("bytes", len(body))
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type or "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._respond("GET")
+
+    def do_POST(self):
+        self._respond("POST")
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fixture set as the scraped sites")
+    parser.add_argument("--fixtures", required=True, help="Fixture directory")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0, help="Response delay in ms")
+    parser.add_argument("--jitter", type=float, default=0, help="Random +/- delay in ms")
+    parser.add_argument("--error-rate", type=float, default=0, help="Share of requests answered with 503")
+    args = parser.parse_args()
+
+    server = ReplayServer(FixtureSet(args.fixtures), args.port, args.latency / 1000, args.jitter / 1000, args.error_rate)
+    print(f"Replaying {len(server.fixtures)} responses on {server.url} (set SCRAPER_REPLAY_URL={server.url})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(server.stats)
+
+if __name__ == "__main__":
+    main()
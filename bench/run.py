@@ -0,0 +1,207 @@
+"""Offline scraper benchmark.
+
+    python -m bench.run                                   # synthetic fixtures
+    python -m bench.run --fixtures bench/fixtures/live --latency 150 --error-rate 0.02
+    python -m bench.run --out after.json --baseline before.json
+
+Replays a fixture set through bench.replay in a separate process and runs
+scraper.run_full_scrape against it, reporting end-to-end wall time,
+pages/sec, parse ms per page and the scraper's peak RSS. No network is
+needed. With --baseline, each metric is compared to an earlier report.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Metrics compared against a baseline, and whether higher is better
+METRICS = {
+    "wall_seconds": False,
+    "pages_per_sec": True,
+    "parse_ms_per_page": False,
+    "peak_rss_mb": False,
+}
+
+def _serve(fixtures_dir, synthetic, latency, jitter, error_rate, seed, conn):
+    sys.path.insert(0, ROOT)
+    from bench import synth
+    from bench.fixtures import FixtureSet
+    from bench.replay import ReplayServer
+
+    if synthetic:
+        pages, ads = synthetic
+        fixtures = synth.build(fixtures_dir, pages=pages, ads=ads, seed=seed)
+    else:
+        fixtures = FixtureSet(fixtures_dir)
+    server = ReplayServer(fixtures, latency=latency, jitter=jitter, error_rate=error_rate, seed=seed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    conn.send((server.url, len(fixtures)))
+    while conn.recv() != "stop":
+        conn.send(dict(server.stats))
+    conn.send(dict(server.stats))
+    server.shutdown()
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+class Instruments:
+    """Counts responses and times (in thread CPU time) the parsing helpers of the scraper."""
+
+    def __init__(self, fetcher, parsing):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+        send = fetcher.request
+
+        def counted_request(method, url, **kwargs):
+            response = send(method, url, **kwargs)
+            with self.lock:
+                self.pages += 1
+            return response
+
+        fetcher.request = counted_request
+        for name in ("make_soup", "extract_next_data"):
+            setattr(parsing, name, self._timed(getattr(parsing, name)))
+
+    def reset(self):
+        self.pages = 0
+        self.parsed = 0
+        self.parse_seconds = 0.0
+
+    def _timed(self, fn):
+        def timed(*args, **kwargs):
+            # extract_next_data may call make_soup; only the outer call counts
+            if getattr(self.local, "depth", 0):
+                return fn(*args, **kwargs)
+            self.local.depth = 1
+            # CPU time of this thread, so waiting on the GIL does not count
+            started = time.thread_time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.thread_time() - started
+                self.local.depth = 0
+                with self.lock:
+                    self.parsed += 1
+                    self.parse_seconds += elapsed
+        return timed
+
+def compare(report, baseline):
+    print(f"{'metric':<20}{'baseline':>12}{'now':>12}{'change':>10}")
+    for metric, higher_is_better in METRICS.items():
+        before, now = baseline.get(metric), report.get(metric)
+        if not before or now is None:
+            continue
+        change = (now - before) / before * 100
+        better = change > 0 if higher_is_better else change < 0
+        print(f"{metric:<20}{before:>12}{now:>12}{change:>+9.1f}%{'' if abs(change) < 1 else (' better' if better else ' worse')}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the scraper against replayed sites")
+    parser.add_argument("--fixtures", help="Recorded fixture directory (default: build a synthetic one)")
+    parser.add_argument("--pages", type=int, default=3, help="Synthetic listing pages per site")
+    parser.add_argument("--ads", type=int, default=20, help="Synthetic ads per listing page")
+    parser.add_argument("--latency", type=float, default=50, help="Replay response delay in ms")
+    parser.add_argument("--jitter", type=float, default=20, help="Random +/- delay in ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 503")
+    parser.add_argument("--runs", type=int, default=3, help="Full scrapes to run; the median is reported")
+    parser.add_argument("--unthrottled", action="store_true", help="Lift the per-host rate limits of SITE_LIMITS")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keyword", default="minibus")
+    parser.add_argument("--avito-url", default="https://www.avito.ma/fr/maroc/fourgon_et_minibus")
+    parser.add_argument("--out", help="Write the report as JSON to this file")
+    parser.add_argument("--baseline", help="Earlier JSON report to compare against")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    fixtures_dir = args.fixtures or os.path.join(workdir, "fixtures")
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(
+        target=_serve,
+        args=(fixtures_dir, None if args.fixtures else (args.pages, args.ads),
+              args.latency / 1000, args.jitter / 1000, args.error_rate, args.seed, child),
+        daemon=True,
+    )
+    server.start()
+    replay_url, responses = parent.recv()
+
+    # Set before the scraper modules read them at import
+    os.environ["SCRAPER_CACHE"] = "0"
+    os.environ["SCRAPER_REPLAY_URL"] = replay_url
+    if not args.fixtures:
+        # One page past the last, so crawls end on an empty page as on the sites
+        os.environ["SCRAPER_MAX_PAGES"] = str(args.pages + 1)
+    os.environ["LISTINGS_DB"] = os.path.join(workdir, "listings.db")
+    sys.path.insert(0, ROOT)
+
+    import fetcher
+    import parsing
+    import scraper
+
+    if args.unthrottled:
+        for host in scraper.SITE_LIMITS:
+            fetcher.configure_host(host, rate=1000.0, max_rate=1000.0)
+    instruments = Instruments(fetcher, parsing)
+
+    print(f"Replaying {responses} responses from {replay_url}, {args.runs} runs")
+    walls, runs = [], []
+    for run in range(args.runs):
+        # Every run starts cold: empty store, fresh connections and rate limiters
+        scraper.store.DB_PATH = os.path.join(workdir, f"listings-{run}.db")
+        fetcher.reset_hosts()
+        instruments.reset()
+
+        started = time.perf_counter()
+        summary = scraper.run_full_scrape(args.keyword, args.avito_url)
+        wall = time.perf_counter() - started
+        walls.append(wall)
+        runs.append({
+            "wall_seconds": round(wall, 3),
+            "ads": summary["count"],
+            "requests": instruments.pages,
+            "pages_per_sec": round(instruments.pages / wall, 2),
+            "parse_ms_per_page": round(instruments.parse_seconds * 1000 / max(instruments.parsed, 1), 2),
+        })
+        print(f"run {run + 1}: {runs[-1]}")
+
+    parent.send("stop")
+    replay_stats = parent.recv()
+    server.join(timeout=5)
+
+    median = runs[walls.index(statistics.median_low(walls))]
+    report = {
+        **median,
+        "peak_rss_mb": peak_rss_mb(),
+        "runs": runs,
+        "replay": replay_stats,
+        "config": {
+            "fixtures": args.fixtures or f"synthetic {args.pages}x{args.ads}",
+            "latency_ms": args.latency,
+            "jitter_ms": args.jitter,
+            "error_rate": args.error_rate,
+            "unthrottled": args.unthrottled,
+            "parser": parsing.PARSER,
+            "python": platform.python_version(),
+        },
+    }
+    print(json.dumps({k: v for k, v in report.items() if k != "runs"}, indent=1))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=1)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            compare(report, json.load(f))
+
+if __name__ == "__main__":
+    main()
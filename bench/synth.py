@@ -0,0 +1,120 @@
+"""Build a synthetic fixture set shaped like the five sites.
+
+    python -m bench.synth --out /tmp/fixtures --pages 3 --ads 20
+
+For benchmarking without any recording: pages carry the markup each
+adapter in sites.py looks for, padded with boilerplate to a realistic
+size, and about a third of the vehicles are posted on several sites.
+"""
+import argparse
+import json
+import random
+from datetime import datetime
+
+from bench.fixtures import FixtureSet
+
+MODELS = [
+    "Toyota Hiace", "Mercedes Sprinter", "Renault Master", "Ford Transit", "Iveco Daily",
+    "Hyundai H1", "Fiat Ducato", "Volkswagen Crafter", "Peugeot Boxer", "Nissan Urvan",
+]
+
+def filler(kb, rng):
+    """Navigation-like boilerplate of roughly kb kilobytes."""
+    block = "".join(
+        f'<li class="nav-item"><a class="nav-link" href="/rubrique/{rng.randrange(10 ** 6)}">Rubrique {i}</a></li>'
+        for i in range(20)
+    )
+    return f'<div class="header"><ul>{block * max(1, kb * 1024 // len(block))}</ul></div>'
+
+def page(body, kb, rng, head=""):
+    return f"<!DOCTYPE html><html><head><title>Annonces</title>{head}</head><body>{filler(kb, rng)}{body}{filler(kb // 4, rng)}</body></html>".encode()
+
+def vehicles(count, rng):
+    return [
+        {
+            "model": f"{rng.choice(MODELS)} {rng.randint(2008, 2024)} {rng.choice(['15 places', '17 places', 'diesel', 'climatisé'])}",
+            "price": rng.randint(60, 450) * 1000,
+            "phone": f"06{rng.randrange(10 ** 8):08d}",
+        }
+        for _ in range(count)
+    ]
+
+def build(directory, pages=3, ads=20, kb=150, seed=1, keyword="minibus",
+          avito_url="https://www.avito.ma/fr/maroc/fourgon_et_minibus"):
+    # Imported here so the fetcher's env-driven setup only runs when building
+    from sites import with_page
+
+    rng = random.Random(seed)
+    fixtures = FixtureSet(directory)
+    today = datetime.now()
+    dmy = today.strftime("%d-%m-%Y")
+    pool = vehicles(pages * ads * 3, rng)
+    html = "text/html; charset=utf-8"
+
+    def pick():
+        # Cross-posted vehicles come from a shared pool
+        return rng.choice(pool) if rng.random() < 0.35 else vehicles(1, rng)[0]
+
+    n = 0
+    for p in range(1, pages + 1):
+        moteur, avito, mu, autoline, truck1 = [], [], [], [], []
+        for _ in range(ads):
+            n += 1
+            v = pick()
+            url = f"https://www.moteur.ma/fr/detail-annonce/{n}"
+            moteur.append(f'<div class="picture"><a href="/fr/detail-annonce/{n}"><img src="/photos/{n}.jpg"></a></div>')
+            fixtures.add("GET", url, 200, html, page(
+                f'<h1>{v["model"]}</h1><div class="price">{v["price"]:,} DH</div><p>Publié le {dmy}</p>'
+                f'<span data-token="t{n}" data-seller="{n}"></span>', kb, rng))
+            fixtures.add("GET", f"https://www.moteur.ma/fr/occasion/get_phone/{n}/?token=t{n}", 200,
+                         "application/json", json.dumps({"phone": v["phone"]}).encode())
+
+            v = pick()
+            avito.append({"href": f"/fr/casablanca/minibus/annonce_{n}.htm", "defaultImage": f"https://content.avito.ma/{n}.jpg"})
+            ad = {"price": {"value": v["price"]}, "subject": v["model"], "date": today.isoformat(timespec="seconds"),
+                  "seller": {"phone": {"number": v["phone"]}}, "defaultImage": f"https://content.avito.ma/{n}.jpg"}
+            fixtures.add("GET", f"https://www.avito.ma/fr/casablanca/minibus/annonce_{n}.htm", 200, html, page(
+                "", kb, rng, head=f'<script id="__NEXT_DATA__" type="application/json">{json.dumps({"props": {"pageProps": {"ad": ad}}})}</script>'))
+
+            v = pick()
+            mu.append(f'<div class="annonce-utilitaire"><a href="/annonce/{n}.html"><img src="/img/{n}.jpg"></a></div>')
+            fixtures.add("GET", f"https://www.maroc-utilitaires.com/annonce/{n}.html", 200, html, page(
+                f'<h1>{v["model"]}</h1><div class="price-tag">{v["price"]} DH</div><p>{today:%d/%m/%Y}</p>', kb, rng))
+
+            v = pick()
+            autoline.append(f'<div class="sl-item"><a class="sales-item-title-link" href="/-/vente/minibus--{n}">x</a><img data-src="https://img.linemedia.com/{n}.jpg"></div>')
+            fixtures.add("GET", f"https://autoline.co.ma/-/vente/minibus--{n}", 200, html, page(
+                f'<h1>{v["model"]}</h1><div class="price">{v["price"]:,} MAD{v["price"] // 9:,} $US</div>'.replace(",", " "), kb, rng))
+
+            v = pick()
+            truck1.append(f'<a href="/minibus/annonce-{n}.html">{v["model"]}</a>')
+            fixtures.add("GET", f"https://www.truck1.co.ma/minibus/annonce-{n}.html", 200, html, page(
+                f'<h1>{v["model"]}</h1><div class="price-value">{v["price"]} MAD</div><img class="main-image" src="/p/{n}.jpg">', kb, rng))
+
+        next_data = json.dumps({"props": {"pageProps": {"componentProps": {"ads": {"ads": avito}}}}})
+        listings = [
+            (with_page(f"https://www.moteur.ma/fr/occasion/voitures/recherche/?search=1&motcle={keyword}", "page", p), page("".join(moteur), kb, rng)),
+            (with_page(avito_url, "o", p), page("", kb, rng, head=f'<script id="__NEXT_DATA__" type="application/json">{next_data}</script>')),
+            (with_page("https://www.maroc-utilitaires.com/minibus/3-37-v115/minibus-occasion.html", "page", p), page("".join(mu), kb, rng)),
+            (with_page("https://autoline.co.ma/-/minibus--c5835", "page", p), page("".join(autoline), kb, rng)),
+            (with_page("https://www.truck1.co.ma/bus-et-autocars/minibus", "page", p), page("".join(truck1), kb, rng)),
+        ]
+        for url, body in listings:
+            fixtures.add("GET", url, 200, html, body)
+
+    fixtures.save()
+    return fixtures
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a synthetic fixture set")
+    parser.add_argument("--out", required=True, help="Fixture directory to write")
+    parser.add_argument("--pages", type=int, default=3, help="Listing pages per site")
+    parser.add_argument("--ads", type=int, default=20, help="Ads per listing page")
+    parser.add_argument("--kb", type=int, default=150, help="Boilerplate per page, in KB")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    fixtures = build(args.out, args.pages, args.ads, args.kb, args.seed)
+    print(f"Wrote {len(fixtures)} responses into {args.out}")
+
+if __name__ == "__main__":
+    main()
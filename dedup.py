@@ -0,0 +1,210 @@
+import hashlib
+import io
+import math
+import re
+import unicodedata
+import zlib
+from collections import defaultdict
+
+# Pillow is optional: without it images are simply not compared
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# MinHash signature length, split into LSH bands of BAND_ROWS rows. Two
+# titles with Jaccard similarity s share a band with probability
+# 1 - (1 - s^4)^8: ~0.96 at s=0.6, ~0.03 at s=0.2.
+MINHASH_PERM = 32
+BAND_ROWS = 4
+MINHASH_PRIME = (1 << 61) - 1
+
+# Pair decisions
+TITLE_THRESHOLD = 0.6        # estimated Jaccard of title shingles
+TITLE_THRESHOLD_STRONG = 0.3  # when the phone or the image also matches
+PRICE_TOLERANCE = 0.1         # relative difference of two known prices
+IMAGE_MAX_DISTANCE = 6        # Hamming distance of two 64-bit dHashes
+
+# Blocks bigger than this (a dealer's phone, a generic title) give no
+# useful candidates and would make the pass quadratic again
+MAX_BLOCK_SIZE = 50
+
+# Words that say nothing about which vehicle an ad is for
+STOPWORDS = {
+    "a", "au", "de", "des", "du", "en", "et", "la", "le", "les", "pour", "sur", "un", "une",
+    "vendre", "vente", "occasion", "minibus", "fourgon", "fourgonnette", "tourisme", "bus",
+    "autocar", "autocars", "mini", "transport", "personnes", "places",
+}
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+def _hash32(text):
+    return zlib.crc32(text.encode())
+
+# (a, b) of the universal hash functions h(x) = (a*x + b) mod p
+_PERMUTATIONS = [
+    (int.from_bytes(hashlib.sha1(f"a{i}".encode()).digest()[:8], "big") % MINHASH_PRIME or 1,
+     int.from_bytes(hashlib.sha1(f"b{i}".encode()).digest()[:8], "big") % MINHASH_PRIME)
+    for i in range(MINHASH_PERM)
+]
+
+def title_tokens(title):
+    """Lowercase, accent-free significant words of an ad title."""
+    text = unicodedata.normalize("NFKD", title or "").encode("ascii", "ignore").decode().lower()
+    return [t for t in TOKEN_RE.findall(text) if t not in STOPWORDS]
+
+def shingles(tokens):
+    # Words plus adjacent word pairs, so word order counts a little
+    return set(tokens) | {f"{a} {b}" for a, b in zip(tokens, tokens[1:])}
+
+def minhash(features):
+    if not features:
+        return None
+    hashed = [_hash32(f) for f in features]
+    return tuple(min((a * x + b) % MINHASH_PRIME for x in hashed) for a, b in _PERMUTATIONS)
+
+def similarity(sig_a, sig_b):
+    """Estimated Jaccard similarity of the sets behind two MinHash signatures."""
+    if sig_a is None or sig_b is None:
+        return 0.0
+    return sum(x == y for x, y in zip(sig_a, sig_b)) / MINHASH_PERM
+
+def model_key(tokens):
+    """Make and model, e.g. "toyota hiace": the first two significant words."""
+    return " ".join(tokens[:2])
+
+def price_bucket(price):
+    # ~10% wide buckets on a log scale
+    return int(math.log(price) / math.log(1 + PRICE_TOLERANCE)) if price and price > 0 else None
+
+def normalize_phone(phone):
+    digits = re.sub(r"\D", "", phone or "")
+    # 0612345678, +212612345678 and 00212612345678 are the same number
+    return digits[-9:] if len(digits) >= 9 else None
+
+def image_dhash(content):
+    """64-bit difference hash of an image as a hex string, or None without Pillow."""
+    if Image is None or not content:
+        return None
+    try:
+        img = Image.open(io.BytesIO(content)).convert("L").resize((9, 8))
+    except Exception as e:
+        print(f"Image hash error: {e}")
+        return None
+    pixels = list(img.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+def hamming(hash_a, hash_b):
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count("1")
+
+def prices_compatible(price_a, price_b):
+    if not price_a or not price_b:
+        return True
+    return abs(price_a - price_b) <= PRICE_TOLERANCE * max(price_a, price_b)
+
+class UnionFind:
+    def __init__(self, items):
+        self.parent = {item: item for item in items}
+
+    def find(self, item):
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[item] != root:
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            # The smaller key stays root so cluster roots do not depend on order
+            if root_b < root_a:
+                root_a, root_b = root_b, root_a
+            self.parent[root_b] = root_a
+
+def candidate_pairs(listings, signatures, tokens):
+    """Pairs of liens sharing a blocking key or an LSH band; never all pairs."""
+    blocks = defaultdict(list)
+    for ad in listings:
+        lien = ad["lien"]
+        key = model_key(tokens[lien])
+        bucket = price_bucket(ad.get("prix_num"))
+        if key and bucket is not None:
+            # Also file under the next bucket so prices either side of a boundary meet
+            blocks[("model", key, bucket)].append(lien)
+            blocks[("model", key, bucket + 1)].append(lien)
+        phone = normalize_phone(ad.get("telephone"))
+        if phone:
+            blocks[("phone", phone)].append(lien)
+        sig = signatures[lien]
+        if sig is not None:
+            for band in range(0, MINHASH_PERM, BAND_ROWS):
+                blocks[("lsh", band, sig[band:band + BAND_ROWS])].append(lien)
+
+    pairs = set()
+    for members in blocks.values():
+        if 1 < len(members) <= MAX_BLOCK_SIZE:
+            for i, a in enumerate(members):
+                for b in members[i + 1:]:
+                    if a != b:
+                        pairs.add((a, b) if a < b else (b, a))
+    return pairs
+
+def is_duplicate(a, b, sim, image_hash=None):
+    """Decide whether two listings ("lien", "site", "prix_num", "telephone") are one vehicle.
+
+    ``sim`` is their title similarity. The phone and the title settle most
+    pairs; ``image_hash(listing)`` returns a dHash or None and is only
+    called for the ambiguous rest, where the same photo confirms a match.
+    """
+    if not prices_compatible(a.get("prix_num"), b.get("prix_num")):
+        return False
+    if sim < TITLE_THRESHOLD_STRONG:
+        return False
+
+    same_phone = normalize_phone(a.get("telephone")) is not None and (
+        normalize_phone(a.get("telephone")) == normalize_phone(b.get("telephone"))
+    )
+    if a.get("site") != b.get("site") and (same_phone or sim >= TITLE_THRESHOLD):
+        return True
+    if same_phone and sim >= TITLE_THRESHOLD:
+        # One seller with several similar vans is common on a single site,
+        # so the phone alone does not settle a same-site pair
+        return True
+    # Weak titles and same-site reposts: only the same photo tells
+    hash_a = image_hash(a) if image_hash else None
+    hash_b = image_hash(b) if image_hash else None
+    return bool(hash_a and hash_b) and hamming(hash_a, hash_b) <= IMAGE_MAX_DISTANCE
+
+def cluster(listings, image_hash=None):
+    """Group listings of the same vehicle across sites.
+
+    ``listings`` are dicts with "lien", "site", "model", "prix_num" and
+    "telephone". Returns {lien: cluster root lien}. Candidates come from
+    blocking keys (make and model with price bucket, phone) and MinHash LSH
+    over the titles, so the cost grows with the number of candidate pairs
+    rather than with the square of the history.
+    """
+    listings = [ad for ad in listings if ad.get("lien")]
+    by_lien = {ad["lien"]: ad for ad in listings}
+    tokens = {lien: title_tokens(ad.get("model")) for lien, ad in by_lien.items()}
+    signatures = {lien: minhash(shingles(tokens[lien])) for lien in by_lien}
+
+    groups = UnionFind(by_lien)
+    pairs = candidate_pairs(by_lien.values(), signatures, tokens)
+    # Text first, so photos are only looked at for pairs it left apart
+    for hashes in (None, image_hash) if image_hash else (None,):
+        for a, b in pairs:
+            if groups.find(a) == groups.find(b):
+                continue
+            if is_duplicate(by_lien[a], by_lien[b], similarity(signatures[a], signatures[b]), hashes):
+                groups.union(a, b)
+    return {lien: groups.find(lien) for lien in by_lien}
+
+def cluster_id(root):
+    """Short stable id of a cluster from its root lien."""
+    return hashlib.sha1(root.encode()).hexdigest()[:12]
@@ -0,0 +1,91 @@
+import json
+import threading
+import time
+
+# Scrape progress for SSE clients is read from the jobs' event log in the
+# store (see jobs.JobManager), which every worker can see, so a client gets
+# the same stream whichever worker runs the job or serves the connection.
+# Within a worker one EventTail polls the log for all of its streams.
+
+class EventTail:
+    """Poll an event log once for every stream of the process.
+
+    ``read(after)`` returns the events ({"id", ...}) with an id above
+    ``after``, oldest first. While any stream waits, one thread reads the
+    log every ``interval`` seconds and keeps the latest ``buffer`` events in
+    memory; streams further behind than that read the log themselves.
+    """
+
+    def __init__(self, read, interval=1.0, buffer=1000):
+        self.read = read
+        self.interval = interval
+        self.buffer = buffer
+        self.cond = threading.Condition()
+        self.events = []
+        # Every event with an id above ``since`` is in self.events
+        self.since = None
+        self.waiting = 0
+        self.polling = False
+
+    def wait(self, after, timeout):
+        """Events with an id above ``after``, waiting up to ``timeout`` seconds
+        for the first one; [] when none came."""
+        deadline = time.monotonic() + timeout
+        checked = None
+        while True:
+            with self.cond:
+                self._start(after)
+                # Ids only grow, so once the log had nothing between ``after``
+                # and ``since`` the buffer holds everything that can follow
+                if after >= self.since or checked == self.since:
+                    self.waiting += 1
+                    try:
+                        while True:
+                            events = [event for event in self.events if event["id"] > after]
+                            remaining = deadline - time.monotonic()
+                            if events or remaining <= 0:
+                                return events
+                            self.cond.wait(remaining)
+                    finally:
+                        self.waiting -= 1
+                since = self.since
+            events = self.read(after)
+            if events:
+                return events
+            checked = since
+
+    def _start(self, after):
+        # Called with the lock held; a poller that stopped left a stale buffer
+        if not self.polling:
+            self.polling = True
+            self.events, self.since = [], after
+            threading.Thread(target=self._poll, args=(after,), name="event-tail", daemon=True).start()
+
+    def _poll(self, last):
+        idle = 0
+        while True:
+            try:
+                events = self.read(last)
+            except Exception as e:
+                print(f"Event log error: {e}")
+                events = []
+            with self.cond:
+                if events:
+                    last = events[-1]["id"]
+                    self.events.extend(events)
+                    if len(self.events) > self.buffer:
+                        dropped = len(self.events) - self.buffer
+                        self.since = self.events[dropped - 1]["id"]
+                        del self.events[:dropped]
+                    self.cond.notify_all()
+                # Stop after a few rounds without anyone waiting
+                idle = 0 if self.waiting else idle + 1
+                if idle > 3:
+                    self.polling = False
+                    return
+            time.sleep(self.interval)
+
+def format_sse(event_id, event, data):
+    """Format one SSE message; an event_id of None leaves the client's Last-Event-ID alone."""
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data)}\n\n"
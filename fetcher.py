@@ -0,0 +1,505 @@
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+import metrics
+
+# urllib3 only decodes brotli bodies when the brotli package is installed,
+# so only advertise "br" when we can actually read it.
+try:
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.1234.56 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'fr,fr-FR;q=0.9,en;q=0.8',
+    'Accept-Encoding': ACCEPT_ENCODING,
+    'Connection': 'keep-alive',
+}
+
+# (connect, read) timeout applied to every call that does not pass its own
+DEFAULT_TIMEOUT = (
+    float(os.environ.get("SCRAPER_CONNECT_TIMEOUT", 5)),
+    float(os.environ.get("SCRAPER_READ_TIMEOUT", 10)),
+)
+
+# Send every request to this origin instead, as <origin>/<scheme>/<host><path>.
+# The offline benchmark (bench/) points it at its replay server; sessions,
+# rate limits and the cache still work per original host and url.
+REPLAY_URL = os.environ.get("SCRAPER_REPLAY_URL", "").rstrip("/")
+
+# Keep-alive connections kept per host; raise it for hosts scraped with more workers
+DEFAULT_POOL_SIZE = int(os.environ.get("SCRAPER_POOL_SIZE", 4))
+POOL_SIZES = {}
+
+# On-disk cache for listing and detail pages. Entries younger than the TTL
+# are served without any request; older ones are revalidated with
+# If-None-Match / If-Modified-Since, so an unchanged page costs a 304.
+CACHE_DIR = os.environ.get("SCRAPER_CACHE_DIR", ".http_cache")
+CACHE_TTL = int(os.environ.get("SCRAPER_CACHE_TTL", 6 * 3600))
+CACHE_MAX_BYTES = int(os.environ.get("SCRAPER_CACHE_MAX_BYTES", 200 * 1024 * 1024))
+CACHE_ENABLED = os.environ.get("SCRAPER_CACHE", "1") != "0"
+
+# Requests per second a host starts at when nothing else is configured. The
+# rate then adapts: it grows slowly while responses are fast, shrinks when
+# they slow down past TARGET_LATENCY, and halves on 429/503.
+DEFAULT_RATE = float(os.environ.get("SCRAPER_DEFAULT_RATE", 1.0))
+TARGET_LATENCY = float(os.environ.get("SCRAPER_TARGET_LATENCY", 2.0))
+HOST_RATES = {}
+
+# Retries with jittered exponential backoff, for connection errors and these
+# statuses. Each host has a retry budget: every plain request earns
+# RETRY_BUDGET_RATIO of a retry, up to RETRY_BUDGET_MAX banked retries. A
+# Retry-After header pauses the host for at most BACKOFF_CAP seconds.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+THROTTLE_STATUSES = (429, 503)
+MAX_RETRIES = int(os.environ.get("SCRAPER_MAX_RETRIES", 3))
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+RETRY_BUDGET_RATIO = 0.2
+RETRY_BUDGET_MAX = 10.0
+
+# After this many failures in a row a host's circuit opens and requests fail
+# fast for BREAKER_COOLDOWN seconds, then a single trial request decides.
+BREAKER_THRESHOLD = int(os.environ.get("SCRAPER_BREAKER_THRESHOLD", 5))
+BREAKER_COOLDOWN = float(os.environ.get("SCRAPER_BREAKER_COOLDOWN", 60))
+
+class FetchError(requests.RequestException):
+    """A request that still failed after the retries allowed for its host."""
+
+class CircuitOpenError(FetchError):
+    pass
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_host_states = {}
+
+def host_of(url):
+    return urlsplit(url).netloc.lower()
+
+def replay_url(url):
+    """Where a request for url is actually sent (see REPLAY_URL)."""
+    if not REPLAY_URL:
+        return url
+    parts = urlsplit(url)
+    return f"{REPLAY_URL}/{parts.scheme}/{parts.netloc}{parts.path or '/'}" + (f"?{parts.query}" if parts.query else "")
+
+def configure_host(host, pool_size=None, rate=None, max_rate=None):
+    """Set a host's connection pool size and starting / maximum request rate.
+
+    Applies to sessions and rate limiters created afterwards.
+    """
+    if pool_size is not None:
+        POOL_SIZES[host] = pool_size
+    if rate is not None:
+        HOST_RATES[host] = (rate, max_rate or rate * 2)
+
+class HostState:
+    """Adaptive token bucket, retry budget and circuit breaker of one host."""
+
+    def __init__(self, host, rate, max_rate):
+        self.host = host
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.min_rate = rate / 10
+        self.max_rate = max_rate
+        self.step = rate / 10
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.retry_tokens = RETRY_BUDGET_MAX
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def allow(self):
+        """Raise CircuitOpenError while the circuit is open; returns True
+        when the caller's request is the trial that may close it."""
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            if time.monotonic() - self.opened_at < BREAKER_COOLDOWN or self.trial_running:
+                raise CircuitOpenError(f"Circuit open for {self.host}")
+            self.trial_running = True
+            return True
+
+    def end_trial(self):
+        """Let the next caller try again after a trial that ended without a verdict."""
+        with self.lock:
+            self.trial_running = False
+
+    def acquire(self):
+        """Block until the bucket has a token (and any Retry-After pause is over)."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if self.paused_until > now:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(1.0, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1.0:
+                        self.tokens -= 1.0
+                        return
+                    wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_response(self, status, latency, retry_after=None):
+        with self.lock:
+            if status in THROTTLE_STATUSES:
+                self.rate = max(self.min_rate, self.rate / 2)
+                if retry_after:
+                    # Capped, so a server asking for hours cannot block every caller of the host
+                    self.paused_until = max(self.paused_until, time.monotonic() + min(retry_after, BACKOFF_CAP))
+            elif latency > TARGET_LATENCY:
+                self.rate = max(self.min_rate, self.rate * 0.8)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.step)
+
+            if status in RETRY_STATUSES:
+                self._failure()
+            else:
+                self.failures = 0
+                self.opened_at = None
+                self.trial_running = False
+                self.retry_tokens = min(RETRY_BUDGET_MAX, self.retry_tokens + RETRY_BUDGET_RATIO)
+
+    def on_error(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._failure()
+
+    def _failure(self):
+        self.failures += 1
+        if self.trial_running or self.failures >= BREAKER_THRESHOLD:
+            if self.opened_at is None or self.trial_running:
+                print(f"Circuit opened for {self.host} after {self.failures} failures")
+            self.opened_at = time.monotonic()
+            self.trial_running = False
+
+    def take_retry(self):
+        with self.lock:
+            if self.retry_tokens >= 1.0:
+                self.retry_tokens -= 1.0
+                return True
+            return False
+
+def get_host_state(url):
+    host = host_of(url)
+    state = _host_states.get(host)
+    if state is None:
+        with _sessions_lock:
+            state = _host_states.get(host)
+            if state is None:
+                rate, max_rate = HOST_RATES.get(host, (DEFAULT_RATE, DEFAULT_RATE * 2))
+                state = _host_states[host] = HostState(host, rate, max_rate)
+    return state
+
+def _retry_after(response):
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def _backoff(attempt):
+    # Full jitter: anywhere between 0 and the exponential ceiling
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+def get_session(url):
+    host = host_of(url)
+    session = _sessions.get(host)
+    if session is not None:
+        return session
+
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            size = POOL_SIZES.get(host, DEFAULT_POOL_SIZE)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size, pool_block=True)
+            session = requests.Session()
+            session.headers.update(DEFAULT_HEADERS)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[host] = session
+    return session
+
+class HttpCache:
+    """Body files named by the url hash, plus a SQLite index holding the
+    validators, sizes and access times used for LRU eviction."""
+
+    # Response headers worth replaying on a cache hit
+    KEPT_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, "index.db"), check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                headers TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                stored_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_entries_accessed ON entries (accessed_at)")
+        self.db.commit()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def lookup(self, url):
+        """Return (headers, body, stored_at) for url, or None."""
+        key = hashlib.sha1(url.encode()).hexdigest()
+        with self.lock:
+            row = self.db.execute("SELECT headers, stored_at FROM entries WHERE key = ?", (key,)).fetchone()
+            if not row:
+                return None
+            try:
+                with open(self._path(key), "rb") as f:
+                    body = f.read()
+            except OSError:
+                self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.db.commit()
+                return None
+            self.db.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+        return json.loads(row[0]), body, row[1]
+
+    def store(self, url, response):
+        key = hashlib.sha1(url.encode()).hexdigest()
+        headers = {h: response.headers[h] for h in self.KEPT_HEADERS if h in response.headers}
+        body = response.content
+        now = time.time()
+        with self.lock:
+            tmp = self._path(key) + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(body)
+            os.replace(tmp, self._path(key))
+            self.db.execute(
+                "INSERT OR REPLACE INTO entries (key, url, headers, size, stored_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, url, json.dumps(headers), len(body), now, now),
+            )
+            self._evict()
+            self.db.commit()
+
+    def touch(self, url):
+        """Mark an entry as revalidated (after a 304)."""
+        key = hashlib.sha1(url.encode()).hexdigest()
+        now = time.time()
+        with self.lock:
+            self.db.execute("UPDATE entries SET stored_at = ?, accessed_at = ? WHERE key = ?", (now, now, key))
+            self.db.commit()
+
+    def _evict(self):
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.db.execute("SELECT key, size FROM entries ORDER BY accessed_at").fetchall():
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self):
+        with self.lock:
+            for (key,) in self.db.execute("SELECT key FROM entries").fetchall():
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+            self.db.execute("DELETE FROM entries")
+            self.db.commit()
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = HttpCache(CACHE_DIR, CACHE_MAX_BYTES)
+    return _cache
+
+def _cached_response(url, headers, body):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.headers = CaseInsensitiveDict(headers)
+    response._content = body
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response.from_cache = True
+    return response
+
+def cached_get(url, ttl=None, headers=None, **kwargs):
+    """GET through the on-disk cache.
+
+    Entries younger than ``ttl`` seconds (CACHE_TTL by default) are returned
+    without a request; ``ttl=0`` always revalidates.
+    """
+    if not CACHE_ENABLED:
+        return request("GET", url, headers=headers, **kwargs)
+
+    ttl = CACHE_TTL if ttl is None else ttl
+    cache = get_cache()
+    entry = cache.lookup(url)
+    if entry:
+        cached_headers, body, stored_at = entry
+        if time.time() - stored_at < ttl:
+            return _cached_response(url, cached_headers, body)
+        headers = dict(headers or {})
+        if "ETag" in cached_headers:
+            headers["If-None-Match"] = cached_headers["ETag"]
+        if "Last-Modified" in cached_headers:
+            headers["If-Modified-Since"] = cached_headers["Last-Modified"]
+
+    try:
+        response = request("GET", url, headers=headers, **kwargs)
+    except FetchError as e:
+        if not entry:
+            raise
+        # A stale copy beats no copy while the site is failing
+        print(f"Serving stale cache for {url}: {e}")
+        return _cached_response(url, entry[0], entry[1])
+    if response.status_code == 304 and entry:
+        cache.touch(url)
+        return _cached_response(url, entry[0], entry[1])
+    if response.status_code == 200:
+        cache.store(url, response)
+    response.from_cache = False
+    return response
+
+def request(method, url, headers=None, timeout=None, **kwargs):
+    """Send a request through the pooled session and rate limiter of the url's host.
+
+    ``headers`` are merged over DEFAULT_HEADERS, and DEFAULT_TIMEOUT is used
+    unless a timeout is given. Failed requests (connection errors, timeouts,
+    truncated or undecodable bodies) and RETRY_STATUSES are retried while
+    the host's retry budget allows; after that FetchError is raised, or
+    CircuitOpenError without any request while the host's circuit is open.
+    """
+    session = get_session(url)
+    state = get_host_state(url)
+    attempt = 0
+    while True:
+        trial = state.allow()
+        try:
+            state.acquire()
+            started = time.monotonic()
+            try:
+                response = session.request(method, replay_url(url), headers=headers, timeout=timeout or DEFAULT_TIMEOUT, **kwargs)
+            except requests.RequestException as e:
+                metrics.record_error(e)
+                metrics.HTTP_REQUESTS.inc(host=state.host, status="error")
+                state.on_error()
+                if attempt < MAX_RETRIES and state.take_retry():
+                    attempt += 1
+                    time.sleep(_backoff(attempt))
+                    continue
+                raise FetchError(f"{method} {url} failed: {e}") from e
+
+            if REPLAY_URL:
+                response.url = url
+            metrics.HTTP_REQUESTS.inc(host=state.host, status=str(response.status_code))
+            metrics.HTTP_BYTES.inc(len(response.content), host=state.host)
+            metrics.HTTP_SECONDS.observe(time.monotonic() - started, host=state.host)
+            retry_after = _retry_after(response)
+            state.on_response(response.status_code, time.monotonic() - started, retry_after)
+            if response.status_code not in RETRY_STATUSES:
+                return response
+            if attempt < MAX_RETRIES and state.take_retry():
+                attempt += 1
+                # A Retry-After pause is already enforced by the host's bucket
+                time.sleep(_backoff(attempt))
+                continue
+            raise FetchError(f"{method} {url} returned {response.status_code}", response=response)
+        finally:
+            if trial:
+                # Responses and errors already settled the trial; anything
+                # else (an interrupt, a bug) must not leave the host blocked
+                state.end_trial()
+
+def get(url, cache=False, ttl=None, **kwargs):
+    if cache:
+        return cached_get(url, ttl=ttl, **kwargs)
+    return request("GET", url, **kwargs)
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+_direct_session = None
+
+def direct_get(url, headers=None, timeout=None, **kwargs):
+    """One GET outside the host's rate limiter, retries and circuit breaker.
+
+    For requests someone is waiting on that must fail fast rather than queue
+    behind a scrape of the host (see app.listing_image). Uses a session of
+    its own that never blocks waiting for a pooled connection. Raises
+    FetchError when the request fails.
+    """
+    global _direct_session
+    if _direct_session is None:
+        with _sessions_lock:
+            if _direct_session is None:
+                session = requests.Session()
+                session.headers.update(DEFAULT_HEADERS)
+                _direct_session = session
+    host = host_of(url)
+    started = time.monotonic()
+    try:
+        response = _direct_session.get(replay_url(url), headers=headers, timeout=timeout or DEFAULT_TIMEOUT, **kwargs)
+    except requests.RequestException as e:
+        metrics.record_error(e)
+        metrics.HTTP_REQUESTS.inc(host=host, status="error")
+        raise FetchError(f"GET {url} failed: {e}") from e
+    if REPLAY_URL:
+        response.url = url
+    metrics.HTTP_REQUESTS.inc(host=host, status=str(response.status_code))
+    metrics.HTTP_BYTES.inc(len(response.content), host=host)
+    metrics.HTTP_SECONDS.observe(time.monotonic() - started, host=host)
+    return response
+
+def close_sessions():
+    global _direct_session
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+        if _direct_session is not None:
+            _direct_session.close()
+            _direct_session = None
+
+def reset_hosts():
+    """Close every session and forget the hosts' rate limiter and breaker state."""
+    close_sessions()
+    with _sessions_lock:
+        _host_states.clear()
@@ -0,0 +1,332 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+import store
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    dedupe_key TEXT,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    progress TEXT,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs (created_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_dedupe ON jobs (dedupe_key);
+CREATE TABLE IF NOT EXISTS job_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    event TEXT NOT NULL,
+    data TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_job_events_job ON job_events (job_id, id);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+FINISHED = ("succeeded", "failed", "cancelled")
+
+# Progress events are appended to the job's event log in batches, at most
+# once a second, except these which are written at once
+FLUSHED_EVENTS = ("done", "error")
+
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    """Handle passed to a running job function."""
+
+    def __init__(self, manager, job_id):
+        self.manager = manager
+        self.id = job_id
+        self._last_check = 0
+        self._cancelled = False
+        self._lock = threading.Lock()
+        self._pending = []
+        self._last_flush = 0
+
+    def should_stop(self):
+        # The flag lives in SQLite so any worker can cancel; read it at most once a second
+        now = time.monotonic()
+        if not self._cancelled and now - self._last_check >= 1:
+            self._last_check = now
+            self._cancelled = self.manager.cancel_requested(self.id)
+        return self._cancelled
+
+    def report(self, event, **data):
+        """Append a progress event to the job's event log (see FLUSHED_EVENTS)."""
+        with self._lock:
+            self._pending.append((event, data))
+            now = time.monotonic()
+            if event in FLUSHED_EVENTS or now - self._last_flush >= 1:
+                self._last_flush = now
+                self._flush()
+
+    def flush(self):
+        """Write the events still waiting for their batch."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        # Written under the lock, so events reach the log in the order they were reported
+        if self._pending:
+            self.manager.add_events(self.id, self._pending)
+            self._pending = []
+
+class JobManager:
+    """Single-flight background jobs shared by every process using the store.
+
+    A job runs only while its process holds the lease of the job kind in
+    SQLite, so gunicorn workers (and their schedulers) never run the same
+    kind of job twice at once. The lease is renewed while the job runs and
+    expires if the process dies, after which the job is reported as failed.
+
+    Every job has an append-only event log: "started", the progress events
+    its function reports, then "finished" with its outcome. Event ids grow
+    across jobs, so a client can resume the log after the last id it saw.
+    """
+
+    def __init__(self, path=None, lease_ttl=60, history=50):
+        self.path = path
+        self.lease_ttl = lease_ttl
+        self.history = history
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        with store.transaction(self.path) as conn:
+            conn.executescript(SCHEMA)
+
+    # Leases
+
+    # A lease is held by a job id, so two jobs of one process exclude each other too
+
+    def _acquire(self, conn, name, holder):
+        now = time.time()
+        conn.execute(
+            """
+            INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE leases.expires_at < ?
+            """,
+            (name, holder, now + self.lease_ttl, now),
+        )
+        row = conn.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()
+        return row["owner"] == holder
+
+    def _renew(self, name, holder, stop):
+        while not stop.wait(self.lease_ttl / 3):
+            try:
+                with store.transaction(self.path) as conn:
+                    conn.execute(
+                        "UPDATE leases SET expires_at = ? WHERE name = ? AND owner = ?",
+                        (time.time() + self.lease_ttl, name, holder),
+                    )
+            except Exception as e:
+                print(f"Lease renewal error: {e}")
+
+    def _release(self, name, holder):
+        with store.transaction(self.path) as conn:
+            conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, holder))
+
+    # Jobs
+
+    def submit(self, kind, fn, dedupe_key=None, **params):
+        """Start fn(job, **params) in a thread unless a job of this kind is running.
+
+        Returns (job, started). When another job holds the lease, or a job
+        with the same dedupe_key already exists, that job is returned with
+        started=False.
+        """
+        job_id = uuid.uuid4().hex[:12]
+        now = time.time()
+        # Take the write lock up front so the checks and the insert are atomic
+        with store.transaction(self.path, immediate=True) as conn:
+            if dedupe_key:
+                row = conn.execute("SELECT id FROM jobs WHERE dedupe_key = ?", (dedupe_key,)).fetchone()
+                if row:
+                    return self._get(conn, row["id"]), False
+            if not self._acquire(conn, kind, job_id):
+                running = conn.execute(
+                    "SELECT id FROM jobs WHERE kind = ? AND status = 'running' ORDER BY created_at DESC LIMIT 1", (kind,)
+                ).fetchone()
+                return (self._get(conn, running["id"]) if running else None), False
+            conn.execute(
+                """
+                INSERT INTO jobs (id, kind, dedupe_key, params, status, owner, created_at, started_at)
+                VALUES (?, ?, ?, ?, 'running', ?, ?, ?)
+                """,
+                (job_id, kind, dedupe_key, json.dumps(params), self.owner, now, now),
+            )
+            self._add_events(conn, job_id, [("started", {})])
+            job = self._get(conn, job_id)
+
+        thread = threading.Thread(target=self._run, args=(kind, job_id, fn, params), name=f"job-{job_id}", daemon=True)
+        thread.start()
+        return job, True
+
+    def _run(self, kind, job_id, fn, params):
+        stop = threading.Event()
+        renewer = threading.Thread(target=self._renew, args=(kind, job_id, stop), daemon=True)
+        renewer.start()
+        job = Job(self, job_id)
+        status, result, error = "succeeded", None, None
+        try:
+            result = fn(job, **params)
+        except JobCancelled:
+            status = "cancelled"
+        except Exception as e:
+            print(f"Job {job_id} error: {e}")
+            status, error = "failed", str(e)
+        finally:
+            stop.set()
+            try:
+                job.flush()
+            except Exception as e:
+                print(f"Job events error: {e}")
+            with store.transaction(self.path) as conn:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, finished_at = ?, result = ?, error = ? WHERE id = ?",
+                    (status, time.time(), json.dumps(result), error, job_id),
+                )
+                self._add_events(conn, job_id, [("finished", {"status": status, "result": result, "error": error})])
+                self._prune(conn, kind)
+            self._release(kind, job_id)
+
+    def _prune(self, conn, kind):
+        # Per kind, so frequent background jobs do not push the scrapes out of the history
+        rows = conn.execute(
+            f"""
+            SELECT id FROM jobs WHERE kind = ? AND status IN ({",".join("?" * len(FINISHED))}) AND id NOT IN (
+                SELECT id FROM jobs WHERE kind = ? ORDER BY created_at DESC LIMIT ?
+            )
+            """,
+            (kind, *FINISHED, kind, self.history),
+        ).fetchall()
+        conn.executemany("DELETE FROM job_events WHERE job_id = ?", [(row["id"],) for row in rows])
+        conn.executemany("DELETE FROM jobs WHERE id = ?", [(row["id"],) for row in rows])
+
+    def _reap(self, conn):
+        # Running jobs whose lease is gone belong to a process that died
+        now = time.time()
+        lost = conn.execute(
+            """
+            SELECT id FROM jobs WHERE status = 'running' AND NOT EXISTS (
+                SELECT 1 FROM leases WHERE leases.name = jobs.kind AND leases.owner = jobs.id AND leases.expires_at >= ?
+            )
+            """,
+            (now,),
+        ).fetchall()
+        for row in lost:
+            conn.execute("UPDATE jobs SET status = 'failed', finished_at = ?, error = 'Worker lost' WHERE id = ?", (now, row["id"]))
+            self._add_events(conn, row["id"], [("finished", {"status": "failed", "result": None, "error": "Worker lost"})])
+
+    def _get(self, conn, job_id):
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if not row:
+            return None
+        job = dict(row)
+        for key in ("params", "progress", "result"):
+            job[key] = json.loads(job[key]) if job[key] else None
+        job["cancel_requested"] = bool(job["cancel_requested"])
+        return job
+
+    def get(self, job_id):
+        with store.transaction(self.path) as conn:
+            self._reap(conn)
+            return self._get(conn, job_id)
+
+    def list(self, limit=20, kind=None):
+        """The latest jobs, of one kind or of all."""
+        with store.transaction(self.path) as conn:
+            self._reap(conn)
+            if kind:
+                rows = conn.execute(
+                    "SELECT id FROM jobs WHERE kind = ? ORDER BY created_at DESC LIMIT ?", (kind, limit)
+                ).fetchall()
+            else:
+                rows = conn.execute("SELECT id FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+            return [self._get(conn, row["id"]) for row in rows]
+
+    def active(self, kind):
+        """The running job of this kind in any process, or None."""
+        with store.transaction(self.path) as conn:
+            self._reap(conn)
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE kind = ? AND status = 'running' ORDER BY created_at DESC LIMIT 1", (kind,)
+            ).fetchone()
+            return self._get(conn, row["id"]) if row else None
+
+    def cancel(self, job_id):
+        """Ask a running job to stop; returns False if it is not running."""
+        with store.transaction(self.path) as conn:
+            cur = conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (job_id,))
+            return cur.rowcount > 0
+
+    def cancel_requested(self, job_id):
+        with store.transaction(self.path) as conn:
+            row = conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            return bool(row and row["cancel_requested"])
+
+    # Event log
+
+    def _add_events(self, conn, job_id, events):
+        now = time.time()
+        conn.executemany(
+            "INSERT INTO job_events (job_id, event, data, created_at) VALUES (?, ?, ?, ?)",
+            [(job_id, event, json.dumps(data), now) for event, data in events],
+        )
+
+    def add_events(self, job_id, events):
+        """Append [(event, data)] to a job's log; the last one also becomes the
+        job's progress, without its "listing" (listings stay in the log)."""
+        event, data = events[-1]
+        progress = {"event": event, **{k: v for k, v in data.items() if k != "listing"}}
+        try:
+            with store.transaction(self.path) as conn:
+                self._add_events(conn, job_id, events)
+                conn.execute("UPDATE jobs SET progress = ? WHERE id = ?", (json.dumps(progress), job_id))
+        except Exception as e:
+            print(f"Job progress error: {e}")
+
+    def events(self, kind, after, limit=500):
+        """Events of this kind's jobs with an id above ``after``, oldest first:
+        [{"id", "job_id", "event", "data"}]."""
+        with store.transaction(self.path) as conn:
+            rows = conn.execute(
+                """
+                SELECT e.id, e.job_id, e.event, e.data FROM job_events e JOIN jobs j ON j.id = e.job_id
+                WHERE j.kind = ? AND e.id > ? ORDER BY e.id LIMIT ?
+                """,
+                (kind, after, limit),
+            ).fetchall()
+        return [{**dict(row), "data": json.loads(row["data"])} for row in rows]
+
+    def event_cursor(self, kind):
+        """Event id a new reader of this kind's log starts after: just before
+        the running job's first event, so it gets the whole job, or else the
+        last event."""
+        with store.transaction(self.path) as conn:
+            row = conn.execute(
+                """
+                SELECT MIN(e.id) - 1 FROM job_events e JOIN jobs j ON j.id = e.job_id
+                WHERE j.kind = ? AND j.status = 'running'
+                """,
+                (kind,),
+            ).fetchone()
+            if row[0] is None:
+                row = conn.execute("SELECT MAX(id) FROM job_events").fetchone()
+        return row[0] or 0
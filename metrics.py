@@ -0,0 +1,213 @@
+import bisect
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# In-process metrics in the Prometheus text format. Each process keeps its
+# own values: the Procfile runs a single gunicorn process with threads, so
+# /metrics sees every scrape and request. Jobs and their progress are shared
+# through the store, so more workers would still work, but each would then
+# report only its own share here.
+
+# Upper bounds (seconds) of the latency buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in items)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+def _format_value(value):
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {}
+        with _registry_lock:
+            _registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_format_labels(key)} {_format_value(value)}"]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[_label_key(labels)] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # Per-bucket counts (made cumulative when rendered), sum, count
+                state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render_value(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            lines.append(f"{self.name}_bucket{_format_labels(key, [('le', _format_value(bound))])} {cumulative}")
+        lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {count}")
+        lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(round(total, 6))}")
+        lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+def render():
+    """Every metric in the Prometheus text exposition format."""
+    with _registry_lock:
+        metrics = list(_registry)
+    return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+# Scrape pipeline
+
+STAGE_SECONDS = Histogram(
+    "scraper_stage_seconds",
+    "Time spent per site and stage (listing, detail, parse, phone, db_write, csv_write).",
+)
+ERRORS = Counter("scraper_errors_total", "Errors by site and exception type.")
+SITE_ADS = Gauge("scraper_site_ads", "Ads returned for each site by the last scrape.")
+RUNS = Counter("scraper_runs_total", "Full scrapes by outcome.")
+RUN_SECONDS = Histogram("scraper_run_seconds", "Duration of full scrapes.")
+LAST_RUN = Gauge("scraper_last_run_timestamp_seconds", "End of the last full scrape, by outcome.")
+LAST_RUN_ADS = Gauge("scraper_last_run_ads", "Ads found by the last full scrape.")
+COALESCED = Counter("scraper_coalesced_total", "Detail pages shared between the queries of a scrape instead of fetched again.")
+
+# Outgoing HTTP, by host
+
+HTTP_REQUESTS = Counter("scraper_http_requests_total", "Responses received from scraped hosts, by status.")
+HTTP_BYTES = Counter("scraper_http_response_bytes_total", "Response body bytes received from scraped hosts.")
+HTTP_SECONDS = Histogram("scraper_http_request_seconds", "Latency of requests to scraped hosts.")
+
+# Flask routes
+
+ROUTE_SECONDS = Histogram("app_request_seconds", "Latency of the app's routes, by route, method and status.")
+
+_context = threading.local()
+
+def current_site():
+    return getattr(_context, "site", None) or "none"
+
+@contextmanager
+def site(name):
+    """Label stage timings and errors of the current thread with a site."""
+    previous = getattr(_context, "site", None)
+    _context.site = name
+    try:
+        yield
+    finally:
+        _context.site = previous
+
+def stage(name, site=None):
+    """Context manager timing one stage of the current (or given) site."""
+    return STAGE_SECONDS.time(site=site or current_site(), stage=name)
+
+def record_error(error, site=None):
+    ERRORS.inc(site=site or current_site(), type=type(error).__name__)
+
+@contextmanager
+def profiled(path=None, top=30):
+    """Profile the enclosed code with cProfile, threads started inside included.
+
+    Writes the stats to ``path`` when given and prints the ``top`` functions
+    by cumulative time.
+    """
+    main = cProfile.Profile()
+    threads = []
+    lock = threading.Lock()
+    # From Python 3.12 a profiler sees every thread and no second one can
+    # start, so only older versions need one profiler per thread
+    per_thread = sys.version_info < (3, 12)
+
+    def start_thread_profile(frame, event, arg):
+        # Runs once in each new thread; the profiler then replaces this hook
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except Exception as e:
+            # Raising here would kill the thread: leave it unprofiled instead
+            print(f"Not profiling {threading.current_thread().name}: {e}")
+            return
+        with lock:
+            threads.append(profile)
+
+    if per_thread:
+        threading.setprofile(start_thread_profile)
+    main.enable()
+    try:
+        yield
+    finally:
+        main.disable()
+        if per_thread:
+            threading.setprofile(None)
+        stats = pstats.Stats(main)
+        with lock:
+            for profile in threads:
+                try:
+                    stats.add(profile)
+                except TypeError:
+                    # A thread that never ran any profiled code
+                    pass
+        if path:
+            stats.dump_stats(path)
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats("cumulative").print_stats(top)
+        print(out.getvalue())
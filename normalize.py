@@ -0,0 +1,213 @@
+import os
+import re
+from datetime import datetime, timedelta
+
+# Prices are compared in dirhams; foreign amounts are converted at these
+# rates (MAD per unit), overridable as SCRAPER_RATE_USD / SCRAPER_RATE_EUR.
+RATES_TO_MAD = {
+    "MAD": 1.0,
+    "USD": float(os.environ.get("SCRAPER_RATE_USD", 9.2)),
+    "EUR": float(os.environ.get("SCRAPER_RATE_EUR", 10.8)),
+}
+
+# Spellings of each currency as they appear on the sites
+CURRENCY_CODES = {
+    "MAD": "MAD", "DH": "MAD", "DHS": "MAD", "DIRHAM": "MAD", "DIRHAMS": "MAD",
+    "$US": "USD", "US$": "USD", "USD": "USD", "$": "USD",
+    "€": "EUR", "EUR": "EUR",
+}
+
+# Sites only show prices in Morocco; a bare number is in dirhams
+DEFAULT_CURRENCY = "MAD"
+
+_NUMBER = r"\d[\d\s  .,]*\d|\d"
+_CURRENCY = r"MAD|DHS?\b|DIRHAMS?|\$\s?US|US\$|USD|\$|€|EUR"
+# An amount with its currency after it ("124 200 MAD") or before it ("€ 11 450")
+PRICE_RE = re.compile(rf"(?P<num>{_NUMBER})\s*(?P<cur>{_CURRENCY})|(?P<cur2>{_CURRENCY})\s*(?P<num2>{_NUMBER})", re.I)
+BARE_NUMBER_RE = re.compile(_NUMBER)
+# A . or , followed by exactly three digits groups thousands ("1.200.000")
+THOUSANDS_SEP_RE = re.compile(r"[.,](?=\d{3}(?!\d))")
+SPACES_RE = re.compile(r"[\s  ]")
+NO_PRICE_RE = re.compile(r"demande|n/a|nous consulter", re.I)
+
+def _to_number(text):
+    text = SPACES_RE.sub("", text)
+    text = THOUSANDS_SEP_RE.sub("", text).replace(",", ".")
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+def normalize_price(price_str):
+    """Return (price in MAD or None, currency or None) for a scraped price string.
+
+    Strings quoting several currencies (Autoline's "124 200 MAD13 500 $US≈
+    11 450 €") use the dirham amount; otherwise the first amount is
+    converted with RATES_TO_MAD. "Sur demande" and the like give (None, None).
+    """
+    if not price_str or NO_PRICE_RE.search(price_str):
+        return None, None
+    amounts = []
+    for match in PRICE_RE.finditer(price_str):
+        number = _to_number(match.group("num") or match.group("num2"))
+        code = CURRENCY_CODES.get(SPACES_RE.sub("", match.group("cur") or match.group("cur2")).upper())
+        if number is not None and code:
+            amounts.append((code, number))
+    if not amounts:
+        match = BARE_NUMBER_RE.search(price_str)
+        number = _to_number(match.group(0)) if match else None
+        return (number, DEFAULT_CURRENCY) if number is not None else (None, None)
+    code, number = next((a for a in amounts if a[0] == "MAD"), amounts[0])
+    return number * RATES_TO_MAD[code], code
+
+def parse_price(price_str):
+    """Price in whole dirhams, 0 when unknown."""
+    price, _ = normalize_price(price_str)
+    return int(round(price)) if price is not None else 0
+
+def parse_date(date_str, now=None):
+    """Parse the date strings of the sites into a datetime, or None.
+
+    Relative dates ("Hier", "Il y a 3 jours", "Today") are taken relative
+    to ``now``, the time the ad was scraped, which defaults to the present.
+    """
+    if not date_str or date_str in ("Unknown", "N/A"):
+        return None
+
+    today = now or datetime.now()
+    date_str = str(date_str).lower().strip()
+
+    try:
+        # Handle "Aujourd'hui" / "Today"
+        if "aujourd'hui" in date_str or "today" in date_str:
+            return today
+
+        # Handle "Hier" / "Yesterday"
+        if "hier" in date_str or "yesterday" in date_str:
+            return today - timedelta(days=1)
+
+        # Handle "Il y a X jours"
+        match_jours = re.search(r'il y a (\d+) jours?', date_str)
+        if match_jours:
+            days = int(match_jours.group(1))
+            return today - timedelta(days=days)
+
+        # Handle "Il y a X heures" / "Il y a X minutes" (treat as today)
+        if "il y a" in date_str and ("heure" in date_str or "minute" in date_str):
+            return today
+
+        # Handle DD-MM-YYYY or DD/MM/YYYY
+        match_date = re.search(r'(\d{2})[-/](\d{2})[-/](\d{4})', date_str)
+        if match_date:
+            day, month, year = map(int, match_date.groups())
+            return datetime(year, month, day)
+
+        # Avito's listTime may be a Unix timestamp, in seconds or milliseconds
+        if date_str.isdigit() and len(date_str) >= 9:
+            stamp = int(date_str)
+            return datetime.fromtimestamp(stamp / 1000 if stamp > 10 ** 11 else stamp)
+
+        # ISO dates such as "2026-02-10 12:00:00" or "2026-02-10T12:00:00Z"
+        if len(date_str) >= 10:
+            try:
+                return datetime.fromisoformat(date_str[:19].replace("t", " "))
+            except ValueError:
+                return datetime.fromisoformat(date_str[:10])
+
+    except Exception as e:
+        print(f"Error parsing date {date_str}: {e}")
+
+    return None
+
+def normalize_listing(ad, now=None):
+    """Typed fields of one listing dict.
+
+    Returns {"prix_mad", "devise", "prix_original", "date_parsed"}; the
+    price is a float in MAD and the date a datetime, both None when unknown.
+    """
+    price, currency = normalize_price(ad.get("prix"))
+    return {
+        "prix_mad": price,
+        "devise": currency,
+        "prix_original": ad.get("prix"),
+        "date_parsed": parse_date(ad.get("date"), now),
+    }
+
+def sort_key(ad):
+    """Newest first then most expensive first, with reverse=True."""
+    normalized = normalize_listing(ad)
+    return (normalized["date_parsed"] or datetime.min, normalized["prix_mad"] or 0)
+
+def normalize_frame(df, now_column=None):
+    """Vectorized normalize_listing over a DataFrame with "prix" and "date" columns.
+
+    Adds prix_mad (float MAD, NaN when unknown), devise and date_parsed
+    (datetime64, NaT when unknown) columns to a copy of ``df``. Relative
+    dates are resolved against ``now_column`` (datetimes, e.g. when each ad
+    was first seen) or the present. Gives the same results as
+    normalize_listing, for re-normalizing the whole store at once.
+    """
+    import numpy as np
+    import pandas as pd
+
+    df = df.copy()
+    prix = df["prix"].fillna("").astype(str)
+
+    # Price: the dirham amount when quoted, else the first amount, else a bare number
+    extract = lambda pattern: prix.str.extract(pattern, flags=re.I)
+    matches = extract(PRICE_RE.pattern)
+    mad = extract(rf"(?P<num>{_NUMBER})\s*(?P<cur>MAD|DHS?\b|DIRHAMS?)|(?P<cur2>MAD|DHS?\b|DIRHAMS?)\s*(?P<num2>{_NUMBER})")
+    has_mad = mad["num"].notna() | mad["num2"].notna()
+    matches = matches.where(~has_mad, mad)
+    number = matches["num"].fillna(matches["num2"])
+    currency = matches["cur"].fillna(matches["cur2"]).str.replace(SPACES_RE.pattern, "", regex=True).str.upper().map(CURRENCY_CODES)
+    bare = prix.str.extract(f"({_NUMBER})", expand=False)
+    currency = currency.where(number.notna(), np.where(bare.notna(), DEFAULT_CURRENCY, None))
+    number = number.fillna(bare)
+
+    digits = (
+        number.str.replace(SPACES_RE.pattern, "", regex=True)
+        .str.replace(THOUSANDS_SEP_RE.pattern, "", regex=True)
+        .str.replace(",", ".", regex=False)
+    )
+    amount = pd.to_numeric(digits, errors="coerce")
+    no_price = prix.str.contains(NO_PRICE_RE.pattern, flags=re.I, regex=True) | (prix == "")
+    df["devise"] = currency.where(~no_price & amount.notna(), None)
+    df["prix_mad"] = (amount * df["devise"].map(RATES_TO_MAD)).where(df["devise"].notna())
+
+    # Dates, one rule of parse_date per np.select branch
+    date = df["date"].fillna("").astype(str).str.lower().str.strip()
+    if now_column is not None:
+        now = pd.to_datetime(df[now_column])
+    else:
+        now = pd.Series(pd.Timestamp.now(), index=df.index)
+    days_ago = pd.to_numeric(date.str.extract(r"il y a (\d+) jours?", expand=False), errors="coerce")
+    dmy = date.str.extract(r"(\d{2})[-/](\d{2})[-/](\d{4})")
+    dmy = pd.to_datetime(dmy[2] + "-" + dmy[1] + "-" + dmy[0], format="%Y-%m-%d", errors="coerce")
+    stamp = pd.to_numeric(date.where(date.str.fullmatch(r"\d{9,}")), errors="coerce")
+    stamp = pd.to_datetime(stamp.where(stamp <= 10 ** 11, stamp / 1000), unit="s", errors="coerce")
+    stamp = stamp.dt.tz_localize("UTC").dt.tz_convert(datetime.now().astimezone().tzinfo).dt.tz_localize(None)
+    iso = pd.to_datetime(date.str.slice(0, 19).str.replace("t", " ", regex=False), format="ISO8601", errors="coerce")
+    df["date_parsed"] = np.select(
+        [
+            date.str.contains("aujourd'hui|today", regex=True),
+            date.str.contains("hier|yesterday", regex=True),
+            days_ago.notna(),
+            date.str.contains("il y a", regex=False) & date.str.contains("heure|minute", regex=True),
+            dmy.notna(),
+            stamp.notna(),
+            iso.notna() & (date.str.len() >= 10),
+        ],
+        [
+            now,
+            now - pd.Timedelta(days=1),
+            now - pd.to_timedelta(days_ago, unit="D"),
+            now,
+            dmy,
+            stamp,
+            iso,
+        ],
+        default=pd.NaT,
+    )
+    df["date_parsed"] = pd.to_datetime(df["date_parsed"])
+    return df
@@ -0,0 +1,113 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from py_vapid import Vapid
+from pywebpush import WebPusher
+
+# Push services answer 404/410 for subscriptions that will never work again
+GONE_STATUSES = (404, 410)
+
+# Lifetime of a signed VAPID JWT; it is re-signed a minute before it expires
+VAPID_JWT_SECONDS = 12 * 60 * 60
+
+class PushDispatcher:
+    """Sends one Web Push message to many subscribers.
+
+    Sends run on a bounded worker pool over one pooled requests session, the
+    VAPID JWT is signed once per push service (audience) and reused until it
+    expires, and subscriptions the push service reports as gone are handed
+    to ``on_gone`` so the caller can prune them.
+    """
+
+    def __init__(self, private_key, email, max_workers=16, ttl=24 * 60 * 60, timeout=10):
+        if os.path.isfile(private_key):
+            self.vapid = Vapid.from_file(private_key_file=private_key)
+        else:
+            self.vapid = Vapid.from_string(private_key=private_key)
+        self.email = email
+        self.ttl = ttl
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.workers = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="push")
+        # Runs whole fan-outs in order so callers never wait on them
+        self.dispatcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="push-dispatch")
+        self.jwt_cache = {}
+        self.jwt_lock = threading.Lock()
+        self.last_stats = None
+
+    def _vapid_headers(self, endpoint):
+        url = urlparse(endpoint)
+        aud = f"{url.scheme}://{url.netloc}"
+        now = time.time()
+        with self.jwt_lock:
+            cached = self.jwt_cache.get(aud)
+            if cached and cached[1] - 60 > now:
+                return cached[0]
+            exp = int(now) + VAPID_JWT_SECONDS
+            headers = self.vapid.sign({"sub": self.email, "aud": aud, "exp": exp})
+            self.jwt_cache[aud] = (headers, exp)
+            return headers
+
+    def _send_one(self, sub, data):
+        """Return "sent", "gone" or "failed" for one subscription."""
+        try:
+            headers = dict(self._vapid_headers(sub["endpoint"]))
+            response = WebPusher(sub, requests_session=self.session).send(
+                data, headers, ttl=self.ttl, timeout=self.timeout
+            )
+        except Exception as e:
+            print(f"Notification error for {sub.get('endpoint')}: {e}")
+            return "failed"
+        if response.status_code in GONE_STATUSES:
+            return "gone"
+        if response.status_code > 202:
+            print(f"Notification error for {sub.get('endpoint')}: {response.status_code} {response.reason}")
+            return "failed"
+        return "sent"
+
+    def send(self, subscriptions, title, body, on_gone=None):
+        """Send to every subscription and block until done; returns delivery stats."""
+        return self.send_each([(sub, title, body) for sub in subscriptions], on_gone, label=title)
+
+    def send_each(self, messages, on_gone=None, label="targeted"):
+        """Send (subscription, title, body) messages and block until done; returns delivery stats."""
+        started = time.monotonic()
+        messages = list(messages)
+        outcomes = list(self.workers.map(
+            lambda m: self._send_one(m[0], json.dumps({"title": m[1], "body": m[2]})), messages
+        ))
+
+        gone = [sub["endpoint"] for (sub, _, _), outcome in zip(messages, outcomes) if outcome == "gone"]
+        if gone and on_gone:
+            try:
+                on_gone(gone)
+            except Exception as e:
+                print(f"Subscription pruning error: {e}")
+
+        stats = {
+            "subscribers": len(messages),
+            "sent": outcomes.count("sent"),
+            "failed": outcomes.count("failed"),
+            "pruned": len(gone),
+            "seconds": round(time.monotonic() - started, 3),
+        }
+        self.last_stats = stats
+        print(f"Push '{label}': {stats}")
+        return stats
+
+    def send_async(self, subscriptions, title, body, on_gone=None):
+        """Queue a fan-out in the background and return its Future."""
+        return self.dispatcher.submit(self.send, subscriptions, title, body, on_gone)
+
+    def send_each_async(self, messages, on_gone=None):
+        """Queue per-subscriber messages in the background and return its Future."""
+        return self.dispatcher.submit(self.send_each, messages, on_gone)
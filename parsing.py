@@ -0,0 +1,46 @@
+import json
+import re
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+import metrics
+
+# lxml builds the tree several times faster than html.parser; fall back to
+# the pure-Python parser when it is not installed.
+try:
+    import lxml  # noqa: F401
+    PARSER = "lxml"
+except ImportError:
+    PARSER = "html.parser"
+
+NEXT_DATA_RE = re.compile(rb'<script[^>]*\bid=["\']__NEXT_DATA__["\'][^>]*>(.*?)</script>', re.S)
+
+def make_soup(content, parse_only=None):
+    """Parse a page with the fastest available parser.
+
+    ``parse_only`` is a SoupStrainer: only matching tags (and their
+    children) are built, which skips most of a listing page.
+    """
+    with metrics.stage("parse"):
+        return BeautifulSoup(content, PARSER, parse_only=parse_only)
+
+def extract_next_data(content):
+    """Return the parsed __NEXT_DATA__ JSON of a Next.js page without building a DOM.
+
+    Falls back to BeautifulSoup when the script tag is not where the regex
+    expects it, and returns None when the page has no such script.
+    """
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    with metrics.stage("parse"):
+        match = NEXT_DATA_RE.search(content)
+        if match:
+            try:
+                return json.loads(match.group(1))
+            except ValueError:
+                pass
+    soup = make_soup(content, parse_only=SoupStrainer("script", id="__NEXT_DATA__"))
+    tag = soup.find("script", id="__NEXT_DATA__")
+    if tag and tag.string:
+        return json.loads(tag.string)
+    return None
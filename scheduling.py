@@ -0,0 +1,105 @@
+import os
+import time
+
+import metrics
+import scraper
+import sites
+import store
+
+# Adaptive crawl schedule. Each site is checked again about when it is
+# expected to have ADAPTIVE_TARGET_CHANGES new or changed ads, judging by
+# the change rate of its recent runs, but not more often than
+# ADAPTIVE_MIN_INTERVAL nor less often than ADAPTIVE_MAX_INTERVAL seconds.
+# When the expected requests of all sites exceed ADAPTIVE_DAILY_REQUESTS,
+# every interval is stretched to fit, and nothing runs once the requests of
+# the last 24 hours reach it.
+ADAPTIVE_TARGET_CHANGES = float(os.environ.get("SCRAPER_TARGET_CHANGES", 5))
+ADAPTIVE_MIN_INTERVAL = float(os.environ.get("SCRAPER_MIN_INTERVAL", 30 * 60))
+ADAPTIVE_MAX_INTERVAL = float(os.environ.get("SCRAPER_MAX_INTERVAL", 48 * 3600))
+ADAPTIVE_DAILY_REQUESTS = int(os.environ.get("SCRAPER_DAILY_REQUESTS", 5000))
+# Until runs say otherwise a site is assumed to reach the target in this
+# many seconds; the estimate moves away from it as history accumulates
+ADAPTIVE_PRIOR_INTERVAL = float(os.environ.get("SCRAPER_PRIOR_INTERVAL", 6 * 3600))
+
+# Recent runs a site's change rate and request cost are estimated from
+HISTORY_RUNS = 10
+DAY = 24 * 3600
+
+def change_rate(runs):
+    """Estimated new or changed ads per second from runs (oldest first).
+
+    The changes seen after the first run over the time they took, blended
+    with the prior so that a few quiet minutes do not read as a dead site.
+    """
+    runs = [run for run in runs if run["kind"] != "error"]
+    span = runs[-1]["finished_at"] - runs[0]["finished_at"] if runs else 0
+    # Changes of the first run happened before the measured span
+    changes = sum(run["new"] + run["changed"] for run in runs[1:])
+    return (changes + ADAPTIVE_TARGET_CHANGES) / (span + ADAPTIVE_PRIOR_INTERVAL)
+
+def interval_for(rate):
+    return min(max(ADAPTIVE_TARGET_CHANGES / rate, ADAPTIVE_MIN_INTERVAL), ADAPTIVE_MAX_INTERVAL)
+
+def plan(names=None, now=None):
+    """Schedule of the sites (all when None): {site: {"changes_per_hour",
+    "interval", "requests_per_run", "last_run", "due_at"}}."""
+    now = now or time.time()
+    names = [adapter.name for adapter in sites.select(names)]
+    history = store.site_runs(names, HISTORY_RUNS)
+    schedule = {}
+    for name in names:
+        runs = history.get(name, [])
+        rate = change_rate(runs)
+        schedule[name] = {
+            "changes_per_hour": round(rate * 3600, 3),
+            "interval": interval_for(rate),
+            # Probes and full crawls both count, in the mix they actually ran
+            "requests_per_run": sum(run["requests"] for run in runs) / len(runs) if runs else 1,
+            "last_run": runs[-1]["finished_at"] if runs else None,
+        }
+
+    expected = sum(DAY / entry["interval"] * entry["requests_per_run"] for entry in schedule.values())
+    stretch = max(1.0, expected / ADAPTIVE_DAILY_REQUESTS)
+    for entry in schedule.values():
+        entry["interval"] = round(entry["interval"] * stretch)
+        entry["due_at"] = entry["last_run"] + entry["interval"] if entry["last_run"] else now
+    return schedule
+
+def due_sites(now=None):
+    """Sites whose check is due, most overdue first; none once the last
+    24 hours used up the request budget."""
+    now = now or time.time()
+    if store.requests_since(now - DAY) >= ADAPTIVE_DAILY_REQUESTS:
+        return []
+    schedule = plan(now=now)
+    return sorted((name for name, entry in schedule.items() if entry["due_at"] <= now), key=lambda name: schedule[name]["due_at"])
+
+def tick(queries, crawl, now=None):
+    """Probe the due sites' first listing pages and call crawl(site_names)
+    with the ones that show new or changed ads; returns those sites.
+
+    Every probe is recorded as a run, so its requests count against
+    ADAPTIVE_DAILY_REQUESTS; one that finds nothing also makes quiet sites
+    drift towards longer intervals for the price of one request.
+    """
+    changed = []
+    for name in due_sites(now):
+        started_at = time.time()
+        try:
+            probe = scraper.probe_site(name, queries)
+        except Exception as e:
+            metrics.record_error(e, site=name)
+            print(f"{name} probe error: {e}")
+            # Wait a full interval before asking a failing site again
+            store.record_site_run(name, "error", started_at, requests=1)
+            continue
+        print(f"{name} probe: {probe['new']} new, {probe['changed']} changed of {probe['listed']} listed.")
+        if probe["new"] or probe["changed"]:
+            changed.append(name)
+            # The full crawl records these changes itself; the probe's requests still count
+            store.record_site_run(name, "probe", started_at, listed=probe["listed"], requests=probe["requests"])
+        else:
+            store.record_site_run(name, "probe", started_at, **probe)
+    if changed:
+        crawl(changed)
+    return changed
@@ -1,630 +1,554 @@
-import requests
-from bs4 import BeautifulSoup
-import json
-import csv
-import time
-import random
-import re
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import argparse
+import os
+import threading
+import time
 
-def get_ads_urls(keyword="minibus"):
-    url = f"https://www.moteur.ma/fr/occasion/voitures/recherche/?search=1&motcle={keyword}"
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.1234.56 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-        'Accept-Language': 'fr,fr-FR;q=0.9,en;q=0.8',
-    }
-    
-    print(f"Fetching Moteur.ma category: {url}")
-    try:
-        response = requests.get(url, headers=headers, timeout=10)
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
-        ads = []
-        # Try finding ads in picture containers first (best for images)
-        containers = soup.find_all('div', class_=re.compile(r'picture|item-annonce|content-inner-listing'))
-        for item in containers:
-            a = item.find('a', href=True)
-            if not a: continue
-            href = a['href']
-            if '/detail-annonce/' not in href: continue
-            
-            if not href.startswith('http'):
-                href = "https://www.moteur.ma" + href
-            
-            img = item.find('img')
-            image = ""
-            if img:
-                # Prioritize src but check data-src too
-                image = img.get('src') or img.get('data-src') or ""
-            
-            if image and not image.startswith('http'):
-                image = "https://www.moteur.ma" + image
-            
-            if not any(x[0] == href for x in ads):
-                ads.append((href, image))
-        
-        # Fallback to any ad links if containers failed
-        if not ads:
-            for a in soup.find_all('a', href=True):
-                href = a['href']
-                if '/detail-annonce/' in href:
-                    if not href.startswith('http'):
-                        href = "https://www.moteur.ma" + href
-                    
-                    if not any(x[0] == href for x in ads):
-                        img = a.find('img') or (a.find_parent() and a.find_parent().find('img'))
-                        image = img.get('src') if img else ""
-                        if image and not image.startswith('http'):
-                            image = "https://www.moteur.ma" + image
-                        ads.append((href, image))
-        
-        print(f"Found {len(ads)} unique ads on Moteur.ma.")
-        return ads[:10]
-    except Exception as e:
-        print(f"Moteur.ma Error: {e}")
-        return []
-
-def parse_date(date_str):
-    if not date_str or date_str == "Unknown":
+import analytics
+import fetcher
+import metrics
+import sites
+import store
+
+# Politeness settings per host, declared with each site in sites.py: how
+# many detail pages may be in flight at once, and the request rate (per
+# second) the host's adaptive limiter in fetcher starts at and may grow to.
+# "max_pages" overrides CRAWL_MAX_PAGES; a site declared with "max_pages": 1
+# does not paginate, so its one listing page is the whole listing.
+SITE_LIMITS = {adapter.host: adapter.limits for adapter in sites.SITES.values()}
+DEFAULT_SITE_LIMIT = {"workers": 1, "rate": 1.0, "max_rate": 2.0}
+
+# Crawl depth per site: listing pages followed, ads taken, and whether to
+# stop at the first listing page that holds only already-known ads.
+CRAWL_MAX_PAGES = int(os.environ.get("SCRAPER_MAX_PAGES", 5))
+CRAWL_MAX_ADS = int(os.environ.get("SCRAPER_MAX_ADS", 100))
+CRAWL_STOP_ON_KNOWN = os.environ.get("SCRAPER_STOP_ON_KNOWN", "1") != "0"
+
+# Crawls cut short by those limits cannot tell a sold ad from one further
+# down the listing, so ads not seen on their listing for LISTING_EXPIRY
+# seconds are marked gone instead (they come back if they show up again).
+# Once a listing has ads unseen for half that time, its crawls skip
+# CRAWL_STOP_ON_KNOWN and go as deep as the limits allow.
+LISTING_EXPIRY = float(os.environ.get("SCRAPER_LISTING_EXPIRY", 14 * 24 * 3600))
+
+# Incremental crawls only fetch the details of ads whose listing entry
+# changed, and most sites' listings do not show the price, so an accepted
+# ad is also fetched again once its details are DETAIL_REFRESH seconds old;
+# that is how their price changes reach the price history.
+DETAIL_REFRESH = float(os.environ.get("SCRAPER_DETAIL_REFRESH", 3 * 24 * 3600))
+
+# Listing parameters of a query, formatted into each site's listing_url
+DEFAULT_QUERY = {"keyword": "minibus", "avito_url": "https://www.avito.ma/fr/maroc/fourgon_et_minibus"}
+
+# Phone numbers are not fetched during the scrape: listings keep the
+# seller id and token, and the number is looked up when someone asks for it
+# (resolve_phone) or by a background batch. A seller's number is reused for
+# PHONE_TTL seconds.
+PHONE_TTL = int(os.environ.get("SCRAPER_PHONE_TTL", 7 * 24 * 3600))
+
+# Photos are not compared during the scrape either: listing pairs that only
+# a photo can settle get their photos hashed afterwards (store.hash_images),
+# this many per batch.
+IMAGE_HASH_BATCH = int(os.environ.get("SCRAPER_IMAGE_HASH_BATCH", 50))
+
+# One spare keep-alive connection per host for the listing and phone calls
+for _host, _limits in SITE_LIMITS.items():
+    fetcher.configure_host(_host, pool_size=_limits["workers"] + 1, rate=_limits["rate"], max_rate=_limits["max_rate"])
+
+class Coalescer:
+    """Run each keyed call once per scrape, however many callers ask for it.
+
+    Concurrent callers of a key wait for the first one's result and later
+    ones get it from memory. An error is raised to the callers waiting for
+    it, and the next caller tries again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = {}
+        self.pending = {}
+        self.hits = 0
+
+    def do(self, key, fn):
+        with self.lock:
+            if key in self.results:
+                self.hits += 1
+                return self.results[key]
+            pending = self.pending.get(key)
+            leader = pending is None
+            if leader:
+                pending = self.pending[key] = {"done": threading.Event()}
+            else:
+                self.hits += 1
+        if not leader:
+            pending["done"].wait()
+            if "error" in pending:
+                raise pending["error"]
+            return pending["result"]
+        try:
+            pending["result"] = fn()
+            with self.lock:
+                self.results[key] = pending["result"]
+            return pending["result"]
+        except Exception as e:
+            pending["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.pending[key]
+            pending["done"].set()
+
+def query_pipelines(queries, names=None, coalescer=None):
+    """Site pipelines for several queries: ({key: pipeline}, [keys of each query]).
+
+    A pipeline is (name, host, list_fn, detail_fn), keyed by its site and
+    listing url, so queries that list a site with the same url share one
+    pipeline. With a Coalescer, detail pages are shared between pipelines.
+    list_fn(page) returns the ads of one listing page.
+    """
+    pipelines = {}
+    query_keys = []
+    for query in queries:
+        keys = []
+        for adapter in sites.select(names):
+            key = (adapter.name, adapter.listing_url.format(**query))
+            if key not in pipelines:
+                detail_fn = partial(sites.get_details, adapter)
+                if coalescer is not None:
+                    detail_fn = partial(_coalesced_details, coalescer, detail_fn)
+                pipelines[key] = (adapter.name, adapter.host, partial(sites.list_entries, adapter, **query), detail_fn)
+            keys.append(key)
+        query_keys.append(keys)
+    return pipelines, query_keys
+
+def _coalesced_details(coalescer, detail_fn, url, image_from_list=""):
+    return coalescer.do(url, lambda: detail_fn(url, image_from_list=image_from_list))
+
+def site_pipelines(keyword="minibus", avito_url="https://www.avito.ma/fr/maroc/fourgon_et_minibus", names=None):
+    """Site pipelines of one query in the order results are merged (see query_pipelines)."""
+    pipelines, _ = query_pipelines([{"keyword": keyword, "avito_url": avito_url}], names)
+    return list(pipelines.values())
+
+def fetch_image(url):
+    """Bytes of an ad photo, or None when the host does not serve it."""
+    # Photos are hashed once, so caching them would only push pages out of the HTTP cache
+    response = fetcher.get(url)
+    return response.content if response.status_code == 200 else None
+
+def resolve_phone(lien):
+    """Phone number of a stored listing, or None for an unknown listing.
+
+    The seller's cached number is used while fresh; otherwise the site is
+    asked and the answer cached for every listing of the seller. Raises
+    fetcher.FetchError when the site cannot be reached.
+    """
+    ref = store.get_phone_ref(lien)
+    if ref is None:
         return None
-    
-    today = datetime.now()
-    date_str = date_str.lower().strip()
-    
+    adapter = sites.SITES.get(ref["site"])
+    if not ref["seller_id"] or adapter is None or adapter.phone is None:
+        return ref["telephone"] or "N/A"
+    cached = store.cached_phone(ref["site"], ref["seller_id"], PHONE_TTL)
+    if cached is not None:
+        return cached
+    with metrics.site(ref["site"]):
+        phone = sites.lookup_phone(adapter, ref["seller_id"], ref["phone_token"], referer=lien) or "N/A"
+    store.save_phone(ref["site"], ref["seller_id"], phone)
+    return phone
+
+def resolve_pending_phones(limit=20, should_stop=None):
+    """Look up the numbers of up to ``limit`` sellers of the newest listings
+    whose number is unknown or expired; returns how many were looked up."""
+    resolved = 0
+    for ref in store.pending_phones(limit, PHONE_TTL):
+        if should_stop is not None and should_stop():
+            break
+        try:
+            resolve_phone(ref["lien"])
+            resolved += 1
+        except Exception as e:
+            metrics.record_error(e, site=ref["site"])
+            print(f"Phone lookup error for {ref['lien']}: {e}")
+    return resolved
+
+class ScrapeCancelled(Exception):
+    pass
+
+def _check_stop(should_stop):
+    if should_stop is not None and should_stop():
+        raise ScrapeCancelled()
+
+def _emit(progress, event, **data):
+    if progress is None:
+        return
     try:
-        # Handle "Aujourd'hui"
-        if "aujourd'hui" in date_str:
-            return today
-        
-        # Handle "Hier"
-        if "hier" in date_str:
-            return today - timedelta(days=1)
-        
-        # Handle "Il y a X jours"
-        match_jours = re.search(r'il y a (\d+) jours', date_str)
-        if match_jours:
-            days = int(match_jours.group(1))
-            return today - timedelta(days=days)
-        
-        # Handle "Il y a X heures" / "Il y a X minutes" (treat as today)
-        if "il y a" in date_str and ("heures" in date_str or "minutes" in date_str):
-            return today
-
-        # Handle DD-MM-YYYY or DD/MM/YYYY
-        match_date = re.search(r'(\d{2})[-/](\d{2})[-/](\d{4})', date_str)
-        if match_date:
-            day, month, year = map(int, match_date.groups())
-            return datetime(year, month, day)
-
-        # Handle Avito listTime format (assuming it's a timestamp or ISO-like string if extracted from JSON)
-        # If it's a simple string like "2026-02-10 12:00:00"
-        if len(date_str) >= 10:
-            try:
-                return datetime.fromisoformat(date_str.split(' ')[0])
-            except:
-                pass
-
+        progress(event, **data)
     except Exception as e:
-        print(f"Error parsing date {date_str}: {e}")
-    
-    return None
-
-def is_within_4_weeks(date_val):
-    if date_val is None:
-        return True # Keep if unknown
-    
-    cutoff = datetime.now() - timedelta(weeks=4)
-    return date_val >= cutoff
-
-def get_ad_details(url, image_from_list=""):
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.1234.56 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-        'Accept-Language': 'fr,fr-FR;q=0.9,en;q=0.8',
-    }
-    try:
-        response = requests.get(url, headers=headers, timeout=10)
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
-        # Date parsing
-        date_pub_str = "Today"
-        date_elem = soup.find(string=re.compile(r'\d{2}-\d{2}-\d{4}'))
-        if date_elem:
-            date_pub_str = date_elem.strip()
-        
-        date_val = parse_date(date_pub_str)
-        if not is_within_4_weeks(date_val):
-            return None
-
-        model = "Utilitaire"
-        h1 = soup.find('h1')
-        if h1: model = h1.get_text(strip=True)
-        
-        price_tag = soup.find('div', class_=re.compile(r'price'))
-        price = price_tag.get_text(strip=True) if price_tag else "N/A"
-        
-        image_url = image_from_list
-        if not image_url:
-            image_tag = soup.find('img', class_=re.compile(r'fluid|detail'))
-            image_url = image_tag['src'] if image_tag and image_tag.get('src') else ""
-
-        contact_elem = soup.find(attrs={"data-token": True, "data-seller": True})
-        phone = "N/A"
-        if contact_elem:
+        print(f"Progress callback error: {e}")
+
+class ListingCrawl:
+    """Lazily walk a site's listing pages, yielding one page of entries at a time.
+
+    Stops after ``max_pages`` pages or ``max_ads`` ads, at an empty page or
+    one with nothing new, or (with ``stop_on_known``) at a page whose ads
+    are all known and unchanged. ``exhausted`` tells afterwards whether the
+    whole listing was seen, which is the only case where missing ads can be
+    marked gone; with ``single_page`` the site does not paginate and its
+    first page is the whole listing. ``completed`` tells whether the crawl
+    ran to one of its stops rather than failing or being abandoned.
+    ``pages`` counts the listing pages requested.
+    """
+
+    def __init__(self, name, list_fn, max_pages, max_ads, known_fn=None, stop_on_known=False, single_page=False):
+        self.name = name
+        self.list_fn = list_fn
+        self.max_pages = max_pages
+        self.max_ads = max_ads
+        self.known_fn = known_fn
+        self.stop_on_known = stop_on_known
+        self.single_page = single_page
+        self.exhausted = False
+        self.completed = False
+        self.seen = {}
+        self.pages = 0
+
+    def __iter__(self):
+        yield from self._walk()
+        self.completed = True
+
+    def _walk(self):
+        for page in range(1, self.max_pages + 1):
+            self.pages += 1
             try:
-                seller_id = contact_elem['data-seller']
-                token = contact_elem['data-token']
-                ajax_url = f"https://www.moteur.ma/fr/occasion/get_phone/{seller_id}/?token={token}"
-                phone_res = requests.get(ajax_url, headers={'X-Requested-With': 'XMLHttpRequest', 'User-Agent': headers['User-Agent']})
-                phone = phone_res.json().get('phone', "N/A")
-            except:
-                pass
-
-        return {
-            "model": model,
-            "prix": price,
-            "contact": "Vendeur (Moteur.ma)",
-            "lien": url,
-            "telephone": phone or "N/A",
-            "date": date_pub_str,
-            "image": image_url,
-            "site": "Moteur.ma"
-        }
-    except Exception as e:
-        print(f"Moteur.ma Detail Error for {url}: {e}")
-        return None
-
-def get_phone_ajax(ajax_url, seller_id, token, referer):
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.1234.56 Safari/537.36',
-        'X-Requested-With': 'XMLHttpRequest',
-        'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
-        'Referer': referer
-    }
-    data = {'seller': seller_id, 'token': token}
-    
-    try:
-        time.sleep(random.uniform(0.5, 1.5))
-        response = requests.post(ajax_url, headers=headers, data=data)
-        if response.status_code == 200 and response.text.strip():
-            return response.text.strip()
-    except Exception as e:
-        print(f"Error fetching phone: {e}")
-    return None
-
-def get_avito_ads(url):
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.1234.56 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-        'Accept-Language': 'fr,fr-FR;q=0.9,en;q=0.8',
-    }
-    print(f"Fetching Avito category: {url}")
-    try:
-        response = requests.get(url, headers=headers, timeout=10)
-        soup = BeautifulSoup(response.content, 'html.parser')
-        ads = []
-        next_data_tag = soup.find("script", id="__NEXT_DATA__")
-        if next_data_tag:
-            try:
-                data = json.loads(next_data_tag.string)
-                page_props = data.get('props', {}).get('pageProps', {})
-                
-                # New direct path to ads
-                ads_list = page_props.get("componentProps", {}).get("ads", {}).get("ads", [])
-                if not ads_list:
-                    ads_list = page_props.get("ads", {}).get("ads", [])
-                
-                # If that fails, try the older apolloState way as fallback
-                if not ads_list:
-                    apollo_state = data.get("props", {}).get("pageProps", {}).get("apolloState", {})
-                    for key, val in apollo_state.items():
-                        if isinstance(val, dict) and val.get("__typename") == "Ad":
-                            ad_url = val.get("url")
-                            if ad_url:
-                                if not ad_url.startswith('http'):
-                                    ad_url = "https://www.avito.ma" + ad_url
-                                image = ""
-                                images = val.get("images", [])
-                                if images:
-                                    img_ref = images[0]
-                                    if isinstance(img_ref, dict):
-                                        img_id = img_ref.get("id")
-                                        if img_id and img_id in apollo_state:
-                                            image = apollo_state[img_id].get("url") or apollo_state[img_id].get("uri")
-                                        else:
-                                            image = img_ref.get("url") or img_ref.get("uri")
-                                if not any(x[0] == ad_url for x in ads):
-                                    ads.append((ad_url, image))
-                else:
-                    for ad in ads_list:
-                        ad_url = ad.get("href")
-                        if not ad_url: continue
-                        if not ad_url.startswith('http'):
-                            ad_url = "https://www.avito.ma" + ad_url
-                        
-                        image = ad.get("defaultImage") or ""
-                        if not image and ad.get("images"):
-                            image = ad.get("images")[0]
-                        
-                        if not any(x[0] == ad_url for x in ads):
-                            ads.append((ad_url, image))
-            except Exception as e:
-                print(f"Error parsing Avito JSON: {e}")
-            
-        print(f"Found {len(ads)} unique Avito ads.")
-        return ads[:10]
-    except Exception as e:
-        print(f"Avito Error: {e}")
-        return []
-
-def get_avito_details(url, image_from_list=""):
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.1234.56 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-        'Accept-Language': 'fr,fr-FR;q=0.9,en;q=0.8',
-    }
+                with metrics.site(self.name), metrics.stage("listing"):
+                    listing = self.list_fn(page)
+            except fetcher.FetchError as e:
+                metrics.record_error(e, site=self.name)
+                print(f"{self.name} listing page {page} fetch failed: {e}")
+                raise
+
+            entries = []
+            for entry in listing:
+                # Listing functions return either (url, image[, price]) tuples or bare urls
+                url, img, price = (*entry, "", "")[:3] if isinstance(entry, tuple) else (entry, "", "")
+                if url not in self.seen and len(self.seen) < self.max_ads:
+                    self.seen[url] = store.fingerprint(url, img, price)
+                    entries.append((url, img))
+
+            if not entries:
+                # Past the last page, or a site that ignores the page parameter
+                self.exhausted = len(self.seen) < self.max_ads
+                return
+            known = self.known_fn([url for url, _ in entries]) if self.known_fn else {}
+            yield entries, known
+
+            if len(self.seen) >= self.max_ads:
+                return
+            if self.single_page:
+                self.exhausted = True
+                return
+            if self.stop_on_known and all(
+                url in known and known[url]["fingerprint"] == self.seen[url] for url, _ in entries
+            ):
+                return
+
+def iter_site(name, host, list_fn, detail_fn, concurrent=True, incremental=False, progress=None, should_stop=None,
+              max_pages=None, max_ads=None, listing=None, new_ads=None):
+    """Stream one site pipeline: listing pages feed the detail stage page by page.
+
+    Each page's details are written to the store as soon as they are parsed
+    and then yielded, in listing order. In incremental mode only ads that
+    are new or whose listing fingerprint changed get a detail fetch; the
+    others reuse their stored details. ``progress`` is called as
+    progress(event, **data) along the way, and ScrapeCancelled is raised as
+    soon as ``should_stop()`` returns True. ``listing`` is the listing url
+    the pipeline walks: ads are only judged by crawls of the listing they
+    were last seen on (see settle_gone). The urls of ads stored for the
+    first time are appended to ``new_ads`` when given. The counts of new and
+    changed ads and of requests are recorded as a site run for the adaptive
+    schedule (see scheduling.py).
+    """
+    _check_stop(should_stop)
+    started_at = time.time()
+    print(f"--- Starting {name} ---")
+    _emit(progress, "site_started", site=name)
+
+    limits = SITE_LIMITS.get(host, DEFAULT_SITE_LIMIT)
+    oldest_seen = store.oldest_seen(name, listing)
+    crawl = ListingCrawl(
+        name, list_fn,
+        max_pages=max_pages or limits.get("max_pages", CRAWL_MAX_PAGES),
+        max_ads=max_ads or CRAWL_MAX_ADS,
+        known_fn=lambda urls: store.get_known(name, urls),
+        stop_on_known=incremental and CRAWL_STOP_ON_KNOWN and not (
+            oldest_seen and oldest_seen < started_at - LISTING_EXPIRY / 2
+        ),
+        single_page=limits.get("max_pages") == 1,
+    )
+    failed = object()
+
+    def fetch(entry):
+        url, img = entry
+        _check_stop(should_stop)
+        try:
+            with metrics.site(name), metrics.stage("detail"):
+                details = detail_fn(url, image_from_list=img)
+        except fetcher.FetchError as e:
+            metrics.record_error(e, site=name)
+            print(f"{name} detail fetch failed for {url}: {e}")
+            _emit(progress, "error", site=name, lien=url, message=str(e))
+            return failed
+        _emit(progress, "detail", site=name, lien=url, listing=details)
+        return details
+
+    pool = None
+    if concurrent and limits["workers"] > 1:
+        pool = ThreadPoolExecutor(max_workers=limits["workers"], thread_name_prefix=f"scrape-{host}")
+    count = 0
+    stats = {"new": 0, "changed": 0, "fetched": 0}
     try:
-        response = requests.get(url, headers=headers, timeout=10)
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
-        # Try finding JSON data first
-        next_data_tag = soup.find("script", id="__NEXT_DATA__")
-        if next_data_tag:
+        for entries, known in crawl:
+            _check_stop(should_stop)
+            updated = [(url, img) for url, img in entries if url not in known or known[url]["fingerprint"] != crawl.seen[url]]
+            stats["new"] += sum(url not in known for url, _ in updated)
+            stats["changed"] += sum(url in known for url, _ in updated)
+            stale = {
+                url for url, _ in entries
+                if url in known and known[url]["data"] and (known[url]["fetched_at"] or 0) < started_at - DETAIL_REFRESH
+            }
+            due = stale.union(url for url, _ in updated)
+            to_fetch = [(url, img) for url, img in entries if url in due] if incremental else entries
+            stats["fetched"] += len(to_fetch)
+            if incremental:
+                print(f"{name}: {len(updated)} new or changed ads, {len(to_fetch) - len(updated)} due for a refresh, "
+                      f"{len(entries) - len(to_fetch)} already known.")
+            _emit(progress, "listing", site=name, count=len(entries), to_fetch=len(to_fetch))
+
+            results = pool.map(fetch, to_fetch) if pool else map(fetch, to_fetch)
+            # Failed fetches are left out, so the store keeps what it had for them
+            fetched = {url: details for (url, _), details in zip(to_fetch, results) if details is not failed}
             try:
-                data = json.loads(next_data_tag.string)
-                # Ad details are usually in props.pageProps.ad
-                ad_details = data.get("props", {}).get("pageProps", {}).get("ad", {})
-                if ad_details:
-                    prix = ad_details.get("price", {}).get("value")
-                    model = ad_details.get("subject", "N/A")
-                    date_str = ad_details.get("date", "N/A")
-                    phone_obj = ad_details.get("seller", {}).get("phone", {})
-                    telephone = phone_obj.get("number") if phone_obj else "N/A"
-                    image_url = ad_details.get("defaultImage") or (ad_details.get("images", [""])[0])
-                    
-                    return {
-                        "prix": f"{prix} DH" if prix else "N/A",
-                        "model": model,
-                        "date": date_str,
-                        "telephone": telephone or "N/A",
-                        "image": image_url or image_from_list,
-                        "lien": url,
-                        "site": "Avito.ma"
-                    }
-                
-                # Fallback to apolloState if that fails
-                apollo_state = data.get("props", {}).get("pageProps", {}).get("apolloState", {})
-                ad_info = None
-                for key, val in apollo_state.items():
-                    if key.startswith("Ad:"):
-                        ad_info = val
-                        break
-                
-                if ad_info:
-                    prix = ad_info.get("price", {}).get("amount")
-                    model = ad_info.get("subject", "N/A")
-                    date_str = ad_info.get("listTime", "N/A")
-                    return {
-                        "prix": f"{prix} DH" if prix else "N/A",
-                        "model": model,
-                        "date": date_str,
-                        "telephone": "N/A",
-                        "image": image_from_list,
-                        "lien": url,
-                        "site": "Avito.ma"
-                    }
+                with metrics.stage("db_write", site=name):
+                    store.record_site(name, {url: crawl.seen[url] for url, _ in entries}, fetched, complete=False,
+                                      listing=listing)
             except Exception as e:
-                print(f"Error parsing Avito detail JSON: {e}")
-
-        # Fallback to HTML selectors
-        prix_tag = soup.find('p', class_=re.compile(r'price|Price'))
-        prix = prix_tag.text.strip() if prix_tag else "N/A"
-        model_tag = soup.find('h1')
-        model = model_tag.text.strip() if model_tag else "N/A"
-        date_tag = soup.find('time') or soup.find('span', class_=re.compile(r'date|Date'))
-        date_str = date_tag.text.strip() if date_tag else "N/A"
-        
-        return {
-            "prix": prix,
-            "model": model,
-            "date": date_str,
-            "telephone": "N/A",
-            "image": image_from_list,
-            "lien": url,
-            "site": "Avito.ma"
-        }
-    except Exception as e:
-        print(f"Avito Detail Error for {url}: {e}")
-        return None
-
-def get_maroc_utilitaires_ads():
-    url = "https://www.maroc-utilitaires.com/minibus/3-37-v115/minibus-occasion.html"
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.1234.56 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-        'Accept-Language': 'fr,fr-FR;q=0.9,en;q=0.8',
-    }
-    print(f"Fetching Maroc-Utilitaires ads from: {url}")
+                metrics.record_error(e, site=name)
+                print(f"{name} store error: {e}")
+                _emit(progress, "error", site=name, message=f"Store error: {e}")
+            if new_ads is not None:
+                new_ads.extend(url for url, details in fetched.items() if details and url not in known)
+
+            for url, _ in entries:
+                if url in fetched:
+                    details = fetched[url]
+                else:
+                    details = known[url]["data"] if url in known else None
+                if details:
+                    count += 1
+                    yield details
+    except fetcher.FetchError as e:
+        # Nothing is marked gone: the stored listings stay as they were
+        _emit(progress, "error", site=name, message=str(e))
+    finally:
+        if pool:
+            pool.shutdown(wait=True)
+
+    settle_gone(name, crawl, listing)
     try:
-        response = requests.get(url, headers=headers, timeout=10)
-        soup = BeautifulSoup(response.content, 'html.parser')
-        ads = []
-        # In Maroc-Utilitaires, entries have class 'annonce-utilitaire'
-        for item in soup.select('div.annonce-utilitaire'):
-            a = item.find('a', href=True)
-            if not a: continue
-            ad_url = a['href']
-            if not ad_url.startswith('http'):
-                ad_url = "https://www.maroc-utilitaires.com" + ad_url
-            
-            img_tag = item.find('img')
-            img_url = ""
-            if img_tag:
-                img_url = img_tag.get('src') or img_tag.get('data-src') or img_tag.get('data-original') or ""
-            
-            if not any(x[0] == ad_url for x in ads):
-                ads.append((ad_url, img_url))
-        
-        print(f"Found {len(ads)} unique Maroc-Utilitaires ads.")
-        return ads[:10]
+        store.record_site_run(
+            name, "full", started_at, listed=len(crawl.seen), new=stats["new"], changed=stats["changed"],
+            requests=crawl.pages + stats["fetched"],
+        )
     except Exception as e:
-        print(f"Maroc-Utilitaires Ads Error: {e}")
-        return []
-
-def get_maroc_utilitaires_details(url, image_from_list=""):
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.1234.56 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-        'Accept-Language': 'fr,fr-FR;q=0.9,en;q=0.8',
-    }
+        metrics.record_error(e, site=name)
+        print(f"{name} store error: {e}")
+    metrics.SITE_ADS.set(count, site=name)
+    _emit(progress, "site_done", site=name, count=count)
+
+def settle_gone(name, crawl, listing=None):
+    """Mark gone the ads of a listing after a crawl of it: those missing from
+    it when the crawl saw all of it, else those not seen on it for
+    LISTING_EXPIRY when the crawl at least ran to its limits. Ads last seen
+    on another listing of the site (another query's) are left alone."""
+    if not crawl.completed:
+        return
     try:
-        response = requests.get(url, headers=headers)
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
-        date_tag = soup.find(string=re.compile(r'\d{2}/\d{2}/\d{4}'))
-        date_pub_str = date_tag.strip() if date_tag else "Unknown"
-        date_val = parse_date(date_pub_str)
-        if not is_within_4_weeks(date_val):
-            print(f"MU: {url} excluded by date ({date_pub_str})")
-            return None
-
-        model = soup.find('h1').get_text(strip=True) if soup.find('h1') else "Utilitaire"
-        price_tag = soup.find('div', class_='price-tag') or soup.find(string=re.compile(r'\d+ DH'))
-        price = price_tag.get_text(strip=True) if hasattr(price_tag, 'get_text') else "Sur demande"
-        
-        image = image_from_list
-        if not image:
-            img_tag = soup.find('img', class_='img-fluid')
-            image = img_tag['src'] if img_tag and img_tag.get('src') else ""
-        
-        return {
-            "model": model,
-            "prix": price,
-            "contact": "Vendeur (Maroc-Utilitaires)",
-            "lien": url,
-            "telephone": "Voir site",
-            "date": date_pub_str,
-            "image": image,
-            "site": "Maroc-Utilitaires"
-        }
+        with metrics.stage("db_write", site=name):
+            if crawl.exhausted:
+                store.mark_gone(name, crawl.seen, listing)
+            else:
+                store.expire_listings(name, time.time() - LISTING_EXPIRY, listing)
     except Exception as e:
-        print(f"MU Detail Error for {url}: {e}")
-        return None
-
-def get_autoline_ads():
-    url = "https://autoline.co.ma/-/minibus--c5835"
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.1234.56 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-        'Accept-Language': 'fr,fr-FR;q=0.9,en;q=0.8',
-    }
-    print(f"Fetching Autoline ads from: {url}")
-    try:
-        response = requests.get(url, headers=headers, timeout=10)
-        soup = BeautifulSoup(response.content, 'html.parser')
-        ads = []
-        # Autoline ads are in containers like 'div.sl-item'
-        for item in soup.select('div.sl-item'):
-            a = item.find('a', class_='sales-item-title-link', href=True)
-            if not a: continue
-            ad_url = a['href']
-            if not ad_url.startswith('http'):
-                ad_url = "https://autoline.co.ma" + ad_url
-            
-            img_tag = item.find('img')
-            image = ""
-            if img_tag:
-                image = img_tag.get('data-src') or img_tag.get('src') or ""
-            
-            if not any(x[0] == ad_url for x in ads):
-                ads.append((ad_url, image))
-
-        print(f"Found {len(ads)} unique Autoline ads.")
-        return ads[:10]
-    except Exception as e:
-        print(f"Autoline Ads Error: {e}")
-        return []
-
-def get_autoline_details(url, image_from_list=""):
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.1234.56 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-        'Accept-Language': 'fr,fr-FR;q=0.9,en;q=0.8',
+        metrics.record_error(e, site=name)
+        print(f"{name} store error: {e}")
+
+def probe_site(name, queries=(DEFAULT_QUERY,)):
+    """Fetch only the first listing page of a site for each query and count
+    its ads that are new or changed since they were stored.
+
+    Returns {"listed", "new", "changed", "requests"}; raises
+    fetcher.FetchError when a page cannot be fetched.
+    """
+    adapter = sites.SITES[name]
+    urls = {}
+    listings = {adapter.listing_url.format(**{**DEFAULT_QUERY, **query}): query for query in queries}
+    for query in listings.values():
+        with metrics.site(name), metrics.stage("probe"):
+            for url, img, price in sites.list_entries(adapter, 1, **{**DEFAULT_QUERY, **query}):
+                urls.setdefault(url, store.fingerprint(url, img, price))
+    known = store.get_known(name, list(urls))
+    return {
+        "listed": len(urls),
+        "new": sum(url not in known for url in urls),
+        "changed": sum(url in known and known[url]["fingerprint"] != fp for url, fp in urls.items()),
+        "requests": len(listings),
     }
-    try:
-        response = requests.get(url, headers=headers)
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
-        date_pub_str = "Today"
-        date_val = parse_date(date_pub_str)
-        if not is_within_4_weeks(date_val):
-            return None
-
-        model = soup.find('h1').get_text(strip=True) if soup.find('h1') else "Minibus"
-        price_tag = soup.find('div', class_='price') or soup.find('div', class_='item-price') or soup.find('div', class_='sl-item__price')
-        price = price_tag.get_text(strip=True) if price_tag else "Sur demande"
-        
-        image = image_from_list
-        if not image:
-            img = soup.find('img', class_='gallery__main-image') or soup.find('img', class_='main-image')
-            image = img['src'] if img and img.get('src') else ""
-        
-        return {
-            "model": model,
-            "prix": price,
-            "contact": "Autoline Seller",
-            "lien": url,
-            "telephone": "N/A",
-            "date": date_pub_str,
-            "image": image,
-            "site": "Autoline"
-        }
-    except Exception as e:
-        print(f"AL Detail Error for {url}: {e}")
-        return None
 
-def get_truck1_ads():
-    url = "https://www.truck1.co.ma/bus-et-autocars/minibus"
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.1234.56 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-        'Accept-Language': 'fr,fr-FR;q=0.9,en;q=0.8',
-    }
-    print(f"Searching Truck1: {url}")
+def run_full_scrape(keyword="minibus", avito_url="https://www.avito.ma/fr/maroc/fourgon_et_minibus", concurrent=True, incremental=False, progress=None, should_stop=None,
+                    site_names=None):
+    """Scrape every site for one query (see run_multi_scrape)."""
+    return run_multi_scrape(
+        [{"keyword": keyword, "avito_url": avito_url}], concurrent=concurrent, incremental=incremental,
+        progress=progress, should_stop=should_stop, site_names=site_names,
+    )
+
+def run_multi_scrape(queries, concurrent=True, incremental=False, progress=None, should_stop=None, site_names=None):
+    """Scrape every site for several queries at once and record the results
+    in the listings store.
+
+    Returns {"count", "queries", "new"}: the vehicles found, the vehicles
+    found by each query (in query order) and the urls of the ads stored for
+    the first time. Ads stream from the sites to the store and only their
+    urls are kept, so memory does not grow with the crawl; read the ads
+    themselves from the store.
+
+    A query is a dict of the listing parameters (keyword, avito_url). Sites
+    whose listing url does not depend on a parameter are crawled once for
+    all queries, and a detail page listed by several queries is fetched and
+    parsed once (see query_pipelines).
+
+    With ``concurrent`` the site pipelines run in parallel, each throttled by
+    its own entry in SITE_LIMITS, so the total time is that of the slowest site.
+    With ``incremental`` ads already in the listings store are only
+    re-fetched when they changed. ``progress`` receives site_started,
+    listing, detail, site_done, error and done events; ``should_stop`` is
+    polled between pages to cancel the run. ``site_names`` limits the run to
+    those sites of sites.SITES.
+    """
+    started = time.perf_counter()
+    status = "failed"
     try:
-        headers['Accept'] = 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8'
-        headers['Accept-Language'] = 'fr,fr-FR;q=0.8,en-US;q=0.5,en;q=0.3'
-        response = requests.get(url, headers=headers)
-        soup = BeautifulSoup(response.content, 'html.parser')
-        ads = []
-        for a in soup.find_all('a', href=True):
-            href = a['href']
-            if '/minibus/' in href and not href.endswith('/minibus'):
-                if not href.startswith('http'):
-                    if not href.startswith('/'): href = '/' + href
-                    href = "https://www.truck1.co.ma" + href
-                ads.append(href)
-        print(f"Truck1 found {len(ads)} candidates.")
-        return list(set(ads))[:10]
-    except Exception as e:
-        print(f"T1 Error: {e}")
-        return []
-
-def get_truck1_details(url):
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.1234.56 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-        'Accept-Language': 'fr,fr-FR;q=0.9,en;q=0.8',
-    }
-    try:
-        response = requests.get(url, headers=headers)
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
-        date_pub_str = "Today" 
-        date_val = parse_date(date_pub_str)
-        if not is_within_4_weeks(date_val):
-            return None
-
-        model = soup.find('h1').get_text(strip=True) if soup.find('h1') else "Truck1 Ad"
-        price_tag = soup.find('div', class_='price-value')
-        price = price_tag.get_text(strip=True) if price_tag else "Sur demande"
-        
-        img = soup.find('img', class_='main-image')
-        image = img['src'] if img and img.get('src') else ""
-        
+        queries = [{**DEFAULT_QUERY, **query} for query in queries]
+        coalescer = Coalescer()
+        pipelines, query_keys = query_pipelines(queries, site_names, coalescer)
+        run_id = store.start_run(", ".join(dict.fromkeys(q["keyword"] for q in queries)))
+        # Urls of the ads each pipeline found, and of those it stored for the first time
+        found = {key: set() for key in pipelines}
+        new_ads = {key: [] for key in pipelines}
+
+        def run(key, concurrent):
+            for ad in iter_site(*pipelines[key], concurrent=concurrent, incremental=incremental, progress=progress,
+                                should_stop=should_stop, listing=key[1], new_ads=new_ads[key]):
+                found[key].add(ad["lien"])
+
+        if concurrent:
+            with ThreadPoolExecutor(max_workers=len(pipelines), thread_name_prefix="scrape-site") as pool:
+                futures = {key: pool.submit(run, key, True) for key in pipelines}
+                for key, future in futures.items():
+                    name = key[0]
+                    try:
+                        future.result()
+                    except ScrapeCancelled:
+                        raise
+                    except Exception as e:
+                        metrics.record_error(e, site=name)
+                        print(f"{name} pipeline error: {e}")
+                        _emit(progress, "error", site=name, message=str(e))
+        else:
+            for key in pipelines:
+                run(key, False)
+
+        if coalescer.hits:
+            metrics.COALESCED.inc(coalescer.hits)
+            print(f"{coalescer.hits} detail pages shared between {len(queries)} queries.")
+
+        # The same vehicle posted on several sites is reported once
+        try:
+            clusters = store.refresh_clusters()
+        except Exception as e:
+            metrics.record_error(e, site="all")
+            print(f"Dedup error: {e}")
+            clusters = {}
+
+        # Market rollups of the listings this run touched
+        try:
+            with metrics.stage("analytics", site="all"):
+                analytics.refresh()
+        except Exception as e:
+            metrics.record_error(e, site="all")
+            print(f"Analytics error: {e}")
+
+        # Vehicles, so one posted on several sites counts once
+        vehicles = [{clusters.get(url, url) for key in keys for url in found[key]} for keys in query_keys]
+        total = len(set().union(*vehicles))
+        store.finish_run(run_id, total)
+        _emit(progress, "done", count=total)
+        metrics.LAST_RUN_ADS.set(total)
+        status = "succeeded"
         return {
-            "model": model,
-            "prix": price,
-            "contact": "Truck1 Seller",
-            "lien": url,
-            "telephone": "N/A",
-            "date": date_pub_str,
-            "image": image,
-            "site": "Truck1.co.ma"
+            "count": total,
+            "queries": [len(ids) for ids in vehicles],
+            "new": list(dict.fromkeys(url for urls in new_ads.values() for url in urls)),
         }
-    except Exception as e:
-        print(f"T1 Detail Error for {url}: {e}")
-        return None
-
-def parse_price(price_str):
-    if not price_str or "demande" in price_str.lower():
-        return 0
-    nums = re.findall(r'\d+', price_str.replace(' ', '').replace('\xa0', '').replace('\u202f', ''))
-    return int(nums[0]) if nums else 0
-
-def run_full_scrape(keyword="minibus", avito_url="https://www.avito.ma/fr/maroc/fourgon_et_minibus"):
-    ads_data = []
-    
-    print(f"--- Starting Moteur.ma ---")
-    m_urls = get_ads_urls(keyword)
-    for url in m_urls:
-        details = get_ad_details(url)
-        if details:
-            ads_data.append(details)
-            time.sleep(0.5)
-
-    print(f"--- Starting Avito ---")
-    a_urls = get_avito_ads(avito_url)
-    for url in a_urls:
-        details = get_avito_details(url)
-        if details:
-            ads_data.append(details)
-            time.sleep(0.5)
-
-    print(f"--- Starting Maroc-Utilitaires ---")
-    mu_data = get_maroc_utilitaires_ads() # Returns (url, img)
-    for url, img in mu_data:
-        details = get_maroc_utilitaires_details(url, image_from_list=img)
-        if details:
-            ads_data.append(details)
-            time.sleep(0.5)
-
-    print(f"--- Starting Autoline ---")
-    al_data = get_autoline_ads() # Returns (url, img)
-    for url, img in al_data:
-        details = get_autoline_details(url, image_from_list=img)
-        if details:
-            ads_data.append(details)
-            time.sleep(0.5)
-
-    print(f"--- Starting Truck1 ---")
-    t1_urls = get_truck1_ads()
-    for url in t1_urls:
-        details = get_truck1_details(url)
-        if details:
-            ads_data.append(details)
-            time.sleep(0.5)
-
-    try:
-        ads_data.sort(key=lambda x: (x.get('date', ''), parse_price(x.get('prix', ''))), reverse=True)
-    except:
-        pass
-
-    csv_file = "liste_annonces_v2.csv"
-    try:
-        with open(csv_file, mode='w', newline='', encoding='utf-8') as file:
-            fieldnames = ["site", "model", "prix", "contact", "lien", "telephone", "date", "image"]
-            writer = csv.DictWriter(file, fieldnames=fieldnames, delimiter=';')
-            writer.writeheader()
-            for ad in ads_data:
-                row = {k: ad.get(k, "") for k in fieldnames}
-                writer.writerow(row)
-    except Exception as e:
-        print(f"CSV Error: {e}")
-        
-    return ads_data, csv_file
+    except ScrapeCancelled:
+        status = "cancelled"
+        raise
+    finally:
+        metrics.RUNS.inc(status=status)
+        metrics.RUN_SECONDS.observe(time.perf_counter() - started)
+        metrics.LAST_RUN.set(time.time(), status=status)
 
 def main():
     parser = argparse.ArgumentParser(description="Scrape vehicle ads from various sites")
-    parser.add_argument("--keyword", default="minibus", help="Keyword for Moteur.ma search")
-    parser.add_argument("--avito-url", default="https://www.avito.ma/fr/maroc/fourgon_et_minibus", help="Category URL for Avito.ma")
+    parser.add_argument("--keyword", action="append", help="Keyword for Moteur.ma search (repeatable, default: minibus)")
+    parser.add_argument("--avito-url", action="append", help="Category URL for Avito.ma (repeatable)")
+    parser.add_argument("--site", action="append", choices=list(sites.SITES), help="Only scrape this site (repeatable)")
+    parser.add_argument("--sequential", action="store_true", help="Visit the sites one after another instead of in parallel")
+    parser.add_argument("--incremental", action="store_true", help="Only fetch details of ads that are new or changed since the last run")
+    parser.add_argument("--csv", default="liste_annonces_v2.csv", help="Export the current listings to this CSV file ('' to skip)")
+    parser.add_argument("--profile", metavar="FILE", help="Profile the scrape with cProfile and save the stats to FILE")
+    parser.add_argument("--renormalize", action="store_true", help="Recompute typed prices and dates of the stored listings and exit")
+    parser.add_argument("--reanalyze", action="store_true", help="Rebuild the market analytics from the whole price history and exit")
     args = parser.parse_args()
 
-    results, _ = run_full_scrape(args.keyword, args.avito_url)
-    print(f"Done. Found {len(results)} total ads.")
+    if args.renormalize:
+        print(f"Re-normalized {store.renormalize()} listings.")
+        return
+    if args.reanalyze:
+        analytics.refresh(full=True)
+        return
+
+    # Every keyword with every Avito category; listings shared between them are crawled once
+    queries = [
+        {"keyword": keyword, "avito_url": avito_url}
+        for keyword in args.keyword or [DEFAULT_QUERY["keyword"]]
+        for avito_url in args.avito_url or [DEFAULT_QUERY["avito_url"]]
+    ]
+    scrape = partial(run_multi_scrape, queries, concurrent=not args.sequential, incremental=args.incremental, site_names=args.site)
+    if args.profile:
+        with metrics.profiled(args.profile):
+            summary = scrape()
+    else:
+        summary = scrape()
+    hashed = store.hash_images(fetch_image, IMAGE_HASH_BATCH)
+    if hashed:
+        print(f"Compared the photos of {hashed} listings.")
+    if args.csv:
+        with open(args.csv, mode='w', newline='', encoding='utf-8') as file, metrics.stage("csv_write", site="all"):
+            store.export_csv(file)
+    print(f"Done. Found {summary['count']} total ads, {len(summary['new'])} new.")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,192 @@
+import bisect
+import re
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import dedup
+import store
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS saved_searches (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    endpoint TEXT NOT NULL,
+    keywords TEXT NOT NULL DEFAULT '',
+    max_price INTEGER,
+    site TEXT,
+    region TEXT,
+    max_age_days INTEGER,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_saved_searches_endpoint ON saved_searches (endpoint);
+"""
+
+FIELDS = ("keywords", "max_price", "site", "region", "max_age_days")
+
+# Avito urls carry the city: https://www.avito.ma/fr/<city>/<category>/...
+AVITO_REGION_RE = re.compile(r"avito\.ma/[a-z]{2}/([^/]+)/")
+
+def normalize_region(text):
+    text = unicodedata.normalize("NFKD", text or "").encode("ascii", "ignore").decode().lower()
+    return re.sub(r"[^a-z]+", "-", text).strip("-") or None
+
+def listing_region(ad):
+    """Region of a listing when its site shows one, else None."""
+    match = AVITO_REGION_RE.search(ad.get("lien") or "")
+    return normalize_region(match.group(1)) if match else None
+
+class SearchIndex:
+    """Saved searches indexed for matching a batch of new listings.
+
+    Keyword searches sit in an inverted index from token to search ids; a
+    listing reaches a search only when it holds all of the search's tokens.
+    Searches without keywords are found through their max price instead:
+    they are kept sorted by max price, so the ones a listing's price fits
+    are a bisected slice. Site, region and age are checked on the few
+    candidates left.
+    """
+
+    def __init__(self, searches):
+        self.searches = {s["id"]: s for s in searches}
+        self.tokens = {}
+        self.by_token = defaultdict(list)
+        open_searches = []
+        self.open_unpriced = []
+        for s in searches:
+            tokens = set(dedup.title_tokens(s["keywords"]))
+            if tokens:
+                self.tokens[s["id"]] = len(tokens)
+                for token in tokens:
+                    self.by_token[token].append(s["id"])
+            elif s["max_price"]:
+                open_searches.append((s["max_price"], s["id"]))
+            else:
+                self.open_unpriced.append(s["id"])
+        open_searches.sort()
+        self.open_prices = [price for price, _ in open_searches]
+        self.open_ids = [search_id for _, search_id in open_searches]
+
+    def _candidates(self, ad, price):
+        hits = defaultdict(int)
+        for token in set(dedup.title_tokens(ad.get("model"))):
+            for search_id in self.by_token.get(token, ()):
+                hits[search_id] += 1
+        matched = [search_id for search_id, n in hits.items() if n == self.tokens[search_id]]
+        if price:
+            matched.extend(self.open_ids[bisect.bisect_left(self.open_prices, price):])
+        else:
+            # Unknown price: every price-capped search may still want it
+            matched.extend(self.open_ids)
+        matched.extend(self.open_unpriced)
+        return matched
+
+    def _accepts(self, s, ad, price, date, region, now):
+        if s["max_price"] and price and price > s["max_price"]:
+            return False
+        if s["site"] and s["site"] != ad.get("site"):
+            return False
+        # Listings whose site shows no region are not filtered out by it
+        if s["region"] and region and normalize_region(s["region"]) != region:
+            return False
+        if s["max_age_days"] and date and date < now - timedelta(days=s["max_age_days"]):
+            return False
+        return True
+
+    def match(self, listings, now=None):
+        """Return {search id: [listing, ...]} for the listings each search wants.
+
+        Listings need "model", "site" and "lien", plus "prix_num" (MAD, 0 when
+        unknown) and "date_parsed" (datetime or ISO string) when available.
+        """
+        now = now or datetime.now()
+        matches = defaultdict(list)
+        for ad in listings:
+            price = ad.get("prix_num") or 0
+            date = ad.get("date_parsed")
+            if isinstance(date, str):
+                date = datetime.fromisoformat(date) if date else None
+            region = listing_region(ad)
+            for search_id in self._candidates(ad, price):
+                s = self.searches[search_id]
+                if self._accepts(s, ad, price, date, region, now):
+                    matches[search_id].append(ad)
+        return matches
+
+class SearchStore:
+    """Saved searches of push subscribers, keyed by subscription endpoint.
+
+    Like SubscriptionStore, every write bumps a version and the index is
+    rebuilt only when that version changes.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.cached_version = None
+        self.cached_index = None
+        with store.transaction(self.path, immediate=True) as conn:
+            conn.executescript(SCHEMA)
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('searches_version', 0)")
+
+    def _bump(self, conn):
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'searches_version'")
+
+    def add(self, endpoint, keywords="", max_price=None, site=None, region=None, max_age_days=None):
+        """Save a search and return it; raises ValueError for an empty endpoint or bad numbers."""
+        if not endpoint:
+            raise ValueError("Missing endpoint")
+        max_price = int(max_price) if max_price not in (None, "") else None
+        max_age_days = int(max_age_days) if max_age_days not in (None, "") else None
+        if (max_price is not None and max_price <= 0) or (max_age_days is not None and max_age_days <= 0):
+            raise ValueError("max_price and max_age_days must be positive")
+        with store.transaction(self.path) as conn:
+            cur = conn.execute(
+                "INSERT INTO saved_searches (endpoint, keywords, max_price, site, region, max_age_days, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (endpoint, (keywords or "").strip(), max_price, site or None, region or None, max_age_days, time.time()),
+            )
+            self._bump(conn)
+            return self._get(conn, cur.lastrowid)
+
+    def _get(self, conn, search_id):
+        row = conn.execute("SELECT * FROM saved_searches WHERE id = ?", (search_id,)).fetchone()
+        return dict(row) if row else None
+
+    def list(self, endpoint):
+        with store.transaction(self.path) as conn:
+            rows = conn.execute("SELECT * FROM saved_searches WHERE endpoint = ? ORDER BY id", (endpoint,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def delete(self, search_id, endpoint):
+        """Delete one search of an endpoint; returns False if it has no such search."""
+        with store.transaction(self.path) as conn:
+            cur = conn.execute("DELETE FROM saved_searches WHERE id = ? AND endpoint = ?", (search_id, endpoint))
+            if cur.rowcount:
+                self._bump(conn)
+            return cur.rowcount > 0
+
+    def delete_endpoints(self, endpoints):
+        """Drop the searches of subscriptions that are gone."""
+        endpoints = list(endpoints)
+        if not endpoints:
+            return
+        with store.transaction(self.path) as conn:
+            conn.executemany("DELETE FROM saved_searches WHERE endpoint = ?", [(e,) for e in endpoints])
+            if conn.total_changes:
+                self._bump(conn)
+
+    def index(self):
+        """SearchIndex of every saved search; rebuilt only after a write."""
+        with store.transaction(self.path) as conn:
+            version = conn.execute("SELECT value FROM meta WHERE key = 'searches_version'").fetchone()[0]
+            with self.lock:
+                if version == self.cached_version:
+                    return self.cached_index
+            rows = conn.execute("SELECT * FROM saved_searches").fetchall()
+        index = SearchIndex([dict(row) for row in rows])
+        with self.lock:
+            self.cached_version = version
+            self.cached_index = index
+        return index
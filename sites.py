@@ -0,0 +1,525 @@
+import re
+from datetime import datetime, timedelta
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit
+
+from bs4 import SoupStrainer
+
+import fetcher
+import metrics
+import parsing
+from normalize import parse_date
+
+# Every site is declared as a SiteAdapter in SITES: where its listing lives,
+# how it paginates, how ads and their details are read from its pages, and
+# how politely it must be crawled. Selectors and patterns are compiled when
+# this module loads; the engine below (list_entries, get_details) runs any of
+# them. Adding a site means declaring one more adapter.
+
+# Listing pages change between runs, so they are always revalidated; detail
+# pages are served from the HTTP cache for fetcher.CACHE_TTL seconds.
+LISTING_CACHE_TTL = 0
+
+def with_page(url, param, page):
+    """Return url with its page query parameter set; page 1 is the url itself."""
+    if page <= 1:
+        return url
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k != param]
+    query.append((param, str(page)))
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+# Extraction rules
+
+class Find:
+    """A tag lookup compiled once: a tag name plus attribute filters.
+
+    ``class_re`` and ``string`` are regex patterns; with ``string`` the
+    lookup matches a text node instead of a tag. get() reads the tag's
+    text, or the first non-empty of the ``read`` attributes.
+    """
+
+    def __init__(self, name=None, class_=None, class_re=None, string=None, read=None, **attrs):
+        self.name = name
+        self.attrs = dict(attrs)
+        if class_re:
+            self.attrs["class"] = re.compile(class_re)
+        elif class_:
+            self.attrs["class"] = class_
+        self.string = re.compile(string) if string else None
+        self.read = (read,) if isinstance(read, str) else read
+
+    def strainer(self):
+        """SoupStrainer building only the tags this lookup can match."""
+        return SoupStrainer(self.name, attrs=self.attrs)
+
+    def find(self, node):
+        if self.string is not None:
+            return node.find(string=self.string)
+        return node.find(self.name, attrs=self.attrs)
+
+    def find_all(self, node):
+        return node.find_all(self.name, attrs=self.attrs)
+
+    def get(self, node, page=None):
+        tag = self.find(node)
+        if tag is None:
+            return None
+        if self.string is not None:
+            return tag.strip()
+        if self.read:
+            return next((tag.get(attr) for attr in self.read if tag.get(attr)), None)
+        return tag.get_text(strip=True)
+
+class Path:
+    """A value nested in parsed JSON, by keys and list indexes."""
+
+    def __init__(self, *keys):
+        self.keys = keys
+
+    def get(self, node, page=None):
+        for key in self.keys:
+            try:
+                node = node[key]
+            except (KeyError, IndexError, TypeError):
+                return None
+        return node
+
+class ListingImage:
+    """The image the listing page showed for the ad."""
+
+    def get(self, node, page):
+        return page.image
+
+LISTING_IMAGE = ListingImage()
+
+class Field:
+    """The first non-empty value of its getters (Find, Path, ListingImage or
+    a function of (node, page)), passed through ``format``; else ``default``."""
+
+    def __init__(self, *getters, default="N/A", format=None):
+        self.getters = getters
+        self.default = default
+        self.format = format
+
+    def get(self, node, page):
+        for getter in self.getters:
+            value = getter(node, page) if callable(getter) else getter.get(node, page)
+            if value:
+                return self.format(value) if self.format else value
+        return self.default
+
+def _field(rule):
+    return rule if isinstance(rule, Field) else Field(rule)
+
+class Page:
+    """A fetched page, parsed lazily and at most once per strainer."""
+
+    def __init__(self, url, content, image=""):
+        self.url = url
+        self.content = content
+        self.image = image
+        self.soups = {}
+        self.parsed_data = False
+        self.next_data = None
+
+    def soup(self, strainer=None):
+        if strainer not in self.soups:
+            self.soups[strainer] = parsing.make_soup(self.content, parse_only=strainer)
+        return self.soups[strainer]
+
+    def data(self):
+        """The page's __NEXT_DATA__ JSON, or None."""
+        if not self.parsed_data:
+            self.parsed_data = True
+            try:
+                self.next_data = parsing.extract_next_data(self.content)
+            except ValueError as e:
+                print(f"Error parsing JSON of {self.url}: {e}")
+        return self.next_data
+
+# Listing sources: each yields the (url, image, price) of the ads on a
+# listing page, price being "" where the listing shows none
+
+class HtmlListing:
+    """Ads found as ``item`` tags holding a ``link`` (the item itself when
+    None) whose href matches ``href`` and not ``href_exclude``.
+
+    Only the item tags are built unless ``strain`` is False.
+    ``image_in_parent`` also looks for the image around a bare link.
+    """
+
+    def __init__(self, item, link=None, image=None, price=None, href=None, href_exclude=None, strain=True,
+                 image_in_parent=False):
+        self.item = item
+        self.link = link
+        self.image = image
+        self.price = price
+        self.href = re.compile(href) if href else None
+        self.href_exclude = re.compile(href_exclude) if href_exclude else None
+        self.strainer = item.strainer() if strain else None
+        self.image_in_parent = image_in_parent
+
+    def entries(self, page, base):
+        for item in self.item.find_all(page.soup(self.strainer)):
+            a = self.link.find(item) if self.link else item
+            href = a.get("href") if a is not None else None
+            if not href or (self.href and not self.href.search(href)):
+                continue
+            if self.href_exclude and self.href_exclude.search(href):
+                continue
+            image = ""
+            if self.image:
+                image = self.image.get(item) or ""
+                if not image and self.image_in_parent and item.parent is not None:
+                    image = self.image.get(item.parent) or ""
+            price = self.price.get(item) if self.price else None
+            yield urljoin(base, href), urljoin(base, image) if image else "", price or ""
+
+class JsonListing:
+    """Ads found in the page's __NEXT_DATA__: the first non-empty of the
+    ``items`` paths (or a function of the data) lists them, and ``url``,
+    ``image`` and ``price`` are read from each."""
+
+    def __init__(self, items, url, image, price=None):
+        self.items = items
+        self.url = url
+        self.image = image
+        self.price = price
+
+    def entries(self, page, base):
+        data = page.data()
+        if not data:
+            return
+        if callable(self.items):
+            items = self.items(data)
+        else:
+            items = next((found for found in (path.get(data) for path in self.items) if found), None)
+        for item in items or ():
+            href = self.url.get(item, page) if isinstance(item, dict) else None
+            if href:
+                price = self.price.get(item, page) if self.price else None
+                yield urljoin(base, href), self.image.get(item, page) or "", str(price) if price else ""
+
+# Detail sources: each returns the fields of an ad, or None if it does not apply
+
+class HtmlDetail:
+    def __init__(self, **fields):
+        self.fields = {key: _field(rule) for key, rule in fields.items()}
+
+    def extract(self, page):
+        soup = page.soup()
+        return {key: field.get(soup, page) for key, field in self.fields.items()}
+
+class JsonDetail:
+    """Fields read from the object at ``root`` (a Path or a function of the
+    data) of the page's __NEXT_DATA__."""
+
+    def __init__(self, root, **fields):
+        self.root = root
+        self.fields = {key: _field(rule) for key, rule in fields.items()}
+
+    def extract(self, page):
+        data = page.data()
+        if not data:
+            return None
+        node = self.root(data) if callable(self.root) else self.root.get(data)
+        if not node:
+            return None
+        return {key: field.get(node, page) for key, field in self.fields.items()}
+
+class Phone:
+    """A phone number behind an AJAX call, ``url`` formatted with the seller
+    id and token found in the ``seller`` and ``token`` attributes of a tag
+    of the detail page. The number is read from the ``key`` of the JSON reply.
+    """
+
+    def __init__(self, tag, url, seller, token, key):
+        self.tag = tag
+        self.url = url
+        self.seller = seller
+        self.token = token
+        self.key = key
+
+    def ref(self, soup):
+        """(seller id, token) of a detail page, or None."""
+        tag = self.tag.find(soup)
+        if tag is None or not tag.get(self.seller):
+            return None
+        return tag[self.seller], tag.get(self.token, "")
+
+    def lookup(self, seller_id, token, referer):
+        with metrics.stage("phone"):
+            response = fetcher.get(
+                self.url.format(seller=seller_id, token=token),
+                headers={'X-Requested-With': 'XMLHttpRequest', 'Referer': referer},
+            )
+        # A block page or an error must not pass for a seller without a number
+        if response.status_code != 200:
+            raise fetcher.FetchError(f"Phone lookup returned {response.status_code}", response=response)
+        try:
+            reply = response.json()
+        except ValueError:
+            reply = None
+        if not isinstance(reply, dict):
+            raise fetcher.FetchError("Phone lookup did not return a JSON object", response=response)
+        return reply.get(self.key)
+
+class SiteAdapter:
+    """Declaration of one site.
+
+    ``listing_url`` is formatted with the scrape's parameters (keyword,
+    avito_url) and paginated through ``page_param``. ``listing`` and
+    ``details`` are sources tried in order until one finds something;
+    ``constants`` are added to every ad. Ads dated more than ``max_age``
+    ago are dropped. With a ``phone``, ads keep the seller_id and
+    phone_token to look the number up later (see lookup_phone).
+    ``limits`` are the politeness settings of its host (see
+    scraper.SITE_LIMITS).
+    """
+
+    def __init__(self, name, host, listing_url, listing, details, page_param="page", limits=None,
+                 listing_headers=None, constants=None, phone=None, max_age=None):
+        self.name = name
+        self.host = host
+        self.base = f"https://{host}"
+        self.listing_url = listing_url
+        self.listing = listing
+        self.details = details
+        self.page_param = page_param
+        self.limits = limits or {"workers": 2, "rate": 2.0, "max_rate": 4.0}
+        self.listing_headers = listing_headers
+        self.constants = constants or {}
+        self.phone = phone
+        self.max_age = max_age
+
+SITES = {}
+
+def register(adapter):
+    SITES[adapter.name] = adapter
+    return adapter
+
+def select(names=None):
+    """Adapters of the given site names (all when None), in registration order."""
+    if names is None:
+        return list(SITES.values())
+    unknown = set(names) - set(SITES)
+    if unknown:
+        raise ValueError(f"Unknown sites: {', '.join(sorted(unknown))}")
+    return [adapter for name, adapter in SITES.items() if name in names]
+
+# Engine
+
+def list_page(adapter, page=1, **params):
+    """Return the (url, image) of the ads on one listing page, in page order."""
+    return [(url, image) for url, image, _ in list_entries(adapter, page, **params)]
+
+def list_entries(adapter, page=1, **params):
+    """Return the (url, image, price) of the ads on one listing page, in page order."""
+    url = with_page(adapter.listing_url.format(**params), adapter.page_param, page)
+    print(f"Fetching {adapter.name} listing: {url}")
+    try:
+        response = fetcher.get(url, cache=True, ttl=LISTING_CACHE_TTL, headers=adapter.listing_headers)
+        listing = Page(url, response.content)
+        ads = {}
+        for source in adapter.listing:
+            for ad_url, image, price in source.entries(listing, adapter.base):
+                ads.setdefault(ad_url, (image, price))
+            if ads:
+                break
+        print(f"Found {len(ads)} unique {adapter.name} ads.")
+        return [(ad_url, image, price) for ad_url, (image, price) in ads.items()]
+    except fetcher.FetchError:
+        # Let the pipeline tell a failed fetch from a rejected ad
+        raise
+    except Exception as e:
+        metrics.record_error(e)
+        print(f"{adapter.name} listing error: {e}")
+        return []
+
+def get_details(adapter, url, image_from_list=""):
+    """Return the ad at url, or None when it cannot be read or is too old."""
+    try:
+        response = fetcher.get(url, cache=True)
+        page = Page(url, response.content, image_from_list)
+        ad = None
+        for source in adapter.details:
+            try:
+                ad = source.extract(page)
+            except Exception as e:
+                metrics.record_error(e)
+                print(f"{adapter.name} detail parse error for {url}: {e}")
+            if ad:
+                break
+        if not ad:
+            return None
+
+        if adapter.max_age:
+            date_val = parse_date(ad.get("date"))
+            if date_val is not None and date_val < datetime.now() - adapter.max_age:
+                print(f"{adapter.name}: {url} excluded by date ({ad.get('date')})")
+                return None
+
+        if adapter.phone:
+            ref = adapter.phone.ref(page.soup())
+            if ref:
+                ad["seller_id"], ad["phone_token"] = ref
+        return {**ad, **adapter.constants, "lien": url, "site": adapter.name}
+    except fetcher.FetchError:
+        # Let the pipeline tell a failed fetch from a rejected ad
+        raise
+    except Exception as e:
+        metrics.record_error(e)
+        print(f"{adapter.name} detail error for {url}: {e}")
+        return None
+
+def lookup_phone(adapter, seller_id, token, referer):
+    """Ask the site for a seller's phone number; None when it has none.
+
+    Raises fetcher.FetchError when the request fails or the reply is not
+    the expected JSON object, so that nothing is cached for the seller.
+    """
+    return adapter.phone.lookup(seller_id, token, referer)
+
+# Sites
+
+def _dirhams(value):
+    return f"{value} DH"
+
+def _apollo_ads(data):
+    state = Path("props", "pageProps", "apolloState").get(data) or {}
+    return [val for val in state.values() if isinstance(val, dict) and val.get("__typename") == "Ad"]
+
+def _apollo_ad(data):
+    state = Path("props", "pageProps", "apolloState").get(data) or {}
+    return next((val for key, val in state.items() if key.startswith("Ad:")), None)
+
+def _apollo_image(ad, page):
+    ref = Path("images", 0).get(ad)
+    if not isinstance(ref, dict):
+        return None
+    state = Path("props", "pageProps", "apolloState").get(page.data()) or {}
+    if ref.get("id") in state:
+        ref = state[ref["id"]]
+    return ref.get("url") or ref.get("uri")
+
+register(SiteAdapter(
+    "Moteur.ma", "www.moteur.ma",
+    listing_url="https://www.moteur.ma/fr/occasion/voitures/recherche/?search=1&motcle={keyword}",
+    listing=[
+        HtmlListing(
+            Find("div", class_re=r"picture|item-annonce|content-inner-listing"),
+            link=Find("a", href=True), image=Find("img", read=("src", "data-src")), href=r"/detail-annonce/",
+        ),
+        # Any ad link, when the containers changed
+        HtmlListing(
+            Find("a", href=True), image=Find("img", read="src"), href=r"/detail-annonce/",
+            strain=False, image_in_parent=True,
+        ),
+    ],
+    details=[HtmlDetail(
+        model=Field(Find("h1"), default="Utilitaire"),
+        prix=Find("div", class_re=r"price"),
+        date=Field(Find(string=r"\d{2}-\d{2}-\d{4}"), default="Today"),
+        image=Field(LISTING_IMAGE, Find("img", class_re=r"fluid|detail", read="src"), default=""),
+        telephone=Field(default="N/A"),
+    )],
+    constants={"contact": "Vendeur (Moteur.ma)"},
+    phone=Phone(
+        Find(**{"data-token": True, "data-seller": True}),
+        url="https://www.moteur.ma/fr/occasion/get_phone/{seller}/?token={token}",
+        seller="data-seller", token="data-token", key="phone",
+    ),
+    max_age=timedelta(weeks=4),
+))
+
+register(SiteAdapter(
+    "Avito.ma", "www.avito.ma",
+    listing_url="{avito_url}", page_param="o",
+    listing=[
+        JsonListing(
+            [Path("props", "pageProps", "componentProps", "ads", "ads"), Path("props", "pageProps", "ads", "ads")],
+            url=Path("href"), image=Field(Path("defaultImage"), Path("images", 0), default=""),
+            price=Path("price", "value"),
+        ),
+        # Older pages keep their ads in the Apollo cache
+        JsonListing(_apollo_ads, url=Path("url"), image=Field(_apollo_image, default=""), price=Path("price", "amount")),
+    ],
+    details=[
+        JsonDetail(
+            Path("props", "pageProps", "ad"),
+            prix=Field(Path("price", "value"), format=_dirhams),
+            model=Path("subject"),
+            date=Path("date"),
+            telephone=Path("seller", "phone", "number"),
+            image=Field(Path("defaultImage"), Path("images", 0), LISTING_IMAGE, default=""),
+        ),
+        JsonDetail(
+            _apollo_ad,
+            prix=Field(Path("price", "amount"), format=_dirhams),
+            model=Path("subject"),
+            date=Path("listTime"),
+            telephone=Field(default="N/A"),
+            image=Field(LISTING_IMAGE, default=""),
+        ),
+        HtmlDetail(
+            prix=Find("p", class_re=r"price|Price"),
+            model=Find("h1"),
+            date=Field(Find("time"), Find("span", class_re=r"date|Date")),
+            telephone=Field(default="N/A"),
+            image=Field(LISTING_IMAGE, default=""),
+        ),
+    ],
+))
+
+register(SiteAdapter(
+    "Maroc-Utilitaires", "www.maroc-utilitaires.com",
+    listing_url="https://www.maroc-utilitaires.com/minibus/3-37-v115/minibus-occasion.html",
+    listing=[HtmlListing(
+        Find("div", class_="annonce-utilitaire"),
+        link=Find("a", href=True), image=Find("img", read=("src", "data-src", "data-original")),
+    )],
+    details=[HtmlDetail(
+        model=Field(Find("h1"), default="Utilitaire"),
+        prix=Field(Find("div", class_="price-tag"), Find(string=r"\d+ DH"), default="Sur demande"),
+        date=Field(Find(string=r"\d{2}/\d{2}/\d{4}"), default="Unknown"),
+        image=Field(LISTING_IMAGE, Find("img", class_="img-fluid", read="src"), default=""),
+    )],
+    constants={"contact": "Vendeur (Maroc-Utilitaires)", "telephone": "Voir site"},
+    limits={"workers": 2, "rate": 2.0, "max_rate": 4.0, "max_pages": 1},
+    max_age=timedelta(weeks=4),
+))
+
+register(SiteAdapter(
+    "Autoline", "autoline.co.ma",
+    listing_url="https://autoline.co.ma/-/minibus--c5835",
+    listing=[HtmlListing(
+        Find("div", class_="sl-item"),
+        link=Find("a", class_="sales-item-title-link", href=True), image=Find("img", read=("data-src", "src")),
+        price=Find("div", class_re=r"price"),
+    )],
+    details=[HtmlDetail(
+        model=Field(Find("h1"), default="Minibus"),
+        prix=Field(
+            Find("div", class_="price"), Find("div", class_="item-price"), Find("div", class_="sl-item__price"),
+            default="Sur demande",
+        ),
+        image=Field(
+            LISTING_IMAGE, Find("img", class_="gallery__main-image", read="src"), Find("img", class_="main-image", read="src"),
+            default="",
+        ),
+    )],
+    constants={"contact": "Autoline Seller", "telephone": "N/A", "date": "Today"},
+))
+
+register(SiteAdapter(
+    "Truck1.co.ma", "www.truck1.co.ma",
+    listing_url="https://www.truck1.co.ma/bus-et-autocars/minibus",
+    listing=[HtmlListing(Find("a", href=True), href=r"/minibus/", href_exclude=r"/minibus$")],
+    listing_headers={'Accept-Language': 'fr,fr-FR;q=0.8,en-US;q=0.5,en;q=0.3'},
+    details=[HtmlDetail(
+        model=Field(Find("h1"), default="Truck1 Ad"),
+        prix=Field(Find("div", class_="price-value"), default="Sur demande"),
+        image=Field(LISTING_IMAGE, Find("img", class_="main-image", read="src"), default=""),
+    )],
+    constants={"contact": "Truck1 Seller", "telephone": "N/A", "date": "Today"},
+))
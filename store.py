@@ -0,0 +1,768 @@
+import base64
+import csv
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import dedup
+import normalize
+
+DB_PATH = os.environ.get("LISTINGS_DB", "listings.db")
+
+# Column order of the CSV export, unchanged from the old liste_annonces_v2.csv
+FIELDNAMES = ["site", "model", "prix", "contact", "lien", "telephone", "date", "image"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (
+    lien TEXT PRIMARY KEY,
+    site TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    data TEXT,
+    model TEXT,
+    prix TEXT,
+    prix_num INTEGER,
+    devise TEXT,
+    contact TEXT,
+    telephone TEXT,
+    date TEXT,
+    date_parsed TEXT,
+    image TEXT,
+    image_id TEXT,
+    image_hash TEXT,
+    cluster_id TEXT,
+    duplicate INTEGER NOT NULL DEFAULT 0,
+    seller_id TEXT,
+    phone_token TEXT,
+    fetched_at REAL,
+    listing_url TEXT,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    gone INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS changes (
+    version INTEGER NOT NULL,
+    lien TEXT NOT NULL,
+    op TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS seller_phones (
+    site TEXT NOT NULL,
+    seller_id TEXT NOT NULL,
+    phone TEXT,
+    resolved_at REAL NOT NULL,
+    PRIMARY KEY (site, seller_id)
+);
+CREATE TABLE IF NOT EXISTS price_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    lien TEXT NOT NULL,
+    observed_at REAL NOT NULL,
+    prix_num INTEGER NOT NULL,
+    devise TEXT
+);
+CREATE TABLE IF NOT EXISTS site_runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    site TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    finished_at REAL NOT NULL,
+    listed INTEGER NOT NULL DEFAULT 0,
+    new INTEGER NOT NULL DEFAULT 0,
+    changed INTEGER NOT NULL DEFAULT 0,
+    requests INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    keyword TEXT,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    ads INTEGER
+);
+"""
+
+INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_listings_site ON listings (site, gone);
+CREATE INDEX IF NOT EXISTS idx_listings_date ON listings (date_parsed);
+CREATE INDEX IF NOT EXISTS idx_listings_price ON listings (prix_num);
+CREATE INDEX IF NOT EXISTS idx_changes_version ON changes (version);
+CREATE INDEX IF NOT EXISTS idx_listings_cluster ON listings (cluster_id);
+CREATE INDEX IF NOT EXISTS idx_listings_image ON listings (image_id);
+CREATE INDEX IF NOT EXISTS idx_listings_seller ON listings (site, seller_id);
+CREATE INDEX IF NOT EXISTS idx_price_history_lien ON price_history (lien, observed_at);
+CREATE INDEX IF NOT EXISTS idx_site_runs_site ON site_runs (site, finished_at);
+CREATE INDEX IF NOT EXISTS idx_site_runs_finished ON site_runs (finished_at);
+"""
+
+# Current listings: still listed and accepted by the detail stage
+ACTIVE = "gone = 0 AND data IS NOT NULL"
+
+# What users see: one current listing per vehicle (see refresh_clusters)
+VISIBLE = f"{ACTIVE} AND duplicate = 0"
+
+# How many data versions of the change log are kept for ?since= deltas
+CHANGES_KEPT_VERSIONS = 500
+
+# How long per-site run statistics are kept for the adaptive schedule
+SITE_RUNS_KEPT_SECONDS = 30 * 24 * 3600
+
+# Columns added after the first version of the listings table
+ADDED_COLUMNS = {
+    "model": "TEXT",
+    "prix": "TEXT",
+    "prix_num": "INTEGER",
+    "devise": "TEXT",
+    "contact": "TEXT",
+    "telephone": "TEXT",
+    "date": "TEXT",
+    "date_parsed": "TEXT",
+    "image": "TEXT",
+    "image_id": "TEXT",
+    "image_hash": "TEXT",
+    "cluster_id": "TEXT",
+    "duplicate": "INTEGER NOT NULL DEFAULT 0",
+    "seller_id": "TEXT",
+    "phone_token": "TEXT",
+    "fetched_at": "REAL",
+    "listing_url": "TEXT",
+}
+
+UPSERT_SQL = """
+INSERT INTO listings (lien, site, fingerprint, data, model, prix, prix_num, devise, contact, telephone, date, date_parsed, image, image_id, seller_id, phone_token, fetched_at, listing_url, first_seen, last_seen, gone)
+VALUES (:lien, :site, :fingerprint, :data, :model, :prix, :prix_num, :devise, :contact,
+        COALESCE((SELECT phone FROM seller_phones WHERE site = :site AND seller_id = :seller_id AND phone != 'N/A'), :telephone),
+        :date, COALESCE(:date_parsed, :now_iso), :image, :image_id, :seller_id, :phone_token, :now, :listing_url, :now, :now, 0)
+ON CONFLICT(lien) DO UPDATE SET
+    fingerprint = excluded.fingerprint,
+    data = excluded.data,
+    model = excluded.model,
+    prix = excluded.prix,
+    prix_num = excluded.prix_num,
+    devise = excluded.devise,
+    contact = excluded.contact,
+    telephone = excluded.telephone,
+    date = excluded.date,
+    date_parsed = COALESCE(:date_parsed, listings.date_parsed, :now_iso),
+    image = excluded.image,
+    image_id = excluded.image_id,
+    seller_id = excluded.seller_id,
+    phone_token = excluded.phone_token,
+    fetched_at = excluded.fetched_at,
+    listing_url = COALESCE(excluded.listing_url, listings.listing_url),
+    last_seen = excluded.last_seen,
+    gone = 0
+"""
+
+_initialized = set()
+
+def _migrate(conn):
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(listings)")}
+    for column, kind in ADDED_COLUMNS.items():
+        if column not in existing:
+            conn.execute(f"ALTER TABLE listings ADD COLUMN {column} {kind}")
+    if "image_id" not in existing:
+        rows = conn.execute("SELECT lien, image FROM listings WHERE image IS NOT NULL AND image != ''").fetchall()
+        conn.executemany("UPDATE listings SET image_id = ? WHERE lien = ?", [(image_id(row[1]), row[0]) for row in rows])
+    if "fetched_at" not in existing:
+        # Unknown until now: spread the first detail refreshes over the last sightings
+        conn.execute("UPDATE listings SET fetched_at = last_seen")
+    # lien is the primary key, which SQLite already indexes
+    conn.execute("DROP INDEX IF EXISTS idx_listings_lien")
+    if not conn.execute("SELECT 1 FROM price_history LIMIT 1").fetchone():
+        # Listings stored before prices were tracked start with their current price
+        conn.execute(
+            "INSERT INTO price_history (lien, observed_at, prix_num, devise) "
+            "SELECT lien, first_seen, prix_num, devise FROM listings WHERE data IS NOT NULL AND prix_num > 0"
+        )
+
+def connect(path=None):
+    path = path or DB_PATH
+    conn = sqlite3.connect(path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    if path not in _initialized:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        _migrate(conn)
+        conn.executescript(INDEXES)
+        conn.commit()
+        _initialized.add(path)
+    return conn
+
+@contextmanager
+def transaction(path=None, immediate=False):
+    """Yield a connection that commits on success and is always closed.
+
+    Use ``immediate`` for transactions that read before they write: taking
+    the write lock up front makes concurrent writers wait instead of failing.
+    """
+    conn = connect(path)
+    try:
+        with conn:
+            if immediate:
+                conn.execute("BEGIN IMMEDIATE")
+            yield conn
+    finally:
+        conn.close()
+
+def fingerprint(url, image="", price=""):
+    """Fingerprint of what a listing page tells us about an ad."""
+    text = f"{url}\n{image or ''}"
+    # Only listings that show the price add it, so the others keep their fingerprints
+    if price:
+        text += f"\n{price}"
+    return hashlib.sha1(text.encode()).hexdigest()
+
+def image_id(url):
+    """Id of a listing image, as used by the /img/<id> thumbnail proxy."""
+    return hashlib.sha1(url.encode()).hexdigest()[:20] if url else None
+
+def get_image_url(image_id, path=None):
+    """Source url of a listing image id, or None."""
+    with transaction(path) as conn:
+        row = conn.execute("SELECT image FROM listings WHERE image_id = ? LIMIT 1", (image_id,)).fetchone()
+    return row["image"] if row else None
+
+def _row(url, site, fp, details, now, listing=None):
+    details = details or {}
+    typed = normalize.normalize_listing(details, datetime.fromtimestamp(now))
+    parsed = typed["date_parsed"]
+    return {
+        "lien": url,
+        "site": details.get("site") or site,
+        "fingerprint": fp,
+        "data": json.dumps(details) if details else None,
+        "model": details.get("model"),
+        "prix": details.get("prix"),
+        # Price in whole MAD, 0 when unknown so the column sorts without NULLs
+        "prix_num": int(round(typed["prix_mad"])) if typed["prix_mad"] is not None else 0,
+        "devise": typed["devise"],
+        "contact": details.get("contact"),
+        "telephone": details.get("telephone"),
+        "date": details.get("date"),
+        "date_parsed": parsed.isoformat(sep=" ", timespec="seconds") if parsed else None,
+        "image": details.get("image"),
+        "image_id": image_id(details.get("image")),
+        # Where the phone number can be looked up later (see save_phone)
+        "seller_id": details.get("seller_id"),
+        "phone_token": details.get("phone_token"),
+        "listing_url": listing,
+        "now": now,
+        "now_iso": datetime.fromtimestamp(now).isoformat(sep=" ", timespec="seconds"),
+    }
+
+def _select_in(conn, sql, urls, params=()):
+    """Run ``sql`` (ending in "lien IN ({})") over urls in chunks below SQLite's parameter limit."""
+    urls = list(urls)
+    rows = []
+    for i in range(0, len(urls), 500):
+        chunk = urls[i:i + 500]
+        rows.extend(conn.execute(sql.format(",".join("?" * len(chunk))), [*params, *chunk]).fetchall())
+    return rows
+
+def get_known(site, urls, path=None):
+    """Return {lien: {"fingerprint", "data", "fetched_at"}} for the already-known urls of a site."""
+    known = {}
+    if not urls:
+        return known
+    with transaction(path) as conn:
+        rows = _select_in(conn, "SELECT lien, fingerprint, data, fetched_at FROM listings WHERE site = ? AND lien IN ({})", urls, (site,))
+    for row in rows:
+        known[row["lien"]] = {
+            "fingerprint": row["fingerprint"],
+            "data": json.loads(row["data"]) if row["data"] else None,
+            "fetched_at": row["fetched_at"],
+        }
+    return known
+
+def read_version(conn):
+    """Data version as seen by an open connection (see get_version)."""
+    row = conn.execute("SELECT value FROM meta WHERE key = 'data_version'").fetchone()
+    return row[0] if row else 0
+
+def _commit_changes(conn, changes):
+    """Bump the data version and log ``changes`` ([(lien, op)]) under it."""
+    if not changes:
+        return read_version(conn)
+    # Increment before reading so concurrent writers never share a version
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('data_version', 0)")
+    conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'data_version'")
+    version = read_version(conn)
+    conn.executemany("INSERT INTO changes (version, lien, op) VALUES (?, ?, ?)", [(version, lien, op) for lien, op in changes])
+    conn.execute("DELETE FROM changes WHERE version <= ?", (version - CHANGES_KEPT_VERSIONS,))
+    return version
+
+def _upsert(conn, rows):
+    """Upsert rows built by _row and return the visible changes as [(lien, op)].
+
+    A price observation is logged for every new listing with a price and
+    every price that differs from the stored one.
+    """
+    existing = {
+        row["lien"]: row
+        for row in _select_in(conn, "SELECT lien, data, gone, prix_num FROM listings WHERE lien IN ({})", [r["lien"] for r in rows])
+    }
+    changes = []
+    observations = []
+    for r in rows:
+        old = existing.get(r["lien"])
+        if r["data"] is not None and r["prix_num"] > 0 and (old is None or old["prix_num"] != r["prix_num"]):
+            observations.append((r["lien"], r["now"], r["prix_num"], r["devise"]))
+        was_visible = old is not None and old["data"] is not None and not old["gone"]
+        if r["data"] is None:
+            if was_visible:
+                changes.append((r["lien"], "removed"))
+        elif not was_visible:
+            changes.append((r["lien"], "added"))
+        elif old["data"] != r["data"]:
+            changes.append((r["lien"], "changed"))
+    conn.executemany(UPSERT_SQL, rows)
+    conn.executemany("INSERT INTO price_history (lien, observed_at, prix_num, devise) VALUES (?, ?, ?, ?)", observations)
+    return changes
+
+def record_site(site, seen, fetched, complete=True, listing=None, path=None):
+    """Record one listing pass of a site in a single transaction.
+
+    ``seen`` maps every url on the listing to its fingerprint, ``fetched``
+    maps the urls whose detail page was downloaded to their details (or None
+    when the detail stage rejected the ad). Fetched ads are upserted, the
+    other seen ads only get their last_seen refreshed and, when ``complete``
+    says the pass covered the whole listing, ads of the listing that were not
+    seen are marked gone. ``listing`` is the url of the listing the pass
+    walked (see _listing_scope). Returns the new data version.
+    """
+    now = time.time()
+    with transaction(path, immediate=True) as conn:
+        changes = _upsert(conn, [_row(url, site, seen[url], details, now, listing) for url, details in fetched.items()])
+
+        unchanged = [url for url in seen if url not in fetched]
+        revived = _select_in(conn, "SELECT lien FROM listings WHERE gone = 1 AND data IS NOT NULL AND lien IN ({})", unchanged)
+        changes.extend((row["lien"], "added") for row in revived)
+        conn.executemany(
+            "UPDATE listings SET last_seen = ?, gone = 0, listing_url = COALESCE(?, listing_url) WHERE lien = ?",
+            [(now, listing, url) for url in unchanged],
+        )
+
+        if complete:
+            changes.extend(_mark_gone(conn, site, seen, listing))
+        return _commit_changes(conn, changes)
+
+def _listing_scope(site, listing):
+    """WHERE clause and parameters of the ads a crawl of ``listing`` can judge.
+
+    Listings of one site can depend on the query (keyword, region), so an ad
+    belongs to the listing it was last seen on and only a crawl of that
+    listing may find it missing. Ads stored before listings were recorded
+    belong to every listing of their site.
+    """
+    if listing is None:
+        return "site = ?", (site,)
+    return "site = ? AND (listing_url = ? OR listing_url IS NULL)", (site, listing)
+
+def _mark_gone(conn, site, seen, listing=None):
+    # An empty listing is more likely a failed fetch than a sold-out site
+    if not seen:
+        return []
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS seen_urls (lien TEXT PRIMARY KEY)")
+    conn.execute("DELETE FROM seen_urls")
+    conn.executemany("INSERT OR IGNORE INTO seen_urls (lien) VALUES (?)", [(url,) for url in seen])
+    scope, params = _listing_scope(site, listing)
+    not_seen = f"{scope} AND gone = 0 AND lien NOT IN (SELECT lien FROM seen_urls)"
+    removed = conn.execute(f"SELECT lien FROM listings WHERE {not_seen} AND data IS NOT NULL", params).fetchall()
+    conn.execute(f"UPDATE listings SET gone = 1 WHERE {not_seen}", params)
+    return [(row["lien"], "removed") for row in removed]
+
+def mark_gone(site, seen, listing=None, path=None):
+    """Mark the ads of a listing missing from ``seen`` as gone after a crawl
+    that was recorded page by page; returns the new data version."""
+    with transaction(path, immediate=True) as conn:
+        return _commit_changes(conn, _mark_gone(conn, site, seen, listing))
+
+def expire_listings(site, before, listing=None, path=None):
+    """Mark gone the ads of a listing last seen on it before ``before``;
+    returns the new data version."""
+    scope, params = _listing_scope(site, listing)
+    with transaction(path, immediate=True) as conn:
+        stale = f"{scope} AND gone = 0 AND last_seen < ?"
+        removed = conn.execute(f"SELECT lien FROM listings WHERE {stale} AND data IS NOT NULL", (*params, before)).fetchall()
+        conn.execute(f"UPDATE listings SET gone = 1 WHERE {stale}", (*params, before))
+        if removed:
+            print(f"{site}: {len(removed)} ads not seen since {datetime.fromtimestamp(before):%Y-%m-%d %H:%M} marked gone.")
+        return _commit_changes(conn, [(row["lien"], "removed") for row in removed])
+
+def oldest_seen(site, listing=None, path=None):
+    """last_seen of the listing's current ad that was seen the longest ago, or None."""
+    scope, params = _listing_scope(site, listing)
+    with transaction(path) as conn:
+        return conn.execute(f"SELECT MIN(last_seen) FROM listings WHERE {scope} AND {ACTIVE}", params).fetchone()[0]
+
+def upsert_listings(ads, path=None):
+    """Upsert a batch of detail dicts in one transaction."""
+    now = time.time()
+    rows = [_row(ad["lien"], ad.get("site", ""), fingerprint(ad["lien"], ad.get("image")), ad, now) for ad in ads if ad.get("lien")]
+    with transaction(path, immediate=True) as conn:
+        _commit_changes(conn, _upsert(conn, rows))
+    return len(rows)
+
+def renormalize(path=None):
+    """Recompute prix_num, devise and date_parsed of every stored listing.
+
+    Runs normalize.normalize_frame over the whole table at once, so a change
+    to the parsing rules reaches the history without a re-scrape. Relative
+    dates are resolved against when each ad was first seen. Returns the
+    number of rows whose typed columns changed.
+    """
+    import pandas as pd
+
+    with transaction(path, immediate=True) as conn:
+        df = pd.read_sql_query("SELECT lien, prix, date, first_seen, prix_num, devise, date_parsed FROM listings", conn)
+        if df.empty:
+            return 0
+        df["seen_at"] = pd.to_datetime(df["first_seen"], unit="s", utc=True).dt.tz_convert(
+            datetime.now().astimezone().tzinfo
+        ).dt.tz_localize(None)
+        typed = normalize.normalize_frame(df, "seen_at")
+
+        new_price = typed["prix_mad"].round().fillna(0).astype("int64")
+        new_devise = typed["devise"].where(typed["devise"].notna(), None)
+        # Unparseable dates keep what they had, like the upsert does
+        new_date = typed["date_parsed"].dt.strftime("%Y-%m-%d %H:%M:%S").where(typed["date_parsed"].notna(), df["date_parsed"])
+        changed = (new_price != df["prix_num"]) | (new_devise.fillna("") != df["devise"].fillna("")) | (new_date != df["date_parsed"])
+        updates = list(zip(new_price[changed].tolist(), new_devise[changed].tolist(), new_date[changed].tolist(), df["lien"][changed].tolist()))
+        conn.executemany("UPDATE listings SET prix_num = ?, devise = ?, date_parsed = ? WHERE lien = ?", updates)
+        # Sort orders may have moved, so cached pages and ETags must refresh
+        _commit_changes(conn, [(lien, "changed") for *_, lien in updates])
+    return len(updates)
+
+def get_version(path=None):
+    """Data version, bumped by every write that changes the visible listings."""
+    with transaction(path) as conn:
+        return read_version(conn)
+
+def changes_since(since, path=None):
+    """Listings added, changed or removed after data version ``since``.
+
+    Returns {"version", "changed": [listing, ...], "removed": [lien, ...]},
+    or None when the change log no longer reaches back to ``since`` and the
+    client has to reload everything.
+    """
+    with transaction(path) as conn:
+        version = read_version(conn)
+        oldest = conn.execute("SELECT MIN(version) FROM changes").fetchone()[0]
+        if since < version and (oldest is None or since + 1 < oldest):
+            return None
+        latest = {}
+        for row in conn.execute("SELECT lien, op FROM changes WHERE version > ? ORDER BY version", (since,)):
+            latest[row["lien"]] = row["op"]
+
+        columns = ", ".join(FIELDNAMES)
+        current = _select_in(
+            conn,
+            f"SELECT {columns} FROM listings WHERE {VISIBLE} AND lien IN ({{}})",
+            [lien for lien, op in latest.items() if op != "removed"],
+        )
+    changed = [{k: row[k] if row[k] is not None else "" for k in FIELDNAMES} for row in current]
+    still_there = {ad["lien"] for ad in changed}
+    removed = [lien for lien in latest if lien not in still_there]
+    return {"version": version, "changed": changed, "removed": removed}
+
+def changed_liens(since, path=None):
+    """Liens whose visible state changed after data version ``since``, with
+    the current version: (liens, version). liens is None when the change
+    log no longer reaches back to ``since``."""
+    with transaction(path) as conn:
+        version = read_version(conn)
+        oldest = conn.execute("SELECT MIN(version) FROM changes").fetchone()[0]
+        if since < version and (oldest is None or since + 1 < oldest):
+            return None, version
+        rows = conn.execute("SELECT DISTINCT lien FROM changes WHERE version > ?", (since,)).fetchall()
+    return [row["lien"] for row in rows], version
+
+def get_price_history(lien, path=None):
+    """Price observations of a listing, oldest first."""
+    with transaction(path) as conn:
+        rows = conn.execute(
+            "SELECT observed_at, prix_num, devise FROM price_history WHERE lien = ? ORDER BY observed_at, id", (lien,)
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+CLUSTER_COLUMNS = (
+    "lien, site, model, prix_num, telephone, image, image_hash, cluster_id, duplicate, gone, first_seen, date_parsed"
+)
+
+def refresh_clusters(path=None):
+    """Re-cluster the whole history into vehicles and pick what users see.
+
+    Listings of one vehicle share a cluster_id, named after the member seen
+    first; of its current listings only the cheapest (then newest) stays
+    visible, the others are flagged duplicate. Pairs the text cannot settle
+    are compared by the photo hashes already stored (see hash_images); no
+    image is fetched here. Returns {lien: cluster_id}.
+    """
+    with transaction(path) as conn:
+        rows = [dict(row) for row in conn.execute(f"SELECT {CLUSTER_COLUMNS} FROM listings WHERE data IS NOT NULL")]
+
+    roots = dedup.cluster(rows, lambda ad: ad["image_hash"] or None)
+    members = {}
+    for ad in rows:
+        members.setdefault(roots[ad["lien"]], []).append(ad)
+
+    updates, changes, clusters = [], [], {}
+    for group in members.values():
+        cid = dedup.cluster_id(min(group, key=lambda ad: (ad["first_seen"], ad["lien"]))["lien"])
+        current = [ad for ad in group if not ad["gone"]]
+        # Cheapest known price first, then the newest
+        shown = max(current, key=lambda ad: (-(ad["prix_num"] or float("inf")), ad["date_parsed"] or ""), default=None)
+        for ad in group:
+            clusters[ad["lien"]] = cid
+            duplicate = int(ad is not shown and not ad["gone"])
+            if ad["cluster_id"] != cid or ad["duplicate"] != duplicate:
+                updates.append((cid, duplicate, ad["lien"]))
+                if not ad["gone"] and ad["duplicate"] != duplicate:
+                    changes.append((ad["lien"], "removed" if duplicate else "added"))
+
+    with transaction(path, immediate=True) as conn:
+        conn.executemany("UPDATE listings SET cluster_id = ?, duplicate = ? WHERE lien = ?", updates)
+        _commit_changes(conn, changes)
+    print(f"Dedup: {len(rows)} listings in {len(members)} vehicles.")
+    return clusters
+
+def hash_images(fetch_image, limit, should_stop=None, path=None):
+    """Hash the photos of up to ``limit`` listings in pairs only a photo can
+    settle, then re-cluster if any was hashed; returns how many were.
+
+    ``fetch_image(url)`` returns image bytes, or None for a photo the host
+    does not serve. Each photo is fetched once: one that cannot be read is
+    stored with an empty hash, while a failed request is tried again later.
+    """
+    if dedup.Image is None:
+        return 0
+    with transaction(path) as conn:
+        rows = [dict(row) for row in conn.execute(
+            f"SELECT {CLUSTER_COLUMNS} FROM listings WHERE data IS NOT NULL"
+        )]
+    wanted = {}
+
+    def image_hash(ad):
+        if ad["image_hash"] is None and ad["image"]:
+            wanted.setdefault(ad["lien"], ad["image"])
+        return ad["image_hash"] or None
+
+    dedup.cluster(rows, image_hash)
+    hashes = []
+    for lien, image in list(wanted.items())[:limit]:
+        if should_stop is not None and should_stop():
+            break
+        try:
+            hashes.append((dedup.image_dhash(fetch_image(image)) or "", lien))
+        except Exception as e:
+            print(f"Image fetch error for {image}: {e}")
+    if hashes:
+        with transaction(path, immediate=True) as conn:
+            conn.executemany("UPDATE listings SET image_hash = ? WHERE lien = ?", hashes)
+        refresh_clusters(path)
+    return len(hashes)
+
+def get_phone_ref(lien, path=None):
+    """Site, seller_id, phone_token and telephone of a stored listing, or None."""
+    with transaction(path) as conn:
+        row = conn.execute("SELECT site, seller_id, phone_token, telephone FROM listings WHERE lien = ?", (lien,)).fetchone()
+    return dict(row) if row else None
+
+def cached_phone(site, seller_id, max_age, path=None):
+    """A seller's number if it was looked up less than max_age seconds ago, else None."""
+    with transaction(path) as conn:
+        row = conn.execute(
+            "SELECT phone FROM seller_phones WHERE site = ? AND seller_id = ? AND resolved_at >= ?",
+            (site, seller_id, time.time() - max_age),
+        ).fetchone()
+    return row["phone"] if row else None
+
+def save_phone(site, seller_id, phone, path=None):
+    """Cache a seller's looked-up number and show it on every listing of the
+    seller; returns the new data version."""
+    with transaction(path, immediate=True) as conn:
+        conn.execute(
+            """
+            INSERT INTO seller_phones (site, seller_id, phone, resolved_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(site, seller_id) DO UPDATE SET phone = excluded.phone, resolved_at = excluded.resolved_at
+            """,
+            (site, seller_id, phone, time.time()),
+        )
+        if not phone or phone == "N/A":
+            return read_version(conn)
+        stale = "site = ? AND seller_id = ? AND (telephone IS NULL OR telephone != ?)"
+        changed = conn.execute(f"SELECT lien FROM listings WHERE {stale} AND {VISIBLE}", (site, seller_id, phone)).fetchall()
+        conn.execute(f"UPDATE listings SET telephone = ? WHERE {stale}", (phone, site, seller_id, phone))
+        return _commit_changes(conn, [(row["lien"], "changed") for row in changed])
+
+def pending_phones(limit, max_age, path=None):
+    """Newest visible listings of sellers whose number was never looked up,
+    or not in the last max_age seconds; one listing per seller."""
+    with transaction(path) as conn:
+        rows = conn.execute(
+            f"""
+            SELECT l.lien, l.site, l.seller_id, MAX(l.first_seen) AS first_seen
+            FROM listings l LEFT JOIN seller_phones p ON p.site = l.site AND p.seller_id = l.seller_id
+            WHERE {VISIBLE} AND l.seller_id IS NOT NULL AND (p.resolved_at IS NULL OR p.resolved_at < ?)
+            GROUP BY l.site, l.seller_id
+            ORDER BY first_seen DESC
+            LIMIT ?
+            """,
+            (time.time() - max_age, limit),
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+def new_listings(since, path=None):
+    """Visible listings first seen at or after the ``since`` timestamp, with
+    their typed prix_num and date_parsed columns."""
+    columns = ", ".join(FIELDNAMES)
+    with transaction(path) as conn:
+        rows = conn.execute(
+            f"SELECT {columns}, prix_num, date_parsed FROM listings WHERE {VISIBLE} AND first_seen >= ?", (since,)
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+def record_site_run(site, kind, started_at, listed=0, new=0, changed=0, requests=0, path=None):
+    """Record what one crawl ("full"), listing probe ("probe") or failed
+    probe ("error") of a site found and how many requests it took."""
+    now = time.time()
+    with transaction(path) as conn:
+        conn.execute(
+            "INSERT INTO site_runs (site, kind, started_at, finished_at, listed, new, changed, requests) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (site, kind, started_at, now, listed, new, changed, requests),
+        )
+        conn.execute("DELETE FROM site_runs WHERE finished_at < ?", (now - SITE_RUNS_KEPT_SECONDS,))
+
+def site_runs(sites, limit, path=None):
+    """The last ``limit`` runs of each site, oldest first: {site: [run, ...]}."""
+    runs = {}
+    with transaction(path) as conn:
+        for site in sites:
+            rows = conn.execute(
+                "SELECT * FROM site_runs WHERE site = ? ORDER BY finished_at DESC LIMIT ?", (site, limit)
+            ).fetchall()
+            runs[site] = [dict(row) for row in reversed(rows)]
+    return runs
+
+def requests_since(since, path=None):
+    """Requests made by the site runs finished since the ``since`` timestamp."""
+    with transaction(path) as conn:
+        return conn.execute("SELECT COALESCE(SUM(requests), 0) FROM site_runs WHERE finished_at >= ?", (since,)).fetchone()[0]
+
+def start_run(keyword=None, path=None):
+    with transaction(path) as conn:
+        cur = conn.execute("INSERT INTO runs (keyword, started_at) VALUES (?, ?)", (keyword, time.time()))
+        return cur.lastrowid
+
+def finish_run(run_id, ads, path=None):
+    with transaction(path) as conn:
+        conn.execute("UPDATE runs SET finished_at = ?, ads = ? WHERE id = ?", (time.time(), ads, run_id))
+
+def count_listings(path=None):
+    with transaction(path) as conn:
+        return conn.execute(f"SELECT COUNT(*) FROM listings WHERE {VISIBLE}").fetchone()[0]
+
+def list_listings(path=None):
+    """Current listings, newest first then most expensive first."""
+    columns = ", ".join(FIELDNAMES)
+    with transaction(path) as conn:
+        rows = conn.execute(
+            f"SELECT {columns} FROM listings WHERE {VISIBLE} ORDER BY date_parsed DESC, prix_num DESC"
+        ).fetchall()
+    return [{k: row[k] if row[k] is not None else "" for k in FIELDNAMES} for row in rows]
+
+# Sortable columns for query_listings; both are never NULL
+SORT_COLUMNS = {"date": "date_parsed", "price": "prix_num"}
+
+def encode_cursor(value, lien):
+    return base64.urlsafe_b64encode(json.dumps([value, lien]).encode()).decode()
+
+def decode_cursor(cursor):
+    value, lien = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return value, lien
+
+def query_listings(site=None, min_price=None, max_price=None, date_from=None, date_to=None,
+                   keyword=None, sort="date", order="desc", limit=50, cursor=None, cluster=None, path=None):
+    """One page of current listings with keyset pagination.
+
+    Each vehicle is listed once, with its "cluster_id" and the number of
+    sites "offers" it is on; ``cluster`` lists every offer of one vehicle
+    instead. Returns (listings, next_cursor); next_cursor is None on the last page.
+    Dates are "YYYY-MM-DD" strings and both bounds are inclusive. Raises
+    ValueError for an unknown sort or order, or a malformed cursor.
+    """
+    if sort not in SORT_COLUMNS:
+        raise ValueError(f"Unknown sort: {sort}")
+    if order not in ("asc", "desc"):
+        raise ValueError(f"Unknown order: {order}")
+    column = SORT_COLUMNS[sort]
+    op = "<" if order == "desc" else ">"
+
+    where = [ACTIVE] if cluster else [VISIBLE]
+    params = []
+    if cluster:
+        where.append("cluster_id = ?")
+        params.append(cluster)
+    if site:
+        where.append("site = ?")
+        params.append(site)
+    if min_price is not None:
+        where.append("prix_num >= ?")
+        params.append(min_price)
+    if max_price is not None:
+        where.append("prix_num <= ?")
+        params.append(max_price)
+    if date_from:
+        where.append("date_parsed >= ?")
+        params.append(date_from)
+    if date_to:
+        where.append("date_parsed <= ?")
+        params.append(f"{date_to} 23:59:59")
+    if keyword:
+        where.append("model LIKE ?")
+        params.append(f"%{keyword}%")
+    if cursor:
+        try:
+            value, lien = decode_cursor(cursor)
+        except Exception:
+            raise ValueError("Invalid cursor")
+        where.append(f"({column} {op} ? OR ({column} = ? AND lien {op} ?))")
+        params.extend([value, value, lien])
+
+    columns = ", ".join(FIELDNAMES)
+    sql = (
+        f"SELECT {columns}, cluster_id, {column} AS sort_value, "
+        f"(SELECT COUNT(*) FROM listings AS o WHERE o.cluster_id = listings.cluster_id AND o.gone = 0 AND o.data IS NOT NULL) AS offers "
+        f"FROM listings WHERE {' AND '.join(where)} "
+        f"ORDER BY {column} {order.upper()}, lien {order.upper()} LIMIT ?"
+    )
+    with transaction(path) as conn:
+        rows = conn.execute(sql, [*params, limit + 1]).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["sort_value"], rows[-1]["lien"])
+    listings = [
+        {**{k: row[k] if row[k] is not None else "" for k in FIELDNAMES}, "cluster_id": row["cluster_id"], "offers": max(row["offers"], 1)}
+        for row in rows
+    ]
+    return listings, next_cursor
+
+def export_csv(fileobj, path=None):
+    """Write the current listings to fileobj in the legacy ;-separated format."""
+    writer = csv.DictWriter(fileobj, fieldnames=FIELDNAMES, delimiter=';')
+    writer.writeheader()
+    for ad in list_listings(path):
+        writer.writerow(ad)
+
+def import_csv(csv_path, path=None):
+    """Seed the store from a legacy liste_annonces_v2.csv file."""
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        ads = list(csv.DictReader(f, delimiter=';'))
+    return upsert_listings(ads, path)
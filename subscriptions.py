@@ -0,0 +1,86 @@
+import json
+import os
+import threading
+import time
+
+import store
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS subscriptions (
+    endpoint TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+class SubscriptionStore:
+    """Push subscriptions keyed by endpoint, shared by every worker process.
+
+    Writes are single SQLite statements, so concurrent /subscribe calls
+    cannot lose each other's rows. Every write bumps a version number and
+    readers keep the full list in memory until that version changes.
+    """
+
+    def __init__(self, path=None, legacy_file=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.cached_version = None
+        self.cached = []
+        with store.transaction(self.path, immediate=True) as conn:
+            conn.executescript(SCHEMA)
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('subscriptions_version', 0)")
+            empty = conn.execute("SELECT COUNT(*) FROM subscriptions").fetchone()[0] == 0
+        if empty and legacy_file and os.path.exists(legacy_file):
+            self._import(legacy_file)
+
+    def _import(self, legacy_file):
+        try:
+            with open(legacy_file, "r") as f:
+                subs = json.load(f)
+        except Exception as e:
+            print(f"Legacy subscriptions import error: {e}")
+            return
+        for sub in subs:
+            if isinstance(sub, dict) and sub.get("endpoint"):
+                self.upsert(sub)
+
+    def _bump(self, conn):
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'subscriptions_version'")
+
+    def upsert(self, sub):
+        now = time.time()
+        with store.transaction(self.path) as conn:
+            conn.execute(
+                """
+                INSERT INTO subscriptions (endpoint, data, created_at, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(endpoint) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+                WHERE subscriptions.data != excluded.data
+                """,
+                (sub["endpoint"], json.dumps(sub), now, now),
+            )
+            if conn.total_changes:
+                self._bump(conn)
+
+    def delete(self, endpoints):
+        endpoints = list(endpoints)
+        if not endpoints:
+            return
+        with store.transaction(self.path) as conn:
+            conn.executemany("DELETE FROM subscriptions WHERE endpoint = ?", [(e,) for e in endpoints])
+            if conn.total_changes:
+                self._bump(conn)
+
+    def all(self):
+        """Every subscription; served from memory while the version is unchanged."""
+        with store.transaction(self.path) as conn:
+            version = conn.execute("SELECT value FROM meta WHERE key = 'subscriptions_version'").fetchone()[0]
+            with self.lock:
+                if version == self.cached_version:
+                    return self.cached
+            rows = conn.execute("SELECT data FROM subscriptions").fetchall()
+        subs = [json.loads(row["data"]) for row in rows]
+        with self.lock:
+            self.cached_version = version
+            self.cached = subs
+        return subs
@@ -0,0 +1,76 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scraper
+import sites
+import store
+
+MODELS = ["Renault Master", "Ford Transit", "Iveco Daily", "Fiat Ducato", "Peugeot Boxer"]
+
+def ad_url(n):
+    return f"https://www.moteur.ma/fr/voiture/achat-voiture-occasion/detail-annonce/{n}/"
+
+class GoneMarkingTest(unittest.TestCase):
+    """Ads of a query-dependent listing are only marked gone by crawls of that listing."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="test-gone-")
+        self.saved = store.DB_PATH, sites.list_entries, sites.get_details
+        store.DB_PATH = os.path.join(self.workdir, "listings.db")
+        # Ads listed per keyword, all on one page
+        self.listed = {}
+        sites.list_entries = lambda adapter, page=1, **query: [
+            (ad_url(n), "", "") for n in self.listed.get(query["keyword"], [])
+        ] if page == 1 else []
+        sites.get_details = lambda adapter, url, image_from_list="": {
+            "site": adapter.name, "lien": url, "model": MODELS[int(url.rstrip("/").rsplit("/", 1)[1]) - 1],
+            "prix": "100 000 DH", "contact": "", "telephone": "", "date": "", "image": "",
+        }
+
+    def tearDown(self):
+        store.DB_PATH, sites.list_entries, sites.get_details = self.saved
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def scrape(self, *keywords, incremental=False):
+        scraper.run_multi_scrape([{"keyword": keyword} for keyword in keywords], concurrent=False,
+                                 incremental=incremental, site_names=["Moteur.ma"])
+
+    def current(self):
+        with store.transaction() as conn:
+            return {row["lien"] for row in conn.execute(f"SELECT lien FROM listings WHERE {store.ACTIVE}")}
+
+    def test_other_query_keeps_its_ads(self):
+        self.listed = {"minibus": [1, 2, 3, 4], "sprinter": [1]}
+        self.scrape("minibus")
+        self.scrape("sprinter")
+        self.assertEqual(self.current(), {ad_url(n) for n in (1, 2, 3, 4)})
+
+    def test_other_query_keeps_its_ads_incremental(self):
+        self.listed = {"minibus": [1, 2, 3, 4], "sprinter": [1, 5]}
+        self.scrape("minibus", incremental=True)
+        self.scrape("sprinter", incremental=True)
+        self.assertEqual(self.current(), {ad_url(n) for n in (1, 2, 3, 4, 5)})
+
+    def test_both_queries_in_one_run(self):
+        self.listed = {"minibus": [1, 2, 3], "sprinter": [1, 4]}
+        self.scrape("minibus", "sprinter")
+        self.listed = {"minibus": [2], "sprinter": [4]}
+        self.scrape("minibus", "sprinter")
+        # Ad 1 was last seen on the sprinter listing, which no longer shows it either
+        self.assertEqual(self.current(), {ad_url(n) for n in (2, 4)})
+
+    def test_ad_missing_from_its_own_listing_is_gone(self):
+        self.listed = {"minibus": [1, 2, 3, 4], "sprinter": [1]}
+        self.scrape("minibus")
+        self.scrape("sprinter")
+        self.listed["minibus"] = [1, 2, 3]
+        self.scrape("minibus")
+        self.assertEqual(self.current(), {ad_url(n) for n in (1, 2, 3)})
+
+if __name__ == "__main__":
+    unittest.main()
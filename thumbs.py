@@ -0,0 +1,149 @@
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+import time
+
+# Pillow is optional: without it original images are cached and served as is
+try:
+    from PIL import Image, features
+    THUMB_FORMAT = "WEBP" if features.check("webp") else "JPEG"
+except ImportError:
+    Image = None
+    THUMB_FORMAT = None
+
+THUMB_DIR = os.environ.get("SCRAPER_THUMB_DIR", ".thumb_cache")
+THUMB_MAX_BYTES = int(os.environ.get("SCRAPER_THUMB_MAX_BYTES", 100 * 1024 * 1024))
+# Result cards are at most 400px wide; twice that covers high-density screens
+THUMB_WIDTH = int(os.environ.get("SCRAPER_THUMB_WIDTH", 800))
+THUMB_QUALITY = int(os.environ.get("SCRAPER_THUMB_QUALITY", 70))
+
+MIME_TYPES = {"WEBP": "image/webp", "JPEG": "image/jpeg"}
+EXTENSIONS = {"image/webp": ".webp", "image/jpeg": ".jpg", "image/png": ".png", "image/gif": ".gif"}
+
+def make_thumbnail(content, mime=None):
+    """Return (bytes, mime) of a thumbnail at most THUMB_WIDTH wide.
+
+    Without Pillow, or for content Pillow cannot read, the original is
+    returned unchanged.
+    """
+    if Image is None:
+        return content, mime or "application/octet-stream"
+    try:
+        img = Image.open(io.BytesIO(content))
+        img.thumbnail((THUMB_WIDTH, THUMB_WIDTH * 2))
+        if img.mode != "RGB" and not (THUMB_FORMAT == "WEBP" and img.mode == "RGBA"):
+            img = img.convert("RGB")
+        out = io.BytesIO()
+        img.save(out, THUMB_FORMAT, quality=THUMB_QUALITY, optimize=True)
+    except Exception as e:
+        print(f"Thumbnail error: {e}")
+        return content, mime or "application/octet-stream"
+    return out.getvalue(), MIME_TYPES[THUMB_FORMAT]
+
+class ThumbnailCache:
+    """Thumbnail files named by the hash of their content, plus a SQLite
+    index mapping image ids to files with sizes and access times for LRU
+    eviction. Images shared by several listings are stored once."""
+
+    def __init__(self, directory=THUMB_DIR, max_bytes=THUMB_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # One fetch per image id at a time; the others wait for its result
+        self.fetching = {}
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, "index.db"), timeout=30, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS thumbs (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                mime TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_thumbs_accessed ON thumbs (accessed_at)")
+        self.db.commit()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def lookup(self, thumb_id):
+        """Return (path, mime, name) of a cached thumbnail, or None."""
+        with self.lock:
+            row = self.db.execute("SELECT name, mime FROM thumbs WHERE id = ?", (thumb_id,)).fetchone()
+            if not row:
+                return None
+            if not os.path.exists(self.path(row[0])):
+                self.db.execute("DELETE FROM thumbs WHERE id = ?", (thumb_id,))
+                self.db.commit()
+                return None
+            self.db.execute("UPDATE thumbs SET accessed_at = ? WHERE id = ?", (time.time(), thumb_id))
+            self.db.commit()
+        return self.path(row[0]), row[1], row[0]
+
+    def store(self, thumb_id, content, mime=None):
+        """Resize and store an image; returns (path, mime, name)."""
+        body, mime = make_thumbnail(content, mime)
+        name = hashlib.sha1(body).hexdigest() + EXTENSIONS.get(mime, "")
+        with self.lock:
+            if not os.path.exists(self.path(name)):
+                tmp = self.path(name) + ".tmp"
+                with open(tmp, "wb") as f:
+                    f.write(body)
+                os.replace(tmp, self.path(name))
+            self.db.execute(
+                "INSERT OR REPLACE INTO thumbs (id, name, mime, size, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (thumb_id, name, mime, len(body), time.time()),
+            )
+            self._evict()
+            self.db.commit()
+        return self.path(name), mime, name
+
+    def get(self, thumb_id, fetch):
+        """Cached thumbnail of an image, calling fetch() -> (bytes, mime) on a miss.
+
+        Concurrent requests for the same missing image share one fetch.
+        Returns (path, mime, name); errors of fetch are raised to every waiter.
+        """
+        cached = self.lookup(thumb_id)
+        if cached:
+            return cached
+        with self.lock:
+            pending = self.fetching.get(thumb_id)
+            leader = pending is None
+            if leader:
+                pending = self.fetching[thumb_id] = {"done": threading.Event()}
+        if not leader:
+            pending["done"].wait()
+            if "error" in pending:
+                raise pending["error"]
+            return pending["result"]
+        try:
+            pending["result"] = self.store(thumb_id, *fetch())
+            return pending["result"]
+        except Exception as e:
+            pending["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.fetching[thumb_id]
+            pending["done"].set()
+
+    def _evict(self):
+        # Sizes count per id; a file shared by several ids is removed with its last id
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM thumbs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for thumb_id, name, size in self.db.execute("SELECT id, name, size FROM thumbs ORDER BY accessed_at").fetchall():
+            self.db.execute("DELETE FROM thumbs WHERE id = ?", (thumb_id,))
+            if not self.db.execute("SELECT 1 FROM thumbs WHERE name = ?", (name,)).fetchone():
+                try:
+                    os.remove(self.path(name))
+                except OSError:
+                    pass
+            total -= size
+            if total <= self.max_bytes:
+                break